@@ -0,0 +1,63 @@
+/*
+ * Copyright (c) 2023 Your Name
+ * SPDX-License-Identifier: Apache-2.0
+ */
+
+// First in, first out buffer. read_value is the oldest value, it is removed
+// with pop. A push while the buffer is full and a pop while it is empty are
+// ignored. depth must be a power of 2, at least 2.
+module fifo #(
+    parameter width = 8,
+    parameter depth = 4
+) (
+    input wire push,
+    input wire [width-1:0] write_value,
+
+    input wire pop,
+    output wire [width-1:0] read_value,
+
+    output reg [$clog2(depth):0] level,     // Number of values in the buffer
+    output wire empty,
+    output wire full,
+
+    input wire clk,
+    input wire rst_n
+);
+
+    localparam index_bits = $clog2(depth);
+
+    reg [width-1:0] values[depth];
+    reg [index_bits-1:0] read_index;
+    reg [index_bits-1:0] write_index;
+
+    wire do_push = push & ~full;
+    wire do_pop = pop & ~empty;
+
+    always @(posedge clk) begin
+        if (rst_n == 0) begin
+            read_index <= 0;
+            write_index <= 0;
+            level <= 0;
+        end else begin
+            if (do_push) begin
+                values[write_index] <= write_value;
+                write_index <= write_index + 1;
+            end
+
+            if (do_pop) begin
+                read_index <= read_index + 1;
+            end
+
+            if (do_push & ~do_pop) begin
+                level <= level + 1;
+            end else if (do_pop & ~do_push) begin
+                level <= level - 1;
+            end
+        end
+    end
+
+    assign read_value = values[read_index];
+    assign empty = (level == 0);
+    assign full = (level == depth);
+
+endmodule
@@ -0,0 +1,77 @@
+/*
+ * Copyright (c) 2023 Your Name
+ * SPDX-License-Identifier: Apache-2.0
+ */
+
+// Direct-mapped cache of instruction words fetched from the flash. Each line
+// holds 1 word, so loops that fit into the cache do not need any SPI
+// transactions after the first iteration. lines must be a power of 2, with
+// lines = 0 the cache is left out and never hits.
+module icache #(
+    parameter address_size = 16+2,
+    parameter lines = 4
+) (
+    input wire [address_size-3:0] address,  // flash address
+    output wire hit,
+    output wire [31:0] value,
+
+    input wire enable,
+    input wire read,            // Fetch request, for the hit counter
+    input wire fill,            // Store value into the line of address
+    input wire [31:0] fill_value,
+    input wire invalidate,      // Flash address was written to
+
+    input wire clk,
+    input wire rst_n
+);
+
+    localparam index_bits = (lines > 1) ? $clog2(lines) : 1;
+    localparam tag_bits = address_size - 4 - index_bits;
+
+    wire aligned = (address[1:0] == 0);
+    wire [index_bits-1:0] index = address[index_bits+1:2];
+    wire [tag_bits-1:0] tag = address[address_size-3:index_bits+2];
+
+    generate
+        if (lines > 0) begin : cache
+            reg [31:0] words[lines];
+            reg [tag_bits-1:0] tags[lines];
+            reg [lines-1:0] valid;
+
+            assign hit = enable & aligned & valid[index] & (tags[index] == tag);
+            assign value = words[index];
+
+            always @(posedge clk) begin
+                if (rst_n == 0 || enable == 0) begin
+                    valid <= 0;
+                end else if (invalidate) begin
+                    valid[index] <= 0;
+                end else if (fill & aligned) begin
+                    words[index] <= fill_value;
+                    tags[index] <= tag;
+                    valid[index] <= 1;
+                end
+            end
+        end else begin : no_cache
+            assign hit = 0;
+            assign value = 0;
+        end
+    endgenerate
+
+`ifdef COCOTB_SIM
+    // Only for the testbench, not synthesized
+    reg [31:0] hits;
+    reg [31:0] misses;
+
+    always @(posedge clk) begin
+        if (rst_n == 0) begin
+            hits <= 0;
+            misses <= 0;
+        end else begin
+            if (read & hit) hits <= hits + 1;
+            if (fill & enable & ~invalidate) misses <= misses + 1;
+        end
+    end
+`endif
+
+endmodule
@@ -1,6 +1,8 @@
 
 module mem_bus #(
-        parameter address_size = 16 + 2
+        parameter address_size = 16 + 2,
+        parameter icache_lines = 4,     // Instruction cache size in words, 0 for none
+        parameter uart_fifo_depth = 4   // UART TX and RX FIFO size in bytes, a power of 2 up to 8
     )(
     input  wire miso,  // Main spi signals
     output wire sclk,
@@ -34,9 +36,15 @@ module mem_bus #(
     input wire is_write,
     input wire [31:0] write_value,
 
+    input wire is_fetch,        // Request is an instruction fetch
+    output wire prefetch_en,    // CPU may fetch the next instruction during execute
+
     input wire start_request,
     output wire request_done,
 
+    input wire [31:0] cycle_count,      // Read by the program at 0x20030
+    input wire [31:0] instret_count,    // and 0x20034
+
     input wire clk,
     input wire rst_n
 );
@@ -44,39 +52,119 @@ module mem_bus #(
 
     reg io_request_done;
     reg [7:0] io_value;
+    reg [23:0] io_value_upper;      // Only set by word reads of the SPI buffers
+
+    wire is_flash_fetch = is_fetch & is_mem & ~target_address[address_size-2];
+
+    // Fetches that hit the instruction cache are done without SPI transaction
+    wire icache_hit;
+    wire [31:0] icache_value;
+    wire icache_fetch_hit = is_flash_fetch & icache_hit;
+
+    // Peripheral SPI transfers run next to the CPU. A transfer that is
+    // started by the control register gets the SPI controller as soon as
+    // the CPU is not using it, CPU requests to the flash/RAM wait until it
+    // is done. Fetches that hit the cache do not need the SPI controller.
+    reg spi_peripheral_pending;         // Transfer is queued or running
+    reg spi_peripheral_active;          // Transfer owns the SPI controller
+    reg spi_peripheral_start_request;
+
+    // DMA moves dma_length bytes from dma_source to dma_destination, one
+    // byte at a time. The flash/RAM are accessed through the SPI controller
+    // when neither the CPU nor a peripheral transfer is using it. A
+    // peripheral address is the UART: bytes are read from the RX FIFO and
+    // written to the TX FIFO, waiting for a byte or for space.
+    localparam DMA_STATE_IDLE =     3'b001;
+    localparam DMA_STATE_READ =     3'b010;
+    localparam DMA_STATE_WRITE =    3'b100;
+
+    reg [2:0] dma_state;
+    reg [address_size-1:0] dma_source;
+    reg [address_size-1:0] dma_destination;
+    reg [15:0] dma_length;              // Bytes left to move
+    reg [7:0] dma_byte;
+    reg dma_done;
+    reg dma_active;                     // DMA owns the SPI controller
+    reg dma_start_request;
+
+    wire dma_is_write = (dma_state == DMA_STATE_WRITE);
+    wire [address_size-1:0] dma_address = dma_is_write ? dma_destination : dma_source;
+    wire dma_is_mem = ~dma_address[address_size-1];
 
     // If the MSB is 0, then select the SPI flash/ram
-    wire mem_start_request = (is_spi_peripheral & spi_peripheral_start_request)
-                             | (start_request & is_mem);
+    wire cpu_mem_request = start_request & is_mem & ~icache_fetch_hit;
+    wire mem_start_request = spi_peripheral_active ? spi_peripheral_start_request
+                             : dma_active ? dma_start_request : cpu_mem_request;
     wire mem_request_done;
+    wire cpu_mem_request_done = mem_request_done & ~spi_peripheral_active & ~dma_active;
+
+    // Address of the flash/RAM transaction
+    wire [address_size-1:0] mem_address = dma_active ? dma_address : target_address;
 
     wire [31:0] mem_fetched_value;
 
-    assign request_done = is_mem ? mem_request_done : io_request_done;
-    assign fetched_value = is_mem ? mem_fetched_value : {24'd0, io_value};
+    assign request_done = ~is_mem ? io_request_done
+                          : icache_fetch_hit ? start_request : cpu_mem_request_done;
+    assign fetched_value = ~is_mem ? {io_value_upper, io_value}
+                           : icache_fetch_hit ? icache_value : mem_fetched_value;
 
     wire spi_in_transaction;
-    reg is_spi_peripheral;
-    reg spi_peripheral_start_request;
-    reg [7:0] spi_peripheral_tx_bytes;
-    reg [7:0] spi_peripheral_rx_bytes;
+    reg [31:0] spi_peripheral_tx_bytes;     // Byte 0 (0x20008) is sent first
+    reg [31:0] spi_peripheral_rx_bytes;     // First received byte (0x2000C) is the MSB
+    reg [2:0] spi_peripheral_tx_len;
+    reg [2:0] spi_peripheral_rx_len;
+    wire [3:0] spi_peripheral_num_bytes = spi_peripheral_tx_len + spi_peripheral_rx_len;
     reg [3:0] spi_cs_bits;
     reg spi_op_done;
 
-    reg [7:0] uart_tx_byte;
+    localparam uart_level_bits = $clog2(uart_fifo_depth) + 1;
+
+    // Bytes written to the UART TX register are sent from the TX FIFO, and
+    // received bytes are moved into the RX FIFO as soon as they are complete
+    reg [7:0] uart_tx_byte;         // Last byte written, pushed into the TX FIFO
+    reg uart_tx_push;
+    wire [7:0] uart_tx_value;
+    wire [uart_level_bits-1:0] uart_tx_level;
+    wire uart_tx_empty;
+    wire uart_tx_full;
     reg uart_start_tx;
     wire uart_tx_done;
-    reg uart_status_bits_hold;
+    reg uart_tx_sent;               // All bytes of the TX FIFO are sent
+
+    wire [7:0] uart_rx_value;
+    wire uart_rx_done;
+    reg uart_rx_ack;                // Moved into the RX FIFO, receive the next byte
+    wire uart_rx_push = uart_rx_done & ~uart_rx_ack;
+    reg uart_rx_pop;
+    wire [7:0] uart_rx_byte;        // Oldest received byte
+    wire [uart_level_bits-1:0] uart_rx_level;
+    wire uart_rx_empty;
+    wire uart_rx_full;
+    reg uart_rx_overrun;            // A byte was lost, as the RX FIFO was full
+
+    // The RX watermark is also the level at which RTS is set with flow control
+    reg [uart_level_bits-1:0] uart_rx_watermark;
+    reg [uart_level_bits-1:0] uart_tx_watermark;
 
-    reg [7:0] uart_rx_byte;
-    reg uart_rx_available;
-    reg uart_rx_clear;
     reg uart_flow_control_en;
-    reg uart_request_to_send;
     reg uart_clear_to_send;
+    wire uart_rx_request_to_send;   // A received byte is not moved into the RX FIFO yet
+
+    // The FIFO mode is off after reset. Without it, a byte that is written to
+    // the TX register is only sent by bit 0 of the control register, and bit
+    // 1 holds off the receiver while it is set, like before the FIFOs.
+    reg uart_fifo_en;
+    reg uart_rx_clear;
 
     reg [11:0] uart_baud_counter;
 
+    // bit 0: burst instruction fetch, bit 1: instruction cache, bit 2: quad read from flash,
+    // bit 3: prefetch of the next instruction, bit 4: quad I/O read (0xEB) instead of 0x6B
+    reg [4:0] mem_control_bits;
+    wire spi_burst_hold;
+    wire [3:0] spi_quad_out;
+    wire [3:0] spi_quad_oe;
+
     spi_controller #(.address_size(address_size)) spi_controller1 (
         .miso(miso),
         .sclk(sclk),
@@ -84,37 +172,67 @@ module mem_bus #(
 
         .in_transaction(spi_in_transaction),
 
-        .num_bytes(num_bytes),
+        .num_bytes(dma_active ? 3'd1 : num_bytes),
 
-        .is_peripheral(is_spi_peripheral),
+        .is_peripheral(spi_peripheral_active),
         .peripheral_tx_bytes(spi_peripheral_tx_bytes),
+        .peripheral_tx_len(spi_peripheral_tx_len),
+        .peripheral_rx_len(spi_peripheral_rx_len),
 
-        .target_address(target_address[15:0]),
+        .target_address(mem_address[15:0]),
         .fetched_value (mem_fetched_value),
 
-        .is_write(is_write),
-        .write_value(write_value),
+        .is_write(dma_active ? dma_is_write : is_write),
+        .write_value(dma_active ? {24'd0, dma_byte} : write_value),
 
         .start_request(mem_start_request),
         .request_done(mem_request_done),
 
-        .clk(clk)
+        // Only fetches from the flash can be continued, as CS1 is held
+        .is_fetch(is_flash_fetch & ~dma_active),
+        .burst_en(mem_control_bits[0] & ~debug_mode),
+        .burst_hold(spi_burst_hold),
+
+        // In quad mode the flash data lines IO0-IO3 are on IO3-IO6
+        .quad_en(mem_control_bits[2] & ~mem_address[address_size-1] & ~mem_address[address_size-2] & ~debug_mode),
+        .quad_io_en(mem_control_bits[4]),
+        .quad_in(io_inputs[6:3]),
+        .quad_out(spi_quad_out),
+        .quad_oe(spi_quad_oe),
+
+        .clk(clk),
+        .rst_n(rst_n)
+    );
+
+    icache #(.address_size(address_size), .lines(icache_lines)) icache1 (
+        .address(target_address[address_size-3:0]),
+        .hit(icache_hit),
+        .value(icache_value),
+
+        .enable(mem_control_bits[1]),
+        .read(start_request & is_flash_fetch),
+        .fill(start_request & is_flash_fetch & cpu_mem_request_done),
+        .fill_value(mem_fetched_value),
+        .invalidate(start_request & is_write & is_mem & ~target_address[address_size-2] & ~debug_mode),
+
+        .clk(clk),
+        .rst_n(rst_n)
     );
 
     uart uart0 (
         .start_tx(uart_start_tx),
-        .tx_value(uart_tx_byte),
+        .tx_value(uart_tx_value),
 
         .tx_done(uart_tx_done),
         .tx(uart_tx),
 
-        .rx_available(uart_rx_available),
-        .rx_value(uart_rx_byte),
-        .rx_clear(uart_rx_clear),
+        .rx_available(uart_rx_done),
+        .rx_value(uart_rx_value),
+        .rx_clear(uart_rx_ack | (~uart_fifo_en & uart_rx_clear)),
         .rx(uart_rx),
 
         .clear_to_send(~uart_flow_control_en ? 1'd0 : uart_clear_to_send),
-        .request_to_send(uart_request_to_send),
+        .request_to_send(uart_rx_request_to_send),
 
         .uart_baud_counter(uart_baud_counter),
         // .tmp_tx_uart_clk(tmp_tx_uart_clk),
@@ -124,6 +242,37 @@ module mem_bus #(
         .clk(clk)
     );
 
+    fifo #(.width(8), .depth(uart_fifo_depth)) uart_tx_fifo (
+        .push(uart_tx_push),
+        .write_value(uart_tx_byte),
+
+        // The byte that is being sent stays in the FIFO until it is done
+        .pop(uart_start_tx & uart_tx_done),
+        .read_value(uart_tx_value),
+
+        .level(uart_tx_level),
+        .empty(uart_tx_empty),
+        .full(uart_tx_full),
+
+        .clk(clk),
+        .rst_n(rst_n)
+    );
+
+    fifo #(.width(8), .depth(uart_fifo_depth)) uart_rx_fifo (
+        .push(uart_rx_push),
+        .write_value(uart_rx_value),
+
+        .pop(uart_rx_pop),
+        .read_value(uart_rx_byte),
+
+        .level(uart_rx_level),
+        .empty(uart_rx_empty),
+        .full(uart_rx_full),
+
+        .clk(clk),
+        .rst_n(rst_n)
+    );
+
     reg [3:0] outputs_bits;     // output only pins
     reg [4:0] input_bits;       // input only pins
 
@@ -134,9 +283,31 @@ module mem_bus #(
     reg [2:0] state;
 
     localparam STATE_PARSE =    3'b001;
-    localparam STATE_PENDING =  3'b010;
     localparam STATE_DONE =     3'b100;
 
+    // Writes to the SPI control, length and TX registers and reads of the
+    // RX registers wait until the queued peripheral transfer is done
+    wire spi_peripheral_wait = spi_peripheral_pending
+                               & (is_write ? (target_address[7:0] == 8'h5 || target_address[7:0] == 8'h7
+                                              || target_address[7:2] == 6'h2)
+                                           : (target_address[7:2] == 6'h3));
+
+    // Writes to the DMA registers wait until the running transfer is done
+    wire dma_wait = (dma_state != DMA_STATE_IDLE) & is_write & (target_address[7:4] == 4'h2);
+
+    // The next byte can be moved from the UART RX FIFO or into the TX FIFO.
+    // A push or pop of the last clock is not in the level yet.
+    wire dma_uart_ready = dma_is_write ? (~uart_tx_full & ~uart_tx_push) : (~uart_rx_empty & ~uart_rx_pop);
+
+    // The byte is read or written, for the flash/RAM when the SPI controller
+    // is given back
+    wire dma_step = (dma_state != DMA_STATE_IDLE)
+                    & (dma_is_mem ? (dma_active & ~dma_start_request) : dma_uart_ready);
+
+    // The last received byte is the LSB of the fetched value, move the first
+    // one to the MSB
+    wire [31:0] spi_peripheral_rx_aligned = mem_fetched_value << (6'd32 - {spi_peripheral_rx_len, 3'b0});
+
     always @ (posedge clk) begin
         if (~rst_n) begin
             outputs_bits <= 0;
@@ -148,25 +319,50 @@ module mem_bus #(
             io_outputs_bits <= 0;
             io_direction_bits <= 0;
 
-            is_spi_peripheral <= 0;
+            spi_peripheral_pending <= 0;
+            spi_peripheral_active <= 0;
             spi_peripheral_tx_bytes <= 0;
+            spi_peripheral_tx_len <= 1;     // 1 tx byte and 1 rx byte by default
+            spi_peripheral_rx_len <= 1;
             spi_peripheral_start_request <= 0;
             spi_op_done <= 0;
 
             uart_start_tx <= 0;
-            uart_status_bits_hold <= 0;
             uart_tx_byte <= 0;
+            uart_tx_push <= 0;
+            uart_tx_sent <= 0;
 
+            uart_rx_ack <= 0;
+            uart_rx_pop <= 0;
+            uart_rx_overrun <= 0;
             uart_rx_clear <= 0;
+            uart_fifo_en <= 0;
+            uart_rx_watermark <= 1;     // RTS as soon as there is a byte to read
+            uart_tx_watermark <= 0;
 
             state <= STATE_PARSE;
             uart_flow_control_en <= 0; // default is no flow control
             uart_clear_to_send <= 1;
 
             uart_baud_counter <= 12'd1249; // 9600 baud at 24MHz sys clock
+            mem_control_bits <= 5'b00000;   // every mode is opt-in
+
+            dma_state <= DMA_STATE_IDLE;
+            dma_source <= 0;
+            dma_destination <= 0;
+            dma_length <= 0;
+            dma_byte <= 0;
+            dma_done <= 0;
+            dma_active <= 0;
+            dma_start_request <= 0;
 
         end else begin
-            if (start_request) begin
+            uart_tx_push <= 0;
+            uart_rx_pop <= 0;
+
+            // Only requests to the peripherals, memory requests must not
+            // write the registers or leave io_request_done set
+            if (start_request & ~is_mem & ~spi_peripheral_wait & ~dma_wait) begin
 
                 case(state)
                     STATE_PARSE: begin
@@ -176,28 +372,69 @@ module mem_bus #(
                                 8'h2: io_direction_bits <= write_value[6:0];
                                 8'h4: io_outputs_bits   <= io_direction_bits & write_value[6:0];
                                 8'h5: begin
-                                    spi_peripheral_start_request <= 0;
-                                    is_spi_peripheral <= write_value[0];
+                                    // Nothing to transfer if both lengths are 0
+                                    spi_peripheral_pending <= write_value[0] & (|spi_peripheral_num_bytes);
                                     spi_cs_bits <= write_value[4:1];
-                                    spi_op_done <= 0;
+                                    spi_op_done <= write_value[0] & ~(|spi_peripheral_num_bytes);
+                                end
+                                8'h7: begin
+                                    // The buffers are 4 bytes, 5-7 are 4
+                                    spi_peripheral_tx_len <= write_value[2] ? 3'd4 : write_value[2:0];
+                                    spi_peripheral_rx_len <= write_value[6] ? 3'd4 : write_value[6:4];
+                                end
+                                8'h8: begin
+                                    if (num_bytes == 4) begin
+                                        spi_peripheral_tx_bytes <= write_value;
+                                    end else begin
+                                        spi_peripheral_tx_bytes[7:0] <= write_value[7:0];
+                                    end
                                 end
-                                8'h8: spi_peripheral_tx_bytes <= write_value[7:0];
+                                8'h9: spi_peripheral_tx_bytes[15:8]  <= write_value[7:0];
+                                8'hA: spi_peripheral_tx_bytes[23:16] <= write_value[7:0];
+                                8'hB: spi_peripheral_tx_bytes[31:24] <= write_value[7:0];
                                 8'h10: begin
-                                    if (uart_start_tx == 0 && write_value[0]) begin
-                                        uart_start_tx <= 1;
-                                        uart_status_bits_hold <= 0;
+                                    // Without the FIFO mode, start TX of the byte
+                                    // in the TX register if no byte is being sent
+                                    if (~write_value[4] & write_value[0] & uart_tx_empty) begin
+                                        uart_tx_push <= 1;
                                     end
 
-                                    // clear rx available bit
+                                    // remove the oldest received byte
+                                    uart_rx_pop <= write_value[1];
                                     uart_rx_clear <= write_value[1];
                                     uart_flow_control_en <= write_value[2];
 
+                                    if (write_value[3]) begin
+                                        uart_rx_overrun <= 0;
+                                    end
+
+                                    uart_fifo_en <= write_value[4];
+                                end
+                                8'h14: begin
+                                    uart_tx_byte <= write_value[7:0];
+                                    uart_tx_push <= uart_fifo_en;
                                 end
-                                8'h14: uart_tx_byte     <= write_value[7:0];
                                 8'h16: uart_baud_counter <= write_value[11:0];
+                                8'h18: mem_control_bits <= write_value[4:0];
+                                8'h19: begin
+                                    uart_rx_watermark <= write_value[uart_level_bits-1:0];
+                                    uart_tx_watermark <= write_value[uart_level_bits+3:4];
+                                end
+                                8'h20: dma_source       <= write_value[address_size-1:0];
+                                8'h24: dma_destination  <= write_value[address_size-1:0];
+                                8'h28: dma_length       <= write_value[15:0];
+                                8'h2C: begin
+                                    if (write_value[0]) begin
+                                        // Nothing to move if the length is 0
+                                        dma_state <= (|dma_length) ? DMA_STATE_READ : DMA_STATE_IDLE;
+                                        dma_done <= ~(|dma_length);
+                                    end
+                                end
                                 default: ;
                             endcase
                         end else begin
+                            io_value_upper <= 0;
+
                             case (target_address[7:0])
                                 8'h0:  io_value <= {4'd0, outputs_bits};
                                 8'h1:  io_value <= {3'd0, input_bits};
@@ -205,39 +442,93 @@ module mem_bus #(
                                 8'h3:  io_value <= {1'd0, io_inputs_bits};
                                 8'h4:  io_value <= {1'd0, io_outputs_bits};
                                 8'h6:  io_value <= {7'd0, spi_op_done};
-                                8'h8:  io_value <= spi_peripheral_tx_bytes;
-                                8'hC:  io_value <= spi_peripheral_rx_bytes;
-                                8'h10: io_value <= {5'd0, uart_flow_control_en, uart_rx_clear, uart_start_tx};
-                                8'h11: io_value <= {6'd0, uart_rx_available, uart_status_bits_hold};
+                                8'h7:  io_value <= {1'd0, spi_peripheral_rx_len, 1'd0, spi_peripheral_tx_len};
+                                // Word reads are in the order of the bytes on the bus,
+                                // like reads from the memory
+                                8'h8: begin
+                                    if (num_bytes == 4) begin
+                                        {io_value_upper, io_value} <= {
+                                            spi_peripheral_tx_bytes[7:0], spi_peripheral_tx_bytes[15:8],
+                                            spi_peripheral_tx_bytes[23:16], spi_peripheral_tx_bytes[31:24]
+                                        };
+                                    end else begin
+                                        io_value <= spi_peripheral_tx_bytes[7:0];
+                                    end
+                                end
+                                8'h9:  io_value <= spi_peripheral_tx_bytes[15:8];
+                                8'hA:  io_value <= spi_peripheral_tx_bytes[23:16];
+                                8'hB:  io_value <= spi_peripheral_tx_bytes[31:24];
+                                8'hC: begin
+                                    if (num_bytes == 4) begin
+                                        {io_value_upper, io_value} <= spi_peripheral_rx_bytes;
+                                    end else begin
+                                        io_value <= spi_peripheral_rx_bytes[31:24];
+                                    end
+                                end
+                                8'hD:  io_value <= spi_peripheral_rx_bytes[23:16];
+                                8'hE:  io_value <= spi_peripheral_rx_bytes[15:8];
+                                8'hF:  io_value <= spi_peripheral_rx_bytes[7:0];
+                                8'h10: io_value <= {3'd0, uart_fifo_en, 1'b0, uart_flow_control_en, uart_rx_clear, ~uart_tx_empty};
+                                8'h11: io_value <= {6'd0, ~uart_rx_empty, uart_tx_sent};
+                                8'h12: io_value <= {{(8-uart_level_bits){1'b0}}, uart_rx_level};
+                                8'h13: io_value <= {{(8-uart_level_bits){1'b0}}, uart_tx_level};
                                 8'h14: io_value <= uart_tx_byte;
                                 8'h15: io_value <= uart_rx_byte;
                                 8'h16: io_value <= uart_baud_counter[7:0];
                                 8'h17: io_value <= {4'd0, uart_baud_counter[11:8]};
+                                8'h18: io_value <= {3'd0, mem_control_bits};
+                                8'h19: io_value <= {
+                                    {(4-uart_level_bits){1'b0}}, uart_tx_watermark,
+                                    {(4-uart_level_bits){1'b0}}, uart_rx_watermark
+                                };
+                                8'h1A: begin
+                                    // Read and remove the oldest received byte
+                                    io_value <= uart_rx_byte;
+                                    uart_rx_pop <= 1;
+                                end
+                                8'h1B: io_value <= {
+                                    4'd0, uart_rx_overrun, uart_tx_full,
+                                    uart_tx_level <= uart_tx_watermark, uart_rx_level >= uart_rx_watermark
+                                };
+                                8'h28: io_value <= dma_length[7:0];
+                                8'h29: io_value <= dma_length[15:8];
+                                8'h2C: io_value <= {6'd0, dma_done, dma_state != DMA_STATE_IDLE};
+                                // Word reads of the counters, so that all bytes are
+                                // of the same clock
+                                8'h30: begin
+                                    if (num_bytes == 4) begin
+                                        {io_value_upper, io_value} <= {
+                                            cycle_count[7:0], cycle_count[15:8],
+                                            cycle_count[23:16], cycle_count[31:24]
+                                        };
+                                    end else begin
+                                        io_value <= cycle_count[7:0];
+                                    end
+                                end
+                                8'h31: io_value <= cycle_count[15:8];
+                                8'h32: io_value <= cycle_count[23:16];
+                                8'h33: io_value <= cycle_count[31:24];
+                                8'h34: begin
+                                    if (num_bytes == 4) begin
+                                        {io_value_upper, io_value} <= {
+                                            instret_count[7:0], instret_count[15:8],
+                                            instret_count[23:16], instret_count[31:24]
+                                        };
+                                    end else begin
+                                        io_value <= instret_count[7:0];
+                                    end
+                                end
+                                8'h35: io_value <= instret_count[15:8];
+                                8'h36: io_value <= instret_count[23:16];
+                                8'h37: io_value <= instret_count[31:24];
                                 default: ;
                             endcase
                         end
 
-                        if (is_write && target_address[7:0] == 5 && write_value[0]) begin
-                            state <= STATE_PENDING;
-                        end else begin
-                            // For all other registers, the io request is done
-                            // in the same cycle
-                            io_request_done <= 1;
-                            state <= STATE_DONE;
-                        end
-                    end
-                    STATE_PENDING: begin
-                        if (is_write && target_address[7:0] == 5 && write_value[0]) begin
-                            spi_peripheral_start_request <= 1;
-
-                            if (mem_request_done) begin
-                                spi_peripheral_rx_bytes <= mem_fetched_value[7:0];
-                                io_request_done <= 1;
-                                is_spi_peripheral <= 0;
-                                state <= STATE_DONE;
-                                spi_op_done <= 1;
-                            end
-                        end
+                        // The io request is done in the same cycle, a
+                        // peripheral transfer runs in the background
+                        io_request_done <= 1;
+                        state <= STATE_DONE;
                     end
                     STATE_DONE:;
                     default: ;
@@ -247,21 +538,105 @@ module mem_bus #(
                 state <= STATE_PARSE;
             end
 
+            // Start a queued peripheral transfer when the CPU is not using the
+            // SPI controller. It is given back one clock after it is done, so
+            // that the controller is idle again before a CPU request.
+            if (spi_peripheral_active) begin
+                if (spi_peripheral_start_request & mem_request_done) begin
+                    spi_peripheral_rx_bytes <= spi_peripheral_rx_aligned;
+                    spi_peripheral_start_request <= 0;
+                    spi_peripheral_pending <= 0;
+                    spi_op_done <= 1;
+                end else if (~spi_peripheral_start_request) begin
+                    spi_peripheral_active <= 0;
+                end
+            end else if (spi_peripheral_pending & ~cpu_mem_request & ~dma_active) begin
+                spi_peripheral_active <= 1;
+                spi_peripheral_start_request <= 1;
+            end
+
+            // The DMA gets the SPI controller in the same way, after the CPU
+            // and peripheral transfers
+            if (dma_active) begin
+                if (dma_start_request & mem_request_done) begin
+                    dma_start_request <= 0;
+                    if (~dma_is_write) begin
+                        dma_byte <= mem_fetched_value[7:0];
+                    end
+                end else if (~dma_start_request) begin
+                    dma_active <= 0;
+                end
+            end else if ((dma_state != DMA_STATE_IDLE) & dma_is_mem & ~cpu_mem_request
+                         & ~spi_peripheral_pending & ~spi_peripheral_active) begin
+                dma_active <= 1;
+                dma_start_request <= 1;
+            end
+
+            if (dma_step) begin
+                if (dma_is_write) begin
+                    if (~dma_is_mem) begin
+                        uart_tx_byte <= dma_byte;
+                        uart_tx_push <= 1;
+                    end else begin
+                        dma_destination <= dma_destination + 1;
+                    end
+
+                    dma_length <= dma_length - 1;
+                    if (dma_length == 1) begin
+                        dma_state <= DMA_STATE_IDLE;
+                        dma_done <= 1;
+                    end else begin
+                        dma_state <= DMA_STATE_READ;
+                    end
+                end else begin
+                    if (~dma_is_mem) begin
+                        dma_byte <= uart_rx_byte;
+                        uart_rx_pop <= 1;
+                    end else begin
+                        dma_source <= dma_source + 1;
+                    end
+
+                    dma_state <= DMA_STATE_WRITE;
+                end
+            end
+
             // always update the input bits
             input_bits <= inputs;
             io_inputs_bits <= ~io_direction_bits & io_inputs;
 
             uart_clear_to_send <= uart_flow_control_en ? inputs[0] : 1'd0;
-        end
 
-        if (uart_start_tx & uart_tx_done) begin
-            uart_status_bits_hold <= 1;
-            uart_start_tx <= 0; // reset the start tx bit, to prepare for next
+            // Send the oldest byte of the TX FIFO, start_tx is low for a clock
+            // after each byte so the uart goes back to idle
+            if (uart_start_tx) begin
+                if (uart_tx_done) begin
+                    uart_start_tx <= 0;
+                end
+            end else if (~uart_tx_empty) begin
+                uart_start_tx <= 1;
+            end
+
+            if (uart_tx_push) begin
+                uart_tx_sent <= 0;
+            end else if (uart_start_tx & uart_tx_done & (uart_tx_level == 1)) begin
+                uart_tx_sent <= 1;
+            end
+
+            // Move a received byte into the RX FIFO, if it is full the byte is lost
+            uart_rx_ack <= uart_rx_push;
+            if (uart_rx_push & uart_rx_full) begin
+                uart_rx_overrun <= 1;
+            end
         end
     end
 
-    wire peripheral_cs = ~(~is_mem & is_spi_peripheral & spi_in_transaction);
-    wire debug_cs = ~(debug_mode & (spi_in_transaction));
+    // RTS is set while the RX FIFO is at the watermark, without the FIFO mode
+    // while a received byte is not cleared
+    wire uart_request_to_send = uart_fifo_en ? (uart_rx_level >= uart_rx_watermark)
+                                             : (uart_rx_request_to_send | ~uart_rx_empty);
+
+    wire peripheral_cs = ~(spi_peripheral_active & spi_in_transaction);
+    wire debug_cs = ~(debug_mode & spi_in_transaction & ~spi_peripheral_active & ~dma_active);
 
     always_comb begin
         outputs[0] = (uart_flow_control_en) ? uart_request_to_send :
@@ -276,10 +651,20 @@ module mem_bus #(
         end
     end
 
-    assign io_direction = io_direction_bits;
-    assign io_outputs = io_outputs_bits;
+    assign prefetch_en = mem_control_bits[3];
+
+    // In quad mode IO3-IO6 are the flash IO0-IO3, outputs only while the
+    // command and address are sent
+    assign io_direction = {mem_control_bits[2] ? spi_quad_oe : io_direction_bits[6:3], io_direction_bits[2:0]};
+    assign io_outputs = {mem_control_bits[2] ? spi_quad_out : io_outputs_bits[6:3], io_outputs_bits[2:0]};
+
+    // CS1 stays low during a fetch burst, even while the address is
+    // pointing elsewhere between fetches
+    wire mem_in_transaction = spi_in_transaction & ~spi_peripheral_active;
 
-    assign cs1 = ~(~debug_mode & is_mem & spi_in_transaction & ~target_address[address_size-2]);
-    assign cs2 = ~(~debug_mode & is_mem & spi_in_transaction & target_address[address_size-2]);
+    wire mem_is_mem = ~mem_address[address_size-1];
+    assign cs1 = ~(~debug_mode & ((mem_is_mem & mem_in_transaction & ~mem_address[address_size-2])
+                                  | spi_burst_hold));
+    assign cs2 = ~(~debug_mode & mem_is_mem & mem_in_transaction & mem_address[address_size-2]);
 
 endmodule
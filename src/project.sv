@@ -66,7 +66,24 @@ module tt_um_liu3hao_rv32e_min_mcu # (
     reg [3:0] reg_counter;              // Count up to 15 for shifting into register file
     reg [31:0] full_reg_write_value;    // Holds full word to be stored in registers
 
-    wire [2:0] mem_num_bytes = (state == STATE_FETCH_INSTRUCTION) ? 3'd4
+    // Prefetch: the next instruction is fetched while the current one is
+    // executed, if it does not use the memory bus itself or jump. The
+    // prefetched word is only used if the PC moves to prefetch_address,
+    // otherwise (a taken branch) it is squashed.
+    wire prefetch_en;
+    reg prefetching;                    // Prefetch request is in flight
+    reg prefetch_valid;                 // prefetch_value holds the next instruction
+    reg [address_size-1:0] prefetch_address;
+    reg [31:0] prefetch_value;
+
+    wire prefetch_allowed = opcode != I_TYPE_LOAD_INSTR && opcode != S_TYPE_INSTR
+                            && opcode != I_TYPE_JUMP_INSTR && opcode != J_TYPE_INSTR;
+    wire prefetch_hit = (alu_result[address_size-1:0] == prefetch_address);
+
+    // The PC stays until the prefetch of the next instruction is done
+    wire prefetch_wait = (state == STATE_MOVE_PROG_COUNTER) & prefetching & prefetch_hit;
+
+    wire [2:0] mem_num_bytes = (state == STATE_FETCH_INSTRUCTION || prefetching) ? 3'd4
                             : (instr_func3 == 3'd2) ? 3'd4
                             : (instr_func3 == 3'd0 || instr_func3 == 3'd4) ? 3'd1
                             : (instr_func3 == 3'd1 || instr_func3 == 3'd5) ? 3'd2
@@ -74,6 +91,10 @@ module tt_um_liu3hao_rv32e_min_mcu # (
 
     wire request_debug_mode = ui_in[6];
 
+    // Free running counters that the program can read, see mem_bus.sv
+    reg [31:0] cycle_count;
+    reg [31:0] instret_count;           // Instructions retired
+
     reg debug_mode;
     reg [3:0] debug_counter;
     reg [1:0] debug_state;
@@ -105,11 +126,15 @@ module tt_um_liu3hao_rv32e_min_mcu # (
         .is_write(
             debug_mode | (state == STATE_PARSE_INSTRUCTION & opcode == S_TYPE_INSTR)
         ),
-        .write_value(debug_mode ? debug_value : rs2),
+        .write_value(debug_mode ? debug_value : reg_value),
+
+        .is_fetch(~debug_mode & (state == STATE_FETCH_INSTRUCTION | prefetching)),
+        .prefetch_en(prefetch_en),
 
         .target_address(
             // Memory space is limited to 3 bytes and 1 extra bit.
-            debug_mode ? {12'd0, debug_counter, 2'd0} : alu_result[address_size-1:0]
+            debug_mode ? {12'd0, debug_counter, 2'd0}
+            : prefetching ? prefetch_address : alu_result[address_size-1:0]
         ),
 
         .fetched_value(mem_fetched_value),
@@ -117,6 +142,9 @@ module tt_um_liu3hao_rv32e_min_mcu # (
         .start_request(mem_start_request),
         .request_done(mem_request_done),
 
+        .cycle_count(cycle_count),
+        .instret_count(instret_count),
+
         // .tmp_tx_uart_clk(tmp_tx_uart_clk),
         // .tmp_rx_uart_clk(tmp_rx_uart_clk),
 
@@ -140,11 +168,9 @@ module tt_um_liu3hao_rv32e_min_mcu # (
         .write_register(instr_rd),
         .write_value(full_reg_write_value[1:0]),
 
-        .r_sel1(debug_mode ? debug_counter[3:0] : instr_rs1),
-        .r_value1(rs1_bit),
-
-        .r_sel2(instr_rs2),
-        .r_value2(rs2_bit),
+        .r_sel(debug_mode ? debug_counter[3:0]
+               : (state == STATE_READ_REGISTERS) ? instr_rs1 : instr_rs2),
+        .r_value(reg_value),
 
         .wr_en(state == STATE_WRITE_REGISTER & opcode != S_TYPE_INSTR & opcode != B_TYPE_INSTR),
         .shift(reg_shift),
@@ -153,11 +179,13 @@ module tt_um_liu3hao_rv32e_min_mcu # (
         .rst_n(rst_n)
     );
 
+    // The register file has one read port. rs1 is read in the clock after
+    // the fetch, rs2 while parsing. Both are kept for moving the PC, as rd
+    // is written back before that.
     reg [31:0] rs1;
     reg [31:0] rs2;
 
-    wire [1:0] rs1_bit;
-    wire [1:0] rs2_bit;
+    wire [31:0] reg_value;
 
     wire [6:0] opcode;
     wire [3:0] instr_rs1;
@@ -268,7 +296,7 @@ module tt_um_liu3hao_rv32e_min_mcu # (
                     U_TYPE_AUIPC_INSTR, U_TYPE_LUI_INSTR: alu_value2 = u_type_imm;
 
                     // For B_TYPE, set alu_value2 to rs2
-                    default:                              alu_value2 = rs2;
+                    default:                              alu_value2 = reg_value;
                 endcase
 
                 case (opcode)
@@ -355,6 +383,12 @@ module tt_um_liu3hao_rv32e_min_mcu # (
             debug_state <= DEBUG_STATE_READ_REGISTERS;
             debug_mode <= 0;
 
+            prefetching <= 0;
+            prefetch_valid <= 0;
+            prefetch_address <= 0;
+
+            instret_count <= 0;
+
         end else if (debug_mode == 1) begin
 
             case (debug_state)
@@ -367,17 +401,11 @@ module tt_um_liu3hao_rv32e_min_mcu # (
                         if (debug_counter == 0) begin
                             // write out the program counter instead, since reg 0 is always 0.
                             debug_value <= {14'd0, prog_counter};
-                            debug_state <= DEBUG_STATE_TX_VALUE;
                         end else begin
-                            debug_value <= (debug_value >> 2) | {rs1_bit, 30'd0};
-                            reg_counter <= reg_counter + 1;
-
-                            if (reg_counter == reg_counter_end) begin
-                                reg_counter <= 0;
-                                reg_shift <= 0;
-                                debug_state <= DEBUG_STATE_TX_VALUE;
-                            end
+                            debug_value <= reg_value;
                         end
+
+                        debug_state <= DEBUG_STATE_TX_VALUE;
                     end
                 end
                 DEBUG_STATE_TX_VALUE: begin
@@ -387,10 +415,6 @@ module tt_um_liu3hao_rv32e_min_mcu # (
 
                         // let counter roll over
                         debug_counter <= debug_counter + 1;
-
-                        // If counter is restarting from 0, do not set register
-                        // shift since the program counter will be read.
-                        reg_shift <= (debug_counter == 4'd15) ? 0 : 1;
                         debug_state <= DEBUG_STATE_READ_REGISTERS;
                     end
                 end
@@ -415,7 +439,7 @@ module tt_um_liu3hao_rv32e_min_mcu # (
                         if (mem_request_done == 0) begin
                             mem_start_request <= 1;
                         end else begin
-                            // Mem request completed, parse instruction
+                            // Mem request completed, read rs1 and parse instruction
                             state <= STATE_READ_REGISTERS;
                             current_instruction <= mem_fetched_value;
 
@@ -424,29 +448,27 @@ module tt_um_liu3hao_rv32e_min_mcu # (
 
                             reg_counter <= 0;
                             full_reg_write_value <= 0;
-                            reg_shift <= 0;     // Prepare to read out register values
+                            reg_shift <= 0;
                         end
                     end
                 end
 
                 STATE_READ_REGISTERS: begin
-                    if (reg_shift == 1) begin
-                        // Read out registers first before reading alu results
-                        rs1 <= (rs1 >> 2) | {rs1_bit, 30'd0};
-                        rs2 <= (rs2 >> 2) | {rs2_bit, 30'd0};
-                        reg_counter <= reg_counter + 1;
-                    end else begin
-                        reg_shift <= 1;
-                    end
+                    rs1 <= reg_value;
 
-                    if (reg_counter == reg_counter_end) begin
-                        reg_counter <= 0;
-                        reg_shift <= 0;
-                        state <= STATE_PARSE_INSTRUCTION;
+                    // The instruction is known, start the prefetch
+                    if (~prefetching && ~prefetch_valid && prefetch_en && prefetch_allowed && request_debug_mode == 0) begin
+                        prefetching <= 1;
+                        prefetch_address <= prog_counter + 4;
                     end
+
+                    state <= STATE_PARSE_INSTRUCTION;
                 end
 
                 STATE_PARSE_INSTRUCTION: begin
+                    // rs2 is read straight from the register file
+                    rs2 <= reg_value;
+
                     if ((opcode == I_TYPE_LOAD_INSTR || opcode == S_TYPE_INSTR) && mem_request_done == 0) begin
                         // If it's a load/store instruction, then start mem request
                         mem_start_request <= 1;
@@ -471,18 +493,59 @@ module tt_um_liu3hao_rv32e_min_mcu # (
                 end
 
                 STATE_MOVE_PROG_COUNTER: begin
-                    prog_counter <= alu_result[address_size-1:0];
-                    state <= STATE_FETCH_INSTRUCTION;
-                    mem_start_request <= 0; // Prepare to fetch next instruction
-
-                    // In this situation, the PC will not change anymore, so
-                    // the program is halted.
-                    if (opcode == J_TYPE_INSTR && i_type_imm_sign_extended == 0) begin
-                        halted <= 1;
+                    if (~prefetch_wait) begin
+                        prog_counter <= alu_result[address_size-1:0];
+                        mem_start_request <= 0; // Prepare to fetch next instruction
+                        instret_count <= instret_count + 1;
+
+                        if (prefetch_valid & prefetch_hit & ~request_debug_mode) begin
+                            // Continue with the prefetched instruction
+                            state <= STATE_READ_REGISTERS;
+                            current_instruction <= prefetch_value;
+
+                            reg_counter <= 0;
+                            full_reg_write_value <= 0;
+                            reg_shift <= 0;
+                        end else begin
+                            // Squash the prefetch if it is not the next
+                            // instruction. Debug mode can only be entered in
+                            // the fetch state, so the prefetch is dropped too.
+                            state <= STATE_FETCH_INSTRUCTION;
+                        end
+
+                        prefetching <= 0;
+                        prefetch_valid <= 0;
+
+                        // In this situation, the PC will not change anymore, so
+                        // the program is halted.
+                        if (opcode == J_TYPE_INSTR && i_type_imm_sign_extended == 0) begin
+                            halted <= 1;
+                        end
                     end
                 end
                 default: ;
             endcase
+
+            // The prefetch runs next to the other states, and overrides their
+            // mem_start_request, as these do not use the bus meanwhile
+            if (prefetching & ~(state == STATE_MOVE_PROG_COUNTER & ~prefetch_hit)) begin
+                if (mem_request_done == 0) begin
+                    mem_start_request <= 1;
+                end else begin
+                    mem_start_request <= 0;
+                    prefetching <= 0;
+                    prefetch_valid <= 1;
+                    prefetch_value <= mem_fetched_value;
+                end
+            end
+        end
+    end
+
+    always @ (posedge clk) begin
+        if (rst_n == 0) begin
+            cycle_count <= 0;
+        end else begin
+            cycle_count <= cycle_count + 1;
         end
     end
 
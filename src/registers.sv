@@ -5,12 +5,9 @@ module registers #(
     input wire [3:0] write_register,
     input wire [1:0] write_value,
 
-    // up to 16 registers
-    input wire [3:0] r_sel1,
-    output wire [1:0] r_value1,
-
-    input wire [3:0] r_sel2,
-    output wire [1:0] r_value2,
+    // up to 16 registers, one combinational read port
+    input wire [3:0] r_sel,
+    output wire [size-1:0] r_value,
 
     input wire wr_en,
     input wire shift,
@@ -20,9 +17,10 @@ module registers #(
 );
     reg [size-1:0] registers[16];  // Array of 16 32-bit registers
 
-    // Reading data from registers
-    assign r_value1 = registers[r_sel1][1:0];
-    assign r_value2 = registers[r_sel2][1:0];
+    // Reading data from registers. While shifting, the registers are
+    // rotated, the values are only valid when shift has been low or after
+    // a multiple of 16 shifts.
+    assign r_value = registers[r_sel];
 
     always @(posedge clk) begin
         if (rst_n == 0) begin
@@ -7,6 +7,10 @@ localparam SPI_TX_BUFFER_SIZE = 64;
 localparam SPI_RX_BUFFER_SIZE = 32;
 
 localparam SPI_CMD_BITS = 8'd32; //1 byte for code, 3 for address bytes
+localparam SPI_QUAD_DUMMY_BITS = 8'd8; // Dummy clocks of the quad output read
+localparam SPI_QUAD_IO_CMD_BITS = 8'd8; // Command of the quad I/O read on IO0
+localparam SPI_QUAD_IO_ADDRESS_END = 8'd16; // 6 address and 2 mode clocks on IO0-IO3
+localparam SPI_QUAD_IO_HEADER = 8'd20; // And 4 dummy clocks
 
 module spi_controller # (
     parameter address_size = 16+2
@@ -19,8 +23,13 @@ module spi_controller # (
 
     input wire [2:0] num_bytes,
 
+    // Peripheral transfers send peripheral_tx_len bytes (byte 0 of
+    // peripheral_tx_bytes first) and then receive peripheral_rx_len bytes,
+    // all under one CS. Up to 4 bytes each.
     input wire is_peripheral,
-    input wire [7:0] peripheral_tx_bytes,
+    input wire [31:0] peripheral_tx_bytes,
+    input wire [2:0] peripheral_tx_len,
+    input wire [2:0] peripheral_rx_len,
 
     // Limit to 3 address bytes, and 1 extra byte for whether it is
     // flash or RAM access.
@@ -33,7 +42,26 @@ module spi_controller # (
     input  wire start_request,    // Toggle from 0 to 1 to start fetch
     output wire request_done,
 
-    input wire clk                // system clock
+    // Burst mode: after an instruction fetch CS is held low, and if the next
+    // request is the fetch of the next word, only the 32 data bits are clocked.
+    input wire is_fetch,          // Request is an instruction fetch from flash
+    input wire burst_en,
+    output reg burst_hold,        // CS is held low between fetches
+
+    // Quad output read (0x6B): command and address are sent on MOSI and on
+    // IO0, and after 8 dummy clocks the data is read 4 bits per clock from
+    // quad_in. Quad I/O read (0xEB): the command is sent on MOSI and IO0, the
+    // address and a mode byte of 0 on IO0-IO3, and the data is read after
+    // 4 dummy clocks. quad_oe is only set while the address is sent, so the
+    // flash can drive the lines after it.
+    input wire quad_en,           // Use quad read if the request is a read
+    input wire quad_io_en,        // Use 0xEB instead of 0x6B
+    input wire [3:0] quad_in,
+    output wire [3:0] quad_out,
+    output wire [3:0] quad_oe,
+
+    input wire clk,               // system clock
+    input wire rst_n
 );
 
     localparam STATE_IDLE =                     3'b001;
@@ -54,10 +82,39 @@ module spi_controller # (
 
     reg [7:0] counter_end;
     reg [31:0] write_value_swapped;
+    reg [31:0] peripheral_tx_swapped;
+
+    wire [3:0] peripheral_num_bytes = peripheral_tx_len + peripheral_rx_len;
+
+    reg burst_candidate;                    // Current transaction can be continued
+    reg [address_size-3:0] burst_next_address;
+
+    reg quad_transaction;
+    reg quad_io_transaction;
+
+    wire is_burst_fetch = burst_hold & burst_en & is_fetch & ~is_write & ~is_peripheral
+                          & (target_address == burst_next_address) & (quad_en == quad_transaction)
+                          & ((quad_en & quad_io_en) == quad_io_transaction);
+
+    // Clocks before the quad data
+    wire [7:0] quad_header = quad_io_transaction ? SPI_QUAD_IO_HEADER
+                                                 : SPI_CMD_BITS + SPI_QUAD_DUMMY_BITS;
+
+    wire quad_cmd_phase = quad_transaction & (spi_clk_counter <= (quad_io_transaction ? SPI_QUAD_IO_CMD_BITS
+                                                                                      : SPI_CMD_BITS));
+    wire quad_address_phase = quad_io_transaction & ~quad_cmd_phase
+                              & (spi_clk_counter <= SPI_QUAD_IO_ADDRESS_END);
+    wire quad_data_phase = quad_transaction & (spi_clk_counter > quad_header);
 
     always_comb begin
         if (is_peripheral) begin
-            counter_end = 16; // 8 for tx byte and 8 for rx byte
+            counter_end = {1'b0, peripheral_num_bytes, 3'b0}; // 8 per tx and rx byte
+        end else if (quad_transaction) begin
+            case (num_bytes)
+                1:       counter_end = quad_header + 2;
+                2:       counter_end = quad_header + 4;
+                default: counter_end = quad_header + 8;
+            endcase
         end else begin
             case (num_bytes)
                 1:       counter_end = SPI_CMD_BITS + 8;
@@ -71,50 +128,97 @@ module spi_controller # (
         write_value_swapped = {
             write_value[7:0], write_value[15:8], write_value[23:16], write_value[31:24]
         };
+        peripheral_tx_swapped = {
+            peripheral_tx_bytes[7:0], peripheral_tx_bytes[15:8],
+            peripheral_tx_bytes[23:16], peripheral_tx_bytes[31:24]
+        };
     end
 
     always @(posedge clk) begin
         if (state == STATE_RUN_TRANSACTION) begin
             // Sample MISO on the very first clock edge too
-            spi_rx_buffer <= (spi_rx_buffer << 1) | {31'b0, miso};
+            if (quad_data_phase) begin
+                spi_rx_buffer <= {spi_rx_buffer[27:0], quad_in};
+            end else begin
+                spi_rx_buffer <= (spi_rx_buffer << 1) | {31'b0, miso};
+            end
         end
     end
 
     always @(negedge clk) begin
-        if (start_request == 0) begin
+        if (rst_n == 0) begin
             state <= STATE_IDLE;
+            burst_hold <= 0;
+            burst_candidate <= 0;
+            quad_transaction <= 0;
+            quad_io_transaction <= 0;
+
+        end else if (start_request == 0) begin
+            state <= STATE_IDLE;
+
+            // A request that is dropped before it is done (a squashed
+            // prefetch) leaves the flash in the middle of a word, so the
+            // burst can not be continued
+            if (~burst_en | state == STATE_RUN_TRANSACTION) begin
+                burst_hold <= 0;
+            end
 
         end else begin
             case (state)
                 STATE_IDLE: begin
-                    // Use 3 byte address mode for now
-                    state <= STATE_RUN_TRANSACTION;
+                    if (burst_hold & ~is_burst_fetch) begin
+                        // Not the next word, end the burst. CS goes high for
+                        // one clock and the transaction starts on the next.
+                        burst_hold <= 0;
+
+                    end else if (is_burst_fetch) begin
+                        // Continue the burst, the flash streams the next
+                        // word, so skip the command and address bits
+                        state <= STATE_RUN_TRANSACTION;
+                        spi_tx_buffer <= 0;
+                        spi_clk_counter <= quad_transaction ? quad_header + 1 : SPI_CMD_BITS + 1;
+
+                        burst_next_address <= target_address + 4;
 
-                    if (is_peripheral) begin
-                        spi_tx_buffer <= {
-                            peripheral_tx_bytes, 56'd0
-                        };
                     end else begin
-                        // Prepare the tx buffer, the MSB is transmitted first
-                        // If write_value is specified, then it needs to be transformed
-                        // for little-endian
-                        spi_tx_buffer <= {
-                            7'b0000001, ~is_write,
-                            8'd0, target_address[address_size-3:0],
-                            write_value_swapped
-                        };
+                        // Use 3 byte address mode for now
+                        state <= STATE_RUN_TRANSACTION;
+
+                        burst_candidate <= burst_en & is_fetch & ~is_write & ~is_peripheral;
+                        burst_next_address <= target_address + 4;
+                        quad_transaction <= quad_en & ~is_write & ~is_peripheral;
+                        quad_io_transaction <= quad_en & quad_io_en & ~is_write & ~is_peripheral;
+
+                        if (is_peripheral) begin
+                            // MOSI is low after the tx bytes, while receiving
+                            spi_tx_buffer <= {peripheral_tx_swapped, 32'd0}
+                                             & ~({SPI_TX_BUFFER_SIZE{1'b1}} >> {peripheral_tx_len, 3'b0});
+                        end else begin
+                            // Prepare the tx buffer, the MSB is transmitted first
+                            // If write_value is specified, then it needs to be transformed
+                            // for little-endian. MOSI is low after the address of
+                            // a read, and the mode byte of 0xEB is 0.
+                            spi_tx_buffer <= {
+                                (quad_en & ~is_write) ? (quad_io_en ? 8'hEB : 8'h6B) : {7'b0000001, ~is_write},
+                                8'd0, target_address[address_size-3:0],
+                                is_write ? write_value_swapped : 32'd0
+                            };
+                        end
+
+                        spi_clk_counter <= 1; // Increase by 1, so that comparison for
+                                              // limit later does not need +1
                     end
-
-                    spi_clk_counter <= 1; // Increase by 1, so that comparison for
-                                          // limit later does not need +1
                 end
                 STATE_RUN_TRANSACTION: begin
                     // Shift out the bits on the falling edge of the clock.
-                    spi_tx_buffer   <= (spi_tx_buffer << 1);
+                    spi_tx_buffer   <= quad_address_phase ? (spi_tx_buffer << 4) : (spi_tx_buffer << 1);
                     spi_clk_counter <= spi_clk_counter + 1;
 
                     if (spi_clk_counter == counter_end) begin
                         state <= STATE_TRANSACTION_DONE;
+
+                        // Keep CS low after a fetch, the next one may be sequential
+                        burst_hold <= burst_candidate;
                     end
                 end
                 default: ;
@@ -125,9 +229,13 @@ module spi_controller # (
     assign in_transaction = (state == STATE_RUN_TRANSACTION);
 
     // MSB is transmitted first, need to check if high impedance state is needed
-    assign mosi = in_transaction & spi_tx_buffer[SPI_TX_BUFFER_SIZE-1];
+    assign mosi = in_transaction & spi_tx_buffer[SPI_TX_BUFFER_SIZE-1] & (~quad_transaction | quad_cmd_phase);
     assign sclk = in_transaction & clk;
 
+    assign quad_out = quad_address_phase ? spi_tx_buffer[SPI_TX_BUFFER_SIZE-1 -: 4]
+                                         : {3'b000, spi_tx_buffer[SPI_TX_BUFFER_SIZE-1]};
+    assign quad_oe = {4{in_transaction}} & (quad_address_phase ? 4'b1111 : {3'b000, quad_cmd_phase});
+
     assign request_done = (start_request == 1 & state == STATE_TRANSACTION_DONE);
     assign fetched_value = spi_rx_buffer;
 
@@ -75,6 +75,7 @@ module uart (
                         tx_bit_counter <= 0;
                         tx_uart_clk <= 0;
                         tx_prev_uart_clk <= 0;
+                        tx_clk_counter <= 0;    // Full length start bit
                     end
                 end
                 STATE_ACTIVE: begin
@@ -112,6 +113,7 @@ module uart (
                         rx_bit_counter <= 0;
                         rx_uart_clk <= 0;
                         rx_prev_uart_clk <= 0;
+                        rx_clk_counter <= 0;    // Sample in the middle of the bits
                     end
                 end
                 STATE_ACTIVE : begin
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""Trace of the instructions retired by the RTL, from the commit log in tb.v.
+
+TraceMonitor copies every entry of the commit log into a Trace: the cycle,
+PC, instruction, rd write and load/store address and value. run_program
+writes the trace at the end of the program if it is called with trace=<path>,
+or for every program with TRACE=bin or TRACE=spike (see the README). Files
+that end in .log are written in the commit log format of Spike
+(--log-commits), other files in a compact binary format.
+
+The traces can be decoded and compared from the command line:
+
+    python commit_trace.py decode sim_build/traces/test_program1_0.trace
+    python commit_trace.py diff a.trace b.log           # stops at the first difference
+    python commit_trace.py diff a.trace b.trace --cycles
+"""
+
+import argparse
+import array
+import os
+import re
+import struct
+import sys
+
+import cocotb
+from cocotb.triggers import Edge, First, RisingEdge
+
+from iss import B_TYPE_INSTR, I_TYPE_LOAD_INSTR, S_TYPE_INSTR
+from lockstep import COMMIT_LOG_SIZE, CommitEntry
+
+TRACE_MAGIC = b'RVCT'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('<4sII')     # magic, version, number of entries
+
+# One array of 32-bit values per field, in the order of the binary format
+TRACE_FIELDS = ('cycle', 'pc', 'instruction', 'rd', 'rd_value', 'mem_address', 'store_value')
+
+STORE_NUM_BYTES = {0: 1, 1: 2, 2: 4}
+
+SPIKE_LINE = re.compile(r'core\s+\d+: \d+ 0x([0-9a-f]+) \(0x([0-9a-f]+)\)'
+                        r'(?: x(\d+)\s+0x([0-9a-f]+))?(?: mem 0x([0-9a-f]+)(?: 0x([0-9a-f]+))?)?')
+
+class Trace:
+    def __init__(self, capacity=65536):
+        # Preallocated, so that appending does not allocate for every entry.
+        # The capacity is doubled when it is full.
+        self.count = 0
+        self.capacity = capacity
+        self.columns = {field: array.array('I', bytes(4 * capacity)) for field in TRACE_FIELDS}
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self):
+        for column in self.columns.values():
+            column.extend(bytes(4 * self.capacity))
+        self.capacity *= 2
+
+    def append(self, cycle, pc, instruction, rd, rd_value, mem_address, store_value):
+        if self.count == self.capacity:
+            self._grow()
+
+        i = self.count
+        columns = self.columns
+        columns['cycle'][i] = cycle
+        columns['pc'][i] = pc
+        columns['instruction'][i] = instruction
+        columns['rd'][i] = rd
+        columns['rd_value'][i] = rd_value
+        columns['mem_address'][i] = mem_address
+        columns['store_value'][i] = store_value
+        self.count += 1
+
+    def entry(self, index):
+        return {field: column[index] for field, column in self.columns.items()}
+
+    def spike_line(self, index):
+        # Same fields as the commit log of Spike, the cycle is not included
+        columns = self.columns
+        instruction = columns['instruction'][index]
+        opcode = instruction & 0x7f
+        rd = columns['rd'][index]
+
+        line = 'core   0: 3 0x%08x (0x%08x)' % (columns['pc'][index], instruction)
+        if opcode not in (S_TYPE_INSTR, B_TYPE_INSTR) and rd != 0:
+            line += ' x%-2d 0x%08x' % (rd, columns['rd_value'][index])
+
+        if opcode == I_TYPE_LOAD_INSTR:
+            line += ' mem 0x%08x' % columns['mem_address'][index]
+        elif opcode == S_TYPE_INSTR:
+            num_bytes = STORE_NUM_BYTES.get((instruction >> 12) & 0x7, 4)
+            value = columns['store_value'][index] & ((1 << (8 * num_bytes)) - 1)
+            line += ' mem 0x%08x 0x%0*x' % (columns['mem_address'][index], 2 * num_bytes, value)
+
+        return line
+
+    def write(self, path):
+        # .log is the Spike format, anything else the binary format
+        if path.endswith('.log'):
+            self.write_spike(path)
+        else:
+            self.write_binary(path)
+
+    def write_binary(self, path):
+        with open(path, 'wb') as output_file:
+            output_file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, self.count))
+            for field in TRACE_FIELDS:
+                column = self.columns[field][:self.count]
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                column.tofile(output_file)
+
+    def write_spike(self, path):
+        with open(path, 'w') as output_file:
+            for i in range(self.count):
+                output_file.write(self.spike_line(i) + '\n')
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as input_file:
+            header = input_file.read(TRACE_HEADER.size)
+
+            if header[:4] != TRACE_MAGIC:
+                input_file.seek(0)
+                return cls.read_spike(input_file.read().decode())
+
+            _, version, count = TRACE_HEADER.unpack(header)
+            if version != TRACE_VERSION:
+                raise ValueError('%s: trace version %d is not supported' % (path, version))
+
+            trace = cls(max(count, 1))
+            trace.count = count
+            for field in TRACE_FIELDS:
+                column = array.array('I')
+                column.fromfile(input_file, count)
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                trace.columns[field] = column
+            trace.capacity = count
+        return trace
+
+    @classmethod
+    def read_spike(cls, text):
+        # The cycles are not in the Spike format, they are left at 0
+        trace = cls()
+        for line in text.splitlines():
+            match = SPIKE_LINE.match(line)
+            if match is None:
+                continue
+
+            pc, instruction, rd, rd_value, mem_address, store_value = match.groups()
+            trace.append(0, int(pc, 16), int(instruction, 16), int(rd or 0), int(rd_value or '0', 16),
+                         int(mem_address or '0', 16), int(store_value or '0', 16))
+        return trace
+
+class TraceMonitor:
+    # Copies the commit log in tb.v into a Trace, one batch at a time like
+    # LockstepChecker, so it does not wake up on every instruction (RTL only)
+    def __init__(self, dut, trace=None):
+        self.dut = dut
+        self.trace = Trace() if trace is None else trace
+        self.read = 0       # entries read from the commit log
+        self.lost = 0
+
+        self._log = [dut.commit_log[i] for i in range(COMMIT_LOG_SIZE)]
+        self._count = dut.commit_count
+        self._task = None
+
+    def read_batch(self):
+        # Reads all entries that were logged since the last call
+        count = self._count.value.integer
+        if count - self.read > COMMIT_LOG_SIZE:
+            self.lost += count - self.read - COMMIT_LOG_SIZE
+            self.read = count - COMMIT_LOG_SIZE
+
+        append = self.trace.append
+        log = self._log
+        while self.read < count:
+            entry = CommitEntry(log[self.read % COMMIT_LOG_SIZE].value.integer)
+            append(entry.cycle, entry.pc, entry.instruction, entry.rd, entry.rd_value,
+                   entry.mem_address, entry.store_value)
+            self.read += 1
+
+    async def run(self):
+        batch = Edge(self.dut.commit_batch)
+        halted = RisingEdge(self.dut.cpu1.halted)
+
+        while True:
+            if (await First(batch, halted)) == halted:
+                break
+            self.read_batch()
+
+        self.read_batch()
+
+    def start(self):
+        self._task = cocotb.start_soon(self.run())
+
+    def stop(self):
+        # Also reads the entries of a program that did not halt
+        if self._task is not None and not self._task.done():
+            self._task.kill()
+        self.read_batch()
+
+        if self.lost:
+            self.dut._log.warning('trace: %d entries were overwritten before they were read' % self.lost)
+
+def next_test_output_path(directory, extension):
+    # <directory>/<test name>_<n><extension>, for the n-th program of the test
+    os.makedirs(directory, exist_ok=True)
+
+    test = getattr(cocotb.regression_manager, '_test', None)
+    name = getattr(test, '__name__', 'test')
+
+    index = 0
+    while os.path.exists(os.path.join(directory, '%s_%d%s' % (name, index, extension))):
+        index += 1
+    return os.path.join(directory, '%s_%d%s' % (name, index, extension))
+
+def trace_path_from_env():
+    # Path of the next trace of the current test for TRACE=bin or TRACE=spike,
+    # in TRACE_DIR. None if the trace is off.
+    trace_format = os.environ.get('TRACE', 'off')
+    if trace_format == 'off':
+        return None
+
+    extension = '.log' if trace_format == 'spike' else '.trace'
+    return next_test_output_path(os.environ.get('TRACE_DIR', 'sim_build/traces'), extension)
+
+def diff_traces(a, b, cycles=False, context=3):
+    # Returns the lines that describe the first difference, or [] if the
+    # traces are the same. Only the fields that Spike logs are compared,
+    # and the cycles too if cycles is set.
+    def describe(trace, i):
+        line = trace.spike_line(i)
+        return ('%10d  ' % trace.columns['cycle'][i] + line) if cycles else line
+
+    for i in range(min(len(a), len(b))):
+        if describe(a, i) != describe(b, i):
+            output = ['first difference at instruction %d' % i]
+            for j in range(max(0, i - context), i):
+                output.append('  ' + describe(a, j))
+            output.append('- ' + describe(a, i))
+            output.append('+ ' + describe(b, i))
+            return output
+
+    if len(a) != len(b):
+        return ['same for %d instructions, but %d against %d instructions' % (min(len(a), len(b)), len(a), len(b))]
+    return []
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode and compare commit traces.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    decode_parser = subparsers.add_parser('decode', help='print a trace in the Spike format')
+    decode_parser.add_argument('trace')
+    decode_parser.add_argument('--cycles', action='store_true', help='print the cycle of every instruction')
+
+    diff_parser = subparsers.add_parser('diff', help='show the first difference of two traces')
+    diff_parser.add_argument('a')
+    diff_parser.add_argument('b')
+    diff_parser.add_argument('--cycles', action='store_true', help='compare the cycles too')
+    diff_parser.add_argument('--context', type=int, default=3, help='instructions shown before the difference')
+
+    args = parser.parse_args()
+
+    if args.command == 'decode':
+        trace = Trace.read(args.trace)
+        for i in range(len(trace)):
+            if args.cycles:
+                print('%10d  %s' % (trace.columns['cycle'][i], trace.spike_line(i)))
+            else:
+                print(trace.spike_line(i))
+        return 0
+
+    output = diff_traces(Trace.read(args.a), Trace.read(args.b), args.cycles, args.context)
+    for line in output:
+        print(line)
+    return 1 if output else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
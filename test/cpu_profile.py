@@ -0,0 +1,90 @@
+# Where the cycles of the CPU go, from the cycle counters in tb.v (RTL only).
+# run_program(..., profile=True) counts the cycles of the program, and
+# CpuProfile.read(dut) reads the counters once it is done. With PROFILE=yes
+# the table of every program is logged.
+
+import os
+
+# Same order as profile_class in tb.v
+OPCODE_CLASSES = ['load', 'store', 'ALU immediate', 'ALU register', 'LUI/AUIPC', 'branch', 'JAL/JALR', 'other']
+
+STATE_COUNTERS = [
+    ('fetch', 'profile_fetch_cycles'),
+    ('read registers', 'profile_read_cycles'),
+    ('parse', 'profile_parse_cycles'),
+    ('write register', 'profile_write_cycles'),
+    ('move PC', 'profile_move_cycles'),
+    ('debug read', 'profile_debug_read_cycles'),
+    ('debug TX', 'profile_debug_tx_cycles'),
+]
+
+WAIT_COUNTERS = [
+    ('fetch', 'profile_fetch_wait_cycles'),
+    ('load/store', 'profile_data_wait_cycles'),
+    ('prefetch', 'profile_prefetch_wait_cycles'),
+]
+
+SPI_COUNTERS = [
+    ('all', 'profile_spi_cycles'),
+    ('peripheral', 'profile_spi_peripheral_cycles'),
+    ('DMA', 'profile_spi_dma_cycles'),
+]
+
+def is_profile_enabled():
+    return os.environ.get('PROFILE', 'no') == 'yes'
+
+class CpuProfile:
+    def __init__(self, states, waits, spi, class_cycles, class_count):
+        # Dicts of name to cycles, and lists in the order of OPCODE_CLASSES
+        self.states = states
+        self.waits = waits
+        self.spi = spi
+        self.class_cycles = class_cycles
+        self.class_count = class_count
+
+    @classmethod
+    def read(cls, dut):
+        def read_counters(counters):
+            return {name: getattr(dut, signal).value.integer for name, signal in counters}
+
+        return cls(read_counters(STATE_COUNTERS), read_counters(WAIT_COUNTERS), read_counters(SPI_COUNTERS),
+                   [dut.profile_class_cycles[i].value.integer for i in range(len(OPCODE_CLASSES))],
+                   [dut.profile_class_count[i].value.integer for i in range(len(OPCODE_CLASSES))])
+
+    @property
+    def cycles(self):
+        # Until the CPU halted, the states cover every cycle
+        return sum(self.states.values())
+
+    @property
+    def instructions(self):
+        return sum(self.class_count)
+
+    @property
+    def cpi(self):
+        return self.cycles / self.instructions if self.instructions else 0.0
+
+    def table(self):
+        # Lines of the CPI breakdown: cycles per state, SPI waits and SPI
+        # bus use per instruction, and cycles per instruction of every class
+        instructions = max(self.instructions, 1)
+        cycles = max(self.cycles, 1)
+
+        lines = ['%-22s %10s %7s %8s' % ('', 'cycles', '%', 'CPI')]
+        sections = [('state', self.states), ('SPI wait', self.waits), ('SPI bus', self.spi)]
+        for section, counters in sections:
+            for name, value in counters.items():
+                lines.append('%-22s %10d %7.1f %8.2f' % ('%s: %s' % (section, name), value,
+                                                         100 * value / cycles, value / instructions))
+
+        lines.append('%-22s %10s %10s %8s' % ('class', 'instrs', 'cycles', 'CPI'))
+        for name, count, class_cycles in zip(OPCODE_CLASSES, self.class_count, self.class_cycles):
+            if count:
+                lines.append('%-22s %10d %10d %8.2f' % (name, count, class_cycles, class_cycles / count))
+        lines.append('%-22s %10d %10d %8.2f' % ('total', self.instructions, self.cycles, self.cpi))
+        return lines
+
+    def log(self, dut, title='CPI profile'):
+        dut._log.info(title)
+        for line in self.table():
+            dut._log.info(line)
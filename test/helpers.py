@@ -1,14 +1,24 @@
 import os
+import tempfile
 import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import ClockCycles, RisingEdge, FallingEdge, Timer
 from cocotb.binary import BinaryValue
+from cocotb.utils import get_sim_time
 
 from cocotbext.spi import SpiBus
 from cocotb.triggers import FallingEdge, RisingEdge, First
-from cocotbext.spi import SpiSlaveBase, SpiConfig
+from cocotbext.spi import SpiSlaveBase, SpiConfig, SpiFrameError
 from cocotbext.uart import UartSink
 
+from commit_trace import TraceMonitor, trace_path_from_env
+from cpu_profile import CpuProfile, is_profile_enabled
+from lockstep import LockstepChecker
+from paged_memory import PagedMemory
+from program_image import load_binary, load_listing
+from spi_analyzer import SpiAnalyzer, spi_stats_format, write_spi_stats_from_env
+from waveform import Waveform
+
 def is_gate_level_tests():
     gate_level_tests = False
 
@@ -17,8 +27,11 @@ def is_gate_level_tests():
 
     return gate_level_tests
 
+def is_benchmark_tests():
+    return 'BENCHMARKS' in os.environ and os.environ['BENCHMARKS'] == 'yes'
+
 class SpiFlashPeripheral(SpiSlaveBase):
-    def __init__(self, bus, contents, dut, name):
+    def __init__(self, bus, contents, dut, name, fast=False):
         self._config = SpiConfig(
             data_output_idle=0,
             sclk_freq=24e6,
@@ -28,72 +41,95 @@ class SpiFlashPeripheral(SpiSlaveBase):
             cpha=0,
         )
 
-        # Memory contents
-        self.contents = contents
+        # Memory contents, lists (flash) and dicts (RAM) are converted
+        self.contents = PagedMemory.from_contents(contents)
         self.name = name
         self.dut = dut
 
         self.show_debug_logs = False
+
+        # custom_func(first_byte) is called for other commands, it can use
+        # shift2 or shift_bytes to receive the rest of the frame and to reply
         self.custom_func = None
 
+        # If fast, the bits are shifted by the spi_fast_* registers in tb.v
+        # and this model only wakes up once per command/address/data chunk.
+        self.fast = fast
+
         super().__init__(bus)
 
     def get_value(self, address, num_bytes):
         # return in little-endian, so earlier mem addresses are the lsb
-        value = 0
-        for i in range(0, num_bytes):
-            value = (self.contents[address + i] << (i*8)) | value
-        return value
+        return self.contents.read_word(address, num_bytes)
+
+    def stop(self):
+        # Stop responding on the bus, the next run_program has its own models
+        self._run_coroutine_obj.kill()
+        if self.fast:
+            self.dut.spi_fast_en.value = 0
     
     def dump_memory(self):
-        print(self.contents)
+        print(self.contents[:])
     
     def dump_memory2(self):
-        keys = sorted(list(self.contents.keys()))
-
-        for addr in keys:
-            print(hex(addr), self.contents[addr])
+        for addr, value in self.contents.items():
+            print(hex(addr), value)
 
     async def _transaction(self, frame_start, frame_end):
         await frame_start
         self.idle.clear()
 
+        try:
+            await self._command(frame_end)
+        except SpiFrameError:
+            # CS went high before the command and address were complete,
+            # e.g. a squashed prefetch. The flash ignores the command.
+            self.debugLog('frame ended early')
+            if self.fast:
+                self.dut.spi_fast_en.value = 0
+
+    async def _command(self, frame_end):
+        if self.fast:
+            await self._fast_transaction(frame_end)
+            return
+
         # self.debugLog('start transaction')
 
         # wait for first byte
         first_byte = await self.shift2(8)
-        self.debugLog("got %d" % first_byte)
+        self.debugLog("got %d", first_byte)
 
         if first_byte == 0x03:
-            self.debugLog('starting read operation: %s' % self.name)
+            self.debugLog('starting read operation: %s', self.name)
             
             # Read address, next 3 bytes are read address
             address = await self.shift2(24)
-            self.debugLog('read address %d' % address)
+            self.debugLog('read address %d', address)
 
             while True:
-                try:
-                    memory_value = self.contents[address]
-                except:
-                    memory_value = 0xff
+                memory_value = self.contents[address]
 
                 try:
                     await self.shift2(8, memory_value)
-                    self.debugLog("shifted out value: %d %s" % (memory_value, bin(memory_value)))
+                    self.debugLog("shifted out value: %d (0x%02x)", memory_value, memory_value)
                     address += 1
                 except Exception as e:
-                    self.debugLog("nothing to shift: %s" % e)
+                    self.debugLog("nothing to shift: %s", e)
                     break
 
         elif first_byte == 0x02:
-            self.debugLog('starting write operation: %s' % self.name)
+            self.debugLog('starting write operation: %s', self.name)
 
             # Write operation, next 3 bytes are starting address
             address = await self.shift2(24)
 
-            self.debugLog('write to address: %d' % address)
+            self.debugLog('write to address: %d', address)
 
             while True:
+                # CS can already be high, see shift2
+                if self._cs.value == 1:
+                    break
+
                 if (await First(RisingEdge(self._sclk), frame_end)) != frame_end:
 
                     result = int(self._mosi.value)
@@ -105,7 +141,7 @@ class SpiFlashPeripheral(SpiSlaveBase):
                         result = (result << 1) | int(self._mosi.value)
 
                     await FallingEdge(self._sclk)
-                    self.debugLog('write value: %d' % result)
+                    self.debugLog('write value: %d', result)
                     self.contents[address] = result
                     address += 1
                     
@@ -118,7 +154,86 @@ class SpiFlashPeripheral(SpiSlaveBase):
         else:
             await frame_end
 
+    async def _fast_transaction(self, frame_end):
+        dut = self.dut
+        dut.spi_fast_en.value = 1
+        dut.spi_fast_bit_count.value = 0
+        self._fast_bit_count = 0
+
+        first_byte = await self.shift2(8)
+        self.debugLog("got %d", first_byte)
+
+        if first_byte == 0x03:
+            address = await self.shift2(24)
+            self.debugLog('read address %d', address)
+
+            # Stream out 4 bytes per wake up until CS goes high
+            while True:
+                value = int.from_bytes(self.contents.read(address, 4), 'big')
+                num_bits, _ = await self._fast_shift(32, value, frame_end)
+                if num_bits < 32 or self._cs.value == 1:
+                    break
+                address += 4
+
+        elif first_byte == 0x02:
+            address = await self.shift2(24)
+            self.debugLog('write to address: %d', address)
+
+            while True:
+                num_bits, result = await self._fast_shift(32, 0, frame_end)
+
+                # Only complete bytes are written, MSB byte is the earliest
+                num_bytes = num_bits // 8
+                self.contents.write(address, (result >> (num_bits % 8)).to_bytes(num_bytes, 'big'))
+                address += num_bytes
+
+                if num_bits < 32 or self._cs.value == 1:
+                    break
+
+        elif self.custom_func is not None:
+            await self.custom_func(first_byte)
+
+        if self._cs.value == 0:
+            await frame_end
+
+        dut.spi_fast_en.value = 0
+
+    async def _fast_shift(self, num_bits, value, frame_end=None, bits_per_clock=1):
+        # Load the tx shift register MSB first and wait until num_bits have
+        # been clocked, or until the end of the frame if frame_end is given.
+        # With bits_per_clock=4 (quad), num_bits is the number of clocks.
+        dut = self.dut
+        start = self._fast_bit_count
+        self._fast_bit_count = (start + num_bits) & 0xff
+
+        dut.spi_fast_tx.value = (value << (32 - num_bits * bits_per_clock)) & 0xffffffff
+        dut.spi_fast_bit_target.value = self._fast_bit_count
+        dut.spi_fast_ready.value = 0
+
+        # CS can already be high, see shift2. Waiting for spi_fast_ready then
+        # would wake up in the transaction of the other chip.
+        ready = RisingEdge(dut.spi_fast_ready)
+        if frame_end is None:
+            await ready
+        elif self._cs.value == 1 or (await First(ready, frame_end)) == frame_end:
+            num_bits = (int(dut.spi_fast_bit_count.value) - start) & 0xff
+
+        result = int(dut.spi_fast_rx.value) & ((1 << num_bits) - 1)
+        return num_bits, result
+
     async def shift2(self, num_bits, value=0):
+        if self.fast:
+            shifted, result = await self._fast_shift(num_bits, value, RisingEdge(self._cs))
+            if shifted < num_bits:
+                raise SpiFrameError("End of frame in the middle of a transaction")
+            return result
+
+        # CS goes high on the last falling edge of sclk. Verilator can update
+        # it in the same step as that edge, before a RisingEdge(cs) trigger
+        # of the next shift is set, so the level is checked too.
+        if self._cs.value == 1:
+            raise SpiFrameError("End of frame in the middle of a transaction")
+
         # immediately set miso and shift out the rest
         self._miso.value = (value >> (num_bits-1)) & 0b1
         result = await self._shift(num_bits-1, value)
@@ -127,89 +242,227 @@ class SpiFlashPeripheral(SpiSlaveBase):
         await FallingEdge(self._sclk)
         return result
 
-
-    def debugLog(self, message):
+    async def shift_bytes(self, data):
+        # Shift out the bytes of data, the first byte first, and return the
+        # bytes received at the same time. Up to 4 bytes are shifted at once.
+        received = bytearray()
+        for i in range(0, len(data), 4):
+            chunk = data[i:i + 4]
+            value = await self.shift2(8 * len(chunk), int.from_bytes(chunk, 'big'))
+            received += value.to_bytes(len(chunk), 'big')
+        return bytes(received)
+
+    def debugLog(self, message, *args):
+        # Only format the message when debug logs are shown
         if self.show_debug_logs:
-            self.dut._log.info(message)
-
-
-def prepare_bytes(memory_array):
-    # organize the memory array into bytes
-    bytes_array = []
+            self.dut._log.info(message, *args)
+
+
+class QuadSpiFlashPeripheral(SpiFlashPeripheral):
+    # SpiFlashPeripheral that also supports the quad output read (0x6B) and
+    # the quad I/O read (0xEB). Commands are received on the flash IO0 pin
+    # (flash_io0 in tb.v). For 0x6B the address is received on IO0 too and the
+    # data is sent after 8 dummy clocks, for 0xEB the address and the mode
+    # byte are received 4 bits per clock on uio_out[7:4] and the data is sent
+    # after 4 dummy clocks. The data is sent 4 bits per clock on the quad
+    # lines in tb.v (uio_in[7:4]).
+    QUAD_OUTPUT_READ = 0x6B
+    DUMMY_BITS = 8
+    QUAD_IO_READ = 0xEB
+    QUAD_IO_DUMMY_CLOCKS = 4
+
+    def __init__(self, bus, contents, dut, name, fast=False):
+        super().__init__(bus, contents, dut, name, fast)
+        self._mosi = dut.flash_io0
+        self.custom_func = self._quad_command
+        dut.flash_quad_en.value = 1
+        dut.flash_quad_conflict.value = 0
+
+    def stop(self):
+        super().stop()
+        self.dut.flash_quad_en.value = 0
+        self.dut.flash_quad_drive.value = 0
+        self.dut.spi_fast_quad.value = 0
+
+    async def _quad_command(self, first_byte):
+        if first_byte == self.QUAD_OUTPUT_READ:
+            address = await self.shift2(24)
+            await self.shift2(self.DUMMY_BITS)
+        elif first_byte == self.QUAD_IO_READ:
+            # 6 address and 2 mode clocks
+            address = await self._quad_receive(8) >> 8
+            await self.shift2(self.QUAD_IO_DUMMY_CLOCKS)
+        else:
+            return
+
+        self.debugLog('quad read 0x%02X address %d', first_byte, address)
+
+        frame_end = RisingEdge(self._cs)
+        self.dut.flash_quad_drive.value = 1
+        try:
+            if self.fast:
+                await self._fast_quad_read(address, frame_end)
+            else:
+                await self._quad_read(address, frame_end)
+        finally:
+            self.dut.flash_quad_drive.value = 0
+
+    async def _quad_receive(self, num_clocks):
+        # Receive 4 bits per clock from uio_out[7:4]
+        if self.fast:
+            await self.shift2(num_clocks)
+            return int(self.dut.spi_fast_quad_rx.value) & ((1 << (4 * num_clocks)) - 1)
+
+        result = 0
+        frame_end = RisingEdge(self._cs)
+        for _ in range(num_clocks):
+            if self._cs.value == 1 or (await First(RisingEdge(self._sclk), frame_end)) == frame_end:
+                raise SpiFrameError("End of frame in the middle of a transaction")
+            result = (result << 4) | (int(self.dut.uio_out.value) >> 4)
+            await FallingEdge(self._sclk)
+        return result
 
-    for item in memory_array:
-        tmp = item
-        bits = [0] * 32
-        index = 0
+    async def _fast_quad_read(self, address, frame_end):
+        # Stream out 4 bytes per wake up until CS goes high
+        self.dut.spi_fast_quad.value = 1
+
+        while True:
+            value = int.from_bytes(self.contents.read(address, 4), 'big')
+            num_clocks, _ = await self._fast_shift(8, value, frame_end, bits_per_clock=4)
+            if num_clocks < 8 or self._cs.value == 1:
+                break
+            address += 4
+
+        self.dut.spi_fast_quad.value = 0
+
+    async def _quad_read(self, address, frame_end):
+        quad_io = self.dut.flash_quad_io
+
+        while True:
+            value = self.contents[address]
+            for nibble in [value >> 4, value & 0xf]:
+                quad_io.value = nibble
+                if self._cs.value == 1 or (await First(RisingEdge(self._sclk), frame_end)) == frame_end:
+                    return
+                await FallingEdge(self._sclk)
+            address += 1
+
+
+class HdlSpiMemory:
+    # Python view of a spi_memory model in tb.v, with the same get_value API
+    # as SpiFlashPeripheral. The contents are only read back on request.
+    def __init__(self, model, load_file_signal, contents, name):
+        self.model = model
+        self.name = name
 
-        while tmp > 0:
-            bits[index] = tmp % 2
-            tmp = tmp >> 1
-            index += 1
+        # Loaded into the model on the next rising edge of hdl_memory_load
+        self.load_file = None
+        contents = PagedMemory.from_contents(contents)
+        if len(contents) > 0:
+            handle, self.load_file = tempfile.mkstemp(suffix='.hex', prefix=name + '_')
+            with os.fdopen(handle, 'w') as output_file:
+                output_file.write('\n'.join('%02x' % value for value in contents[:]))
 
-        bits.reverse()
-        
-        tmp_bytes = []
-        for i in range(0, 4):
-            tmp_bits = bits[i*8:(i+1)*8]
-
-            value = 0
-            for index, val in enumerate(tmp_bits):
-                value = value | (val << (7-index))
-            # print(tmp_bits, value, hex(value))
-            tmp_bytes.append(value)
-        
-        # Convert to little endian
-        tmp_bytes.reverse()
-        bytes_array += tmp_bytes
+        load_file_signal.value = int.from_bytes((self.load_file or '').encode(), 'big')
 
-    # for value in bytes_array:
-    #     print("%02x" % value)
+    def stop(self):
+        pass
 
-    return bytes_array
+    def remove_load_file(self):
+        if self.load_file is not None:
+            os.remove(self.load_file)
+            self.load_file = None
 
-def load_binary(path):
-    tmp_bytes = []
-    output = []
-    with open(path, 'rb') as input_file:
-        tmp_bytes = input_file.read()
-    for b in tmp_bytes:
-        output.append(b)
-    return output
+    def get_value(self, address, num_bytes):
+        # return in little-endian, so earlier mem addresses are the lsb
+        value = 0
+        for i in range(0, num_bytes):
+            value = (int(self.model.memory[address + i].value) << (i*8)) | value
+        return value
 
-async def run_program(dut, raw='', memory=None, wait_cycles=100, extra_func=None, timeout_us = 3000):
+    def dump_memory2(self):
+        for addr in range(0, len(self.model.memory)):
+            value = int(self.model.memory[addr].value)
+            if value != 0xff:
+                print(hex(addr), value)
+
+
+CLOCK_PERIOD_NS = 41.66
+
+async def wait_clocks(dut, num_cycles):
+    # Like ClockCycles, but with one timer instead of a callback per clock.
+    # The timer ends on the falling edge before the last rising edge, so
+    # num_cycles rising edges are waited if it is called on a rising edge.
+    if num_cycles == 0:
+        return
+    if num_cycles > 1:
+        await Timer((num_cycles - 0.5) * CLOCK_PERIOD_NS, 'ns', round_mode='round')
+    await RisingEdge(dut.clk)
+
+def is_hdl_clock():
+    # CLOCK=hdl: the clock in tb.v, CLOCK=cocotb: a cocotb Clock (see the Makefile).
+    # Without CLOCK, the default of the Makefile: hdl with Verilator only.
+    clock = os.environ.get('CLOCK')
+    if not clock:
+        return 'verilator' in cocotb.SIM_NAME.lower()
+    return clock == 'hdl'
+
+_clock_task = None
+_waveform_task = None
+_memory_chips = []
+
+def start_clock(dut):
+    # Both clocks keep running between the programs of a test
+    global _clock_task
+    if is_hdl_clock():
+        dut.clk_en.value = 1
+    elif _clock_task is None or _clock_task.done():
+        _clock_task = cocotb.start_soon(Clock(dut.clk, CLOCK_PERIOD_NS, units='ns').start())
+
+async def run_program(dut, raw='', memory=None, wait_cycles=100, extra_func=None, timeout_us = 3000, fast_spi=True,
+                      hdl_memory=False, lockstep=False, quad_spi=False, trace=None, profile=False,
+                      spi_analyzer=None):
     # dut._log.info("Run program")
 
     if raw != '':
-        memory = []
-        lines = raw.splitlines()
-        lines = [line.strip() for line in lines]
-        for line in lines:
-            if line != '' and not line.endswith(':') and not line.startswith('-') and line != 'Data Dump':
-                if '|' in line:
-                    line = line.split('|')[1].strip()[2:]
-                memory.append(int(line, 16))
-
-        bytes_array = prepare_bytes(memory)
+        bytes_array = load_listing(raw)
     elif memory is not None:
         bytes_array = memory
 
-    ram_bytes = {}
+    ram_bytes = PagedMemory()
 
-    # Flash memory
-    flash_chip = SpiFlashPeripheral(SpiBus.from_entity(dut,
-                                                 cs_name='cs1'), bytes_array, 
-                                                 dut, name='flash')  
-    
-    # PSRAM
-    ram_chip = SpiFlashPeripheral(SpiBus.from_entity(dut, 
-                                                 cs_name='cs2'), ram_bytes, 
-                                                 dut, name='ram')
+    # Models of an earlier run in the same test would still drive MISO
+    global _memory_chips
+    for chip in _memory_chips:
+        chip.stop()
+
+    # If hdl_memory, the flash and PSRAM models in tb.v are used, so fetches
+    # never leave the simulator. Otherwise the Python models are used.
+    dut.hdl_memory_en.value = 1 if hdl_memory else 0
+    dut.hdl_memory_load.value = 0
+
+    if hdl_memory:
+        flash_chip = HdlSpiMemory(dut.flash_memory, dut.flash_load_file, 
+                                  bytes_array, name='flash')
+        ram_chip = HdlSpiMemory(dut.ram_memory, dut.ram_load_file, 
+                                ram_bytes, name='ram')
+    else:
+        # Flash memory, with quad_spi it also supports the quad read
+        flash_class = QuadSpiFlashPeripheral if quad_spi else SpiFlashPeripheral
+        flash_chip = flash_class(SpiBus.from_entity(dut,
+                                                     cs_name='cs1'), bytes_array, 
+                                                     dut, name='flash', fast=fast_spi)
+        
+        # PSRAM
+        ram_chip = SpiFlashPeripheral(SpiBus.from_entity(dut, 
+                                                     cs_name='cs2'), ram_bytes, 
+                                                     dut, name='ram', fast=fast_spi)
     
-    clock = Clock(dut.clk, 41.66, units="ns") # 24MHz
-    cocotb.start_soon(clock.start())
+    _memory_chips = [flash_chip, ram_chip]
+
+    start_clock(dut)
 
-    # Timeout to ensure test does not run too long and generate a very large vcd
+    # Timeout to ensure test does not run too long
     timeout = Timer(timeout_us, 'us')
     halted_signal = RisingEdge(get_halt_signal(dut))
 
@@ -218,51 +471,213 @@ async def run_program(dut, raw='', memory=None, wait_cycles=100, extra_func=None
     dut.ena.value = 1
     dut.rst_n.value = 0
 
-    await ClockCycles(dut.clk, 20)
+    if hdl_memory:
+        # Load the memory models while in reset
+        await ClockCycles(dut.clk, 1)
+        dut.hdl_memory_load.value = 1
+        await ClockCycles(dut.clk, 1)
+        flash_chip.remove_load_file()
+        ram_chip.remove_load_file()
+        await wait_clocks(dut, 18)
+    else:
+        await wait_clocks(dut, 20)
+
+    # If lockstep, every retired instruction is checked against the ISS (RTL only)
+    lockstep_task = None
+    if lockstep:
+        checker = LockstepChecker(dut, PagedMemory.from_contents(bytes_array))
+        lockstep_task = cocotb.start_soon(checker.run())
+
+    # Trace of the retired instructions, written to the trace path when the
+    # program is done, or has timed out (RTL only, see commit_trace.py)
+    if trace is None:
+        trace = trace_path_from_env()
+
+    trace_monitor = None
+    if trace is not None and not is_gate_level_tests():
+        trace_monitor = TraceMonitor(dut)
+        trace_monitor.start()
+
+    # Cycle counters of the CPI profile, they are cleared by the reset (RTL only)
+    profile = profile or is_profile_enabled()
+    if not is_gate_level_tests():
+        dut.profile_en.value = 1 if profile else 0
+
+    # Transactions on the SPI bus, from the reset until the program is done
+    # (see spi_analyzer.py). With SPI_STATS the summary is logged.
+    stats_from_env = spi_analyzer is None and spi_stats_format() != 'off'
+    if stats_from_env:
+        spi_analyzer = SpiAnalyzer(dut)
+    if spi_analyzer is not None:
+        spi_analyzer.start()
+
     dut.rst_n.value = 1
 
-    if extra_func:
-        await extra_func()
+    # Waveform of this program, if enabled with WAVEFORM (see waveform.py)
+    global _waveform_task
+    if _waveform_task is not None and not _waveform_task.done():
+        _waveform_task.kill()
+    waveform = Waveform(dut, CLOCK_PERIOD_NS)
+    _waveform_task = cocotb.start_soon(waveform.run_from_env())
 
-    # check for stop signal if not halted already
-    if get_halt_signal(dut).value == 0:
-        stop_signal = await First(halted_signal, timeout)
+    try:
+        if extra_func:
+            await extra_func()
 
-        # If stop signal was not halted signal, then the test timed out!
-        assert stop_signal == halted_signal
+        # check for stop signal if not halted already
+        if get_halt_signal(dut).value == 0:
+            stop_signal = await First(halted_signal, timeout)
 
-    await ClockCycles(dut.clk, wait_cycles)
+            # If stop signal was not halted signal, then the test timed out!
+            assert stop_signal == halted_signal, \
+                'not halted after %d us (%d cycles), WAVEFORM=vcd WAVEFORM_START=end:<n> dumps the last n cycles' \
+                % (timeout_us, timeout_us * 1000 / CLOCK_PERIOD_NS)
 
-    return ram_chip, flash_chip
+        if lockstep_task is not None:
+            await lockstep_task
 
-def get_register(dut, index):
-    gate_level_tests = is_gate_level_tests()
+        await wait_clocks(dut, wait_cycles)
 
-    main_cpu = dut.cpu1
+        if is_profile_enabled() and not is_gate_level_tests():
+            CpuProfile.read(dut).log(dut)
+    finally:
+        waveform.record_end()
 
-    if gate_level_tests:
-        # gate level tests
-        value = 0
-        for i in range(0, 32):
-            bit = main_cpu._id('\\reg1.registers[%d][%d]' % (index, i), extended = False)
-            value = (int(bit) << i) | value
-        return ValueWrapper(value)
-    else:
-        if False:
-            return main_cpu.reg1._id('r%d' % index, extended=False)
+        if trace_monitor is not None:
+            trace_monitor.stop()
+            trace_monitor.trace.write(trace)
+            dut._log.info('Trace of %d instructions written to %s', len(trace_monitor.trace), trace)
+
+        if spi_analyzer is not None:
+            spi_analyzer.stop()
+            if stats_from_env:
+                write_spi_stats_from_env(spi_analyzer)
+
+    return ram_chip, flash_chip
+
+def addi_word(rd, immediate):
+    # Machine word of addi rd, x0, immediate, for a 0x%08X word in a listing
+    return ((immediate & 0xfff) << 20) | (rd << 7) | 0x13
+
+async def run_program_cycles(dut, raw='', mem_control=None, extra_func=None, wait_cycles=0, **kwargs):
+    # Runs a program like run_program, and returns the cycles from the
+    # release of the reset until the CPU halts. With mem_control, the
+    # 0x%08X word of the listing is addi x2, x0, mem_control, for the
+    # program to write to the memory control register.
+    if mem_control is not None:
+        raw = raw % addi_word(2, mem_control)
+
+    times = {}
+
+    async def wait_halted():
+        await RisingEdge(get_halt_signal(dut))
+        times['end'] = get_sim_time('ns')
+
+    async def measure():
+        times['start'] = get_sim_time('ns')
+        tasks.append(cocotb.start_soon(wait_halted()))
+        if extra_func:
+            await extra_func()
+
+    tasks = []
+    try:
+        await run_program(dut, raw, extra_func=measure, wait_cycles=wait_cycles, **kwargs)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.kill()
+
+    return round((times['end'] - times['start']) / CLOCK_PERIOD_NS)
+
+class RegisterFile:
+    # Handles of the register file, program counter and state of cpu1. They
+    # are resolved once per simulation, in the gate level netlist each
+    # register is 32 separate flip flops.
+    def __init__(self, dut):
+        main_cpu = dut.cpu1
+        self.gate_level = is_gate_level_tests()
+
+        if self.gate_level:
+            # x0 is never written, so synthesis removes its flip flops and
+            # it reads as 0 like any register without flip flops
+            self.registers = [
+                self._gl_bits(main_cpu, 'reg1.registers[%d]' % index, 32) or []
+                for index in range(0, 16)
+            ]
+            self.prog_counter = self._gl_bits(main_cpu, 'prog_counter', 18)
+            self.state = self._gl_bits(main_cpu, 'state', 5)
         else:
-            return main_cpu.reg1._id('registers[%d]' % index, extended=False)
+            self.registers = [main_cpu.reg1._id('registers[%d]' % index, extended=False) for index in range(0, 16)]
+            self.prog_counter = main_cpu.prog_counter
+            self.state = main_cpu.state
+
+    @staticmethod
+    def _gl_bits(main_cpu, name, num_bits):
+        # Not every flip flop keeps its name after synthesis. Verilator keeps
+        # the space that ends the escaped name, Icarus does not.
+        for end in ('', ' '):
+            try:
+                return [main_cpu._id('\\%s[%d]%s' % (name, i, end), extended = False) for i in range(0, num_bits)]
+            except AttributeError:
+                pass
+        return None
+
+    @staticmethod
+    def _bits_value(bits):
+        value = 0
+        for i, bit in enumerate(bits):
+            value |= int(bit.value) << i
+        return value
+
+    def read(self, handle):
+        if handle is None:
+            return None
+        if self.gate_level:
+            return self._bits_value(handle)
+        return handle.value.integer
+
+    def get(self, index):
+        if self.gate_level:
+            return ValueWrapper(self._bits_value(self.registers[index]))
+        return self.registers[index]
+
+    def snapshot(self):
+        return tuple(self.read(handle) for handle in self.registers) \
+            + (self.read(self.prog_counter), self.read(self.state))
+
+_register_files = {}
+
+def get_register_file(dut):
+    register_file = _register_files.get(id(dut))
+    if register_file is None:
+        register_file = RegisterFile(dut)
+        _register_files[id(dut)] = register_file
+    return register_file
+
+# Positions of the program counter and state in snapshot_registers
+SNAPSHOT_PC = 16
+SNAPSHOT_STATE = 17
+
+def snapshot_registers(dut):
+    # x0 - x15, program counter and state as one tuple of ints. The program
+    # counter and state are None in gate level tests if they can not be found.
+    return get_register_file(dut).snapshot()
+
+def get_register(dut, index):
+    return get_register_file(dut).get(index)
     
 def assert_registers_zero(dut, start_from, until=15):
+    values = snapshot_registers(dut)
     for i in range(start_from, until+1):
-        assert get_register(dut, i).value == 0
+        assert values[i] == 0, 'x%d is 0x%x' % (i, values[i])
 
     return True
 
 class ValueWrapper:
+    # 32 bits like the register handles, so that the values compare equal
     def __init__(self, value) -> None:
         self.raw_value = value
-        self.value = BinaryValue(value)
+        self.value = BinaryValue(format(value, '032b'), n_bits=32)
 
 def get_output_pin(dut, index):
     # output only pins
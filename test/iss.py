@@ -0,0 +1,596 @@
+import sys
+
+from cocotb.binary import BinaryValue
+
+from paged_memory import PAGE_BITS, PagedMemory
+from program_image import load_image, load_listing
+
+# Instruction set simulator of the MCU, used as a fast reference model of
+# project.sv. It follows what the HDL does rather than the RISC-V spec where
+# the two differ:
+# - the program counter and load/store addresses are address_size (18) bits
+# - shift immediates only use 4 bits (instr_rs2)
+# - JALR does not clear the lsb of the target
+# - a JAL with zero in bits 31:20 (e.g. jal x0, 0) halts the CPU
+# - unknown opcodes write rs1 + rs2 to rd
+# - loads from peripheral registers go through the same byte swap as memory
+#
+# Basic blocks are decoded once into lists of closures and cached by PC.
+
+I_TYPE_LOAD_INSTR =  0x03
+I_TYPE_INSTR =       0x13
+U_TYPE_AUIPC_INSTR = 0x17
+S_TYPE_INSTR =       0x23
+R_TYPE_INSTR =       0x33
+U_TYPE_LUI_INSTR =   0x37
+B_TYPE_INSTR =       0x63
+I_TYPE_JUMP_INSTR =  0x67  # JALR
+J_TYPE_INSTR =       0x6F  # JAL
+
+ADDRESS_SIZE = 16 + 2
+ADDRESS_MASK = (1 << ADDRESS_SIZE) - 1
+PERIPHERAL_BIT = 1 << (ADDRESS_SIZE - 1)
+RAM_BIT = 1 << (ADDRESS_SIZE - 2)
+CHIP_ADDRESS_MASK = RAM_BIT - 1
+
+MASK32 = 0xffffffff
+
+# Number of bytes that the mem bus fetches for each load func3 (mem_num_bytes)
+LOAD_NUM_BYTES = {0: 1, 1: 2, 2: 4, 4: 1, 5: 2}
+
+MAX_BLOCK_SIZE = 64
+
+def sign_extend(value, bits):
+    sign = 1 << (bits - 1)
+    return ((value & (sign - 1)) - (value & sign)) & MASK32
+
+def to_signed(value):
+    return value - (1 << 32) if value & 0x80000000 else value
+
+def alu(func3, f7_bit, value1, value2):
+    # Same as alu.sv, the values are 32-bit unsigned
+    if func3 == 0:
+        return (value1 - value2 if f7_bit else value1 + value2) & MASK32
+    if func3 == 1:
+        return (value1 << (value2 & 0x1f)) & MASK32
+    if func3 == 2:
+        return 1 if to_signed(value1) < to_signed(value2) else 0
+    if func3 == 3:
+        return 1 if value1 < value2 else 0
+    if func3 == 4:
+        return value1 ^ value2
+    if func3 == 5:
+        if f7_bit:
+            return (to_signed(value1) >> (value2 & 0x1f)) & MASK32
+        return value1 >> (value2 & 0x1f)
+    if func3 == 6:
+        return value1 | value2
+    return value1 & value2
+
+def load_value(func3, fetched):
+    # Same as mem_fetch_value2 in project.sv, fetched has the first byte in
+    # the most significant position of the fetched bytes
+    if func3 == 0:
+        return sign_extend(fetched & 0xff, 8)
+    if func3 == 1:
+        return sign_extend(((fetched & 0xff) << 8) | ((fetched >> 8) & 0xff), 16)
+    if func3 == 2:
+        return int.from_bytes((fetched & MASK32).to_bytes(4, 'big'), 'little')
+    if func3 == 4:
+        return fetched & 0xff
+    return ((fetched & 0xff) << 8) | ((fetched >> 8) & 0xff)
+
+class IssMemoryChip:
+    # Same shape as the SpiFlashPeripheral returned by run_program
+    def __init__(self, contents, name):
+        self.contents = PagedMemory.from_contents(contents)
+        self.name = name
+
+    def get_value(self, address, num_bytes):
+        # return in little-endian, so earlier mem addresses are the lsb
+        return self.contents.read_word(address, num_bytes)
+
+    def dump_memory2(self):
+        for addr, value in self.contents.items():
+            print(hex(addr), value)
+
+class IssPeripherals:
+    # Peripheral registers of mem_bus.sv. The UART completes transfers
+    # immediately, so the TX FIFO is always empty and uart_rx is the RX
+    # FIFO. SPI peripheral transfers are passed to spi_func and DMA
+    # transfers to dma_func, which moves the bytes right away.
+    def __init__(self):
+        self.outputs_bits = 0
+        self.input_bits = 0
+        self.io_direction_bits = 0
+        self.io_inputs = 0
+        self.io_outputs_bits = 0
+
+        self.spi_cs_bits = 0
+        self.spi_op_done = 0
+        self.spi_tx_len = 1
+        self.spi_rx_len = 1
+        self.spi_tx_bytes = bytearray(4)
+        self.spi_rx_bytes = bytearray(4)
+        self.spi_func = None    # spi_func(cs_bits, tx_bytes, rx_len) -> rx_bytes
+
+        self.uart_tx_byte = 0
+        self.uart_status_bits_hold = 0
+        self.uart_flow_control_en = 0
+        self.uart_rx_clear = 0
+        self.uart_fifo_en = 0
+        self.uart_rx_watermark = 1
+        self.uart_tx_watermark = 0
+        self.uart_baud_counter = 1249
+        self.uart_rx = []       # bytes waiting to be received
+        self.uart_tx = []       # bytes that were sent
+
+        self.mem_control_bits = 0  # only changes the timing in the HDL
+
+        self.dma_source = 0
+        self.dma_destination = 0
+        self.dma_length = 0
+        self.dma_busy = 0
+        self.dma_done = 0
+        self.dma_func = None    # dma_func(), moves the bytes of the dma registers
+
+        # Instructions retired before the load that reads the counters. There
+        # is no timing, the cycle counter reads the same value.
+        self.instret = 0
+
+        self.io_value = 0
+
+    def read(self, address, num_bytes=1):
+        # Only the SPI buffers can be read as words, in the order of the
+        # bytes on the bus
+        address &= 0xff
+        self.io_value &= 0xff
+        if address == 0x0:
+            self.io_value = self.outputs_bits
+        elif address == 0x1:
+            self.io_value = self.input_bits
+        elif address == 0x2:
+            self.io_value = self.io_direction_bits
+        elif address == 0x3:
+            self.io_value = ~self.io_direction_bits & self.io_inputs & 0x7f
+        elif address == 0x4:
+            self.io_value = self.io_outputs_bits
+        elif address == 0x6:
+            self.io_value = self.spi_op_done
+        elif address == 0x7:
+            self.io_value = (self.spi_rx_len << 4) | self.spi_tx_len
+        elif address in (0x8, 0xc) and num_bytes == 4:
+            buffer = self.spi_tx_bytes if address == 0x8 else self.spi_rx_bytes
+            self.io_value = int.from_bytes(buffer, 'big')
+        elif 0x8 <= address <= 0xb:
+            self.io_value = self.spi_tx_bytes[address - 0x8]
+        elif 0xc <= address <= 0xf:
+            self.io_value = self.spi_rx_bytes[address - 0xc]
+        elif address == 0x10:
+            # The TX FIFO is always empty, bit 0 is 0
+            self.io_value = (self.uart_fifo_en << 4) | (self.uart_flow_control_en << 2) | (self.uart_rx_clear << 1)
+        elif address == 0x11:
+            self.io_value = (int(len(self.uart_rx) > 0) << 1) | self.uart_status_bits_hold
+        elif address == 0x12:
+            self.io_value = len(self.uart_rx)
+        elif address == 0x13:
+            self.io_value = 0
+        elif address == 0x14:
+            self.io_value = self.uart_tx_byte
+        elif address == 0x15:
+            self.io_value = self.uart_rx[0] if len(self.uart_rx) > 0 else 0
+        elif address == 0x16:
+            self.io_value = self.uart_baud_counter & 0xff
+        elif address == 0x17:
+            self.io_value = self.uart_baud_counter >> 8
+        elif address == 0x18:
+            self.io_value = self.mem_control_bits
+        elif address == 0x19:
+            self.io_value = (self.uart_tx_watermark << 4) | self.uart_rx_watermark
+        elif address == 0x1a:
+            self.io_value = self.uart_rx.pop(0) if len(self.uart_rx) > 0 else 0
+        elif address == 0x1b:
+            # The TX FIFO is always empty, it is at or below the watermark
+            self.io_value = 0b10 | int(len(self.uart_rx) >= self.uart_rx_watermark)
+        elif address == 0x28:
+            self.io_value = self.dma_length & 0xff
+        elif address == 0x29:
+            self.io_value = self.dma_length >> 8
+        elif address == 0x2c:
+            self.io_value = (self.dma_done << 1) | self.dma_busy
+        elif 0x30 <= address <= 0x37:
+            # Word reads are in the order of the bytes on the bus
+            index = address & 0x3
+            if num_bytes == 4 and index == 0:
+                self.io_value = int.from_bytes((self.instret & MASK32).to_bytes(4, 'little'), 'big')
+            else:
+                self.io_value = (self.instret >> (8 * index)) & 0xff
+        # Other addresses keep the previous value, like io_value in mem_bus
+
+        return self.io_value
+
+    def write(self, address, value, num_bytes=1):
+        address &= 0xff
+        if address == 0x0:
+            self.outputs_bits = value & 0xf
+        elif address == 0x2:
+            self.io_direction_bits = value & 0x7f
+        elif address == 0x4:
+            self.io_outputs_bits = self.io_direction_bits & value & 0x7f
+        elif address == 0x5:
+            self.spi_cs_bits = (value >> 1) & 0xf
+            self.spi_op_done = value & 1
+            if value & 1 and self.spi_func is not None and self.spi_tx_len + self.spi_rx_len > 0:
+                rx_bytes = bytes(self.spi_func(self.spi_cs_bits, bytes(self.spi_tx_bytes[:self.spi_tx_len]),
+                                               self.spi_rx_len))[:self.spi_rx_len]
+                # The first received byte is at 0x2000C, the rest are 0
+                self.spi_rx_bytes[:] = rx_bytes + bytes(4 - len(rx_bytes))
+        elif address == 0x7:
+            # The buffers are 4 bytes, 5-7 are 4
+            self.spi_tx_len = min(value & 0x7, 4)
+            self.spi_rx_len = min((value >> 4) & 0x7, 4)
+        elif address == 0x8 and num_bytes == 4:
+            self.spi_tx_bytes[:] = (value & 0xffffffff).to_bytes(4, 'little')
+        elif 0x8 <= address <= 0xb:
+            self.spi_tx_bytes[address - 0x8] = value & 0xff
+        elif address == 0x10:
+            # Without the FIFO mode, bit 0 sends the byte of 0x20014
+            if value & 1 and not value & 0x10:
+                self.uart_tx.append(self.uart_tx_byte)
+                self.uart_status_bits_hold = 1
+            if value & 2 and len(self.uart_rx) > 0:
+                self.uart_rx.pop(0)
+            self.uart_rx_clear = (value >> 1) & 1
+            self.uart_flow_control_en = (value >> 2) & 1
+            self.uart_fifo_en = (value >> 4) & 1
+        elif address == 0x14:
+            self.uart_tx_byte = value & 0xff
+            if self.uart_fifo_en:
+                self.uart_tx.append(self.uart_tx_byte)
+                self.uart_status_bits_hold = 1
+        elif address == 0x16:
+            self.uart_baud_counter = value & 0xfff
+        elif address == 0x18:
+            self.mem_control_bits = value & 0x1f
+        elif address == 0x19:
+            self.uart_rx_watermark = value & 0x7
+            self.uart_tx_watermark = (value >> 4) & 0x7
+        # Writes to the DMA registers wait until a transfer is done in the
+        # HDL, here the bytes are already moved
+        elif address == 0x20:
+            self.dma_source = value & ADDRESS_MASK
+        elif address == 0x24:
+            self.dma_destination = value & ADDRESS_MASK
+        elif address == 0x28:
+            self.dma_length = value & 0xffff
+        elif address == 0x2c and value & 1 and not self.dma_busy:
+            self.dma_busy = int(self.dma_length > 0)
+            self.dma_done = 0
+            if self.dma_func is not None:
+                self.dma_func()
+            if self.dma_length == 0:
+                self.dma_busy = 0
+                self.dma_done = 1
+
+class Iss:
+    def __init__(self, flash=None, ram=None):
+        self.flash_chip = IssMemoryChip(flash if flash is not None else PagedMemory(), 'flash')
+        self.ram_chip = IssMemoryChip(ram if ram is not None else PagedMemory(), 'ram')
+        self.peripherals = IssPeripherals()
+        self.peripherals.dma_func = self.dma
+
+        self.registers = [0] * 16
+        self.prog_counter = 0
+        self.halted = False
+        self.instret = 0
+
+        # Called as store_hook(address, num_bytes, value) for every store
+        self.store_hook = None
+
+        self._blocks = {}
+        self._code_pages = set()    # (is_ram, page) of the cached blocks
+
+    def get_register(self, index):
+        return IssValue(self.registers[index])
+
+    def reset(self):
+        # In place, the decoded blocks hold on to the registers list
+        self.registers[:] = [0] * 16
+        self.prog_counter = 0
+        self.halted = False
+        self.instret = 0
+
+    # Memory accesses, same address decoding as mem_bus.sv and project.sv
+
+    def _chip(self, address):
+        return self.ram_chip.contents if address & RAM_BIT else self.flash_chip.contents
+
+    def fetch(self, address):
+        address &= ADDRESS_MASK
+        return self._chip(address).read_word(address & CHIP_ADDRESS_MASK)
+
+    def load(self, address, func3, pc=None):
+        address &= ADDRESS_MASK
+        if address & PERIPHERAL_BIT:
+            # prog_counter is the start of the running block, the
+            # instructions before pc in the block are retired too
+            offset = 0 if pc is None else ((pc - self.prog_counter) & ADDRESS_MASK) >> 2
+            self.peripherals.instret = self.instret + offset
+            fetched = self.peripherals.read(address, LOAD_NUM_BYTES.get(func3, 4))
+        else:
+            num_bytes = LOAD_NUM_BYTES.get(func3, 4)
+            data = self._chip(address).read(address & CHIP_ADDRESS_MASK, num_bytes)
+            fetched = int.from_bytes(data, 'big')
+        return load_value(func3, fetched)
+
+    def store(self, address, func3, value):
+        address &= ADDRESS_MASK
+        num_bytes = LOAD_NUM_BYTES.get(func3, 4) if func3 <= 2 else 4
+
+        if self.store_hook is not None:
+            self.store_hook(address, num_bytes, value)
+
+        if address & PERIPHERAL_BIT:
+            self.peripherals.write(address, value, num_bytes)
+            return
+
+        self.write_memory(address, (value & ((1 << (8 * num_bytes)) - 1)).to_bytes(num_bytes, 'little'))
+
+    def write_memory(self, address, data):
+        chip_address = address & CHIP_ADDRESS_MASK
+        self._chip(address).write(chip_address, data)
+
+        # Self modifying code, drop the decoded blocks
+        is_ram = bool(address & RAM_BIT)
+        if ((is_ram, chip_address >> PAGE_BITS) in self._code_pages
+                or (is_ram, (chip_address + len(data) - 1) >> PAGE_BITS) in self._code_pages):
+            self.flush_blocks()
+
+    def dma(self):
+        # Same as the DMA of mem_bus.sv, a peripheral address is the UART.
+        # If the RX FIFO runs out of bytes, the transfer stays busy as the
+        # HDL waits for the next byte.
+        p = self.peripherals
+        while p.dma_length > 0:
+            if p.dma_source & PERIPHERAL_BIT:
+                if len(p.uart_rx) == 0:
+                    return
+                value = p.uart_rx.pop(0)
+            else:
+                value = self._chip(p.dma_source).read(p.dma_source & CHIP_ADDRESS_MASK, 1)[0]
+                p.dma_source = (p.dma_source + 1) & ADDRESS_MASK
+
+            if p.dma_destination & PERIPHERAL_BIT:
+                p.uart_tx_byte = value
+                p.uart_tx.append(value)
+                p.uart_status_bits_hold = 1
+            else:
+                self.write_memory(p.dma_destination, bytes([value]))
+                p.dma_destination = (p.dma_destination + 1) & ADDRESS_MASK
+
+            p.dma_length -= 1
+
+    def flush_blocks(self):
+        self._blocks = {}
+        self._code_pages = set()
+
+    # Decoding
+
+    def _decode(self, pc, instr):
+        # Returns (closure, is_end_of_block). Closures that end a block return
+        # the next PC, all others return None and fall through to pc + 4.
+        regs = self.registers
+        opcode = instr & 0x7f
+        rd = (instr >> 7) & 0xf
+        func3 = (instr >> 12) & 0x7
+        rs1 = (instr >> 15) & 0xf
+        rs2 = (instr >> 20) & 0xf
+        f7_bit = (instr >> 30) & 1
+        i_imm = sign_extend(instr >> 20, 12)
+        next_pc = (pc + 4) & ADDRESS_MASK
+
+        def write(value):
+            # Writes to x0 are dropped by the register file
+            if rd == 0:
+                return lambda: None
+            return value
+
+        if opcode == I_TYPE_LOAD_INSTR:
+            load = self.load
+            if rd == 0:
+                def op():
+                    load(regs[rs1] + i_imm, func3, pc)
+            else:
+                def op():
+                    regs[rd] = load(regs[rs1] + i_imm, func3, pc)
+            return op, False
+
+        if opcode == S_TYPE_INSTR:
+            store = self.store
+            s_imm = sign_extend(((instr >> 25) << 5) | ((instr >> 7) & 0x1f), 12)
+
+            def op():
+                store(regs[rs1] + s_imm, func3, regs[rs2])
+                # The block cache can be flushed by the store, so end here
+                return next_pc
+            return op, True
+
+        if opcode == I_TYPE_INSTR:
+            if func3 == 1 or func3 == 5:
+                # Shift amount is instr_rs2, so only 4 bits
+                value2, f7 = rs2, f7_bit
+            else:
+                value2, f7 = i_imm, 0
+
+            if func3 == 0:
+                def op():
+                    regs[rd] = (regs[rs1] + value2) & MASK32
+            else:
+                def op():
+                    regs[rd] = alu(func3, f7, regs[rs1], value2)
+            return write(op), False
+
+        if opcode == R_TYPE_INSTR:
+            def op():
+                regs[rd] = alu(func3, f7_bit, regs[rs1], regs[rs2])
+            return write(op), False
+
+        if opcode == U_TYPE_LUI_INSTR:
+            u_imm = instr & 0xfffff000
+            def op():
+                regs[rd] = u_imm
+            return write(op), False
+
+        if opcode == U_TYPE_AUIPC_INSTR:
+            value = (pc + (instr & 0xfffff000)) & MASK32
+            def op():
+                regs[rd] = value
+            return write(op), False
+
+        if opcode == J_TYPE_INSTR:
+            j_imm = sign_extend((((instr >> 31) & 1) << 20) | (((instr >> 12) & 0xff) << 12)
+                                | (((instr >> 20) & 1) << 11) | (((instr >> 21) & 0x3ff) << 1), 21)
+            target = (pc + j_imm) & ADDRESS_MASK
+            halts = (instr >> 20) == 0
+
+            def op():
+                if rd != 0:
+                    regs[rd] = next_pc
+                if halts:
+                    self.halted = True
+                return target
+            return op, True
+
+        if opcode == I_TYPE_JUMP_INSTR:
+            def op():
+                target = (regs[rs1] + i_imm) & ADDRESS_MASK
+                if rd != 0:
+                    regs[rd] = next_pc
+                return target
+            return op, True
+
+        if opcode == B_TYPE_INSTR:
+            b_imm = sign_extend((((instr >> 31) & 1) << 12) | (((instr >> 7) & 1) << 11)
+                                | (((instr >> 25) & 0x3f) << 5) | (((instr >> 8) & 0xf) << 1), 13)
+            target = (pc + b_imm) & ADDRESS_MASK
+
+            if func3 == 0:
+                condition = lambda: regs[rs1] == regs[rs2]
+            elif func3 == 1:
+                condition = lambda: regs[rs1] != regs[rs2]
+            elif func3 == 4:
+                condition = lambda: to_signed(regs[rs1]) < to_signed(regs[rs2])
+            elif func3 == 5:
+                condition = lambda: to_signed(regs[rs1]) >= to_signed(regs[rs2])
+            elif func3 == 6:
+                condition = lambda: regs[rs1] < regs[rs2]
+            elif func3 == 7:
+                condition = lambda: regs[rs1] >= regs[rs2]
+            else:
+                condition = lambda: False
+
+            def op():
+                return target if condition() else next_pc
+            return op, True
+
+        # Unknown opcodes go through the ALU with rs1 + rs2 and are written back
+        def op():
+            regs[rd] = (regs[rs1] + regs[rs2]) & MASK32
+        return write(op), False
+
+    def _decode_block(self, pc):
+        ops = []
+        address = pc
+        while True:
+            op, is_end = self._decode(address, self.fetch(address))
+            address = (address + 4) & ADDRESS_MASK
+
+            if is_end:
+                end = op
+                break
+
+            ops.append(op)
+            if len(ops) == MAX_BLOCK_SIZE:
+                end = lambda next_pc=address: next_pc
+                break
+
+        is_ram = bool(pc & RAM_BIT)
+        first_page = (pc & CHIP_ADDRESS_MASK) >> PAGE_BITS
+        last_page = ((address - 1) & CHIP_ADDRESS_MASK) >> PAGE_BITS
+        for page in range(first_page, last_page + 1):
+            self._code_pages.add((is_ram, page))
+
+        # +1 for the instruction that ends the block
+        block = (tuple(ops), end, len(ops) + 1)
+        self._blocks[pc] = block
+        return block
+
+    # Execution
+
+    def step(self):
+        # Runs a single instruction, without the block cache
+        if self.halted:
+            return
+        pc = self.prog_counter
+        op, is_end = self._decode(pc, self.fetch(pc))
+        next_pc = op()
+        self.prog_counter = next_pc if is_end else (pc + 4) & ADDRESS_MASK
+        self.instret += 1
+
+    def run(self, max_instructions=10_000_000):
+        # Runs until halted or until about max_instructions were retired, the
+        # last block is always completed. Returns the number of instructions.
+        blocks = self._blocks
+        pc = self.prog_counter
+        start = self.instret
+        limit = start + max_instructions
+        instret = start
+
+        while not self.halted and instret < limit:
+            block = blocks.get(pc)
+            if block is None:
+                block = self._decode_block(pc)
+                blocks = self._blocks
+
+            ops, end, count = block
+            self.prog_counter = pc
+            self.instret = instret
+            for op in ops:
+                op()
+            pc = end()
+            instret += count
+
+            # A store can flush the cache, which replaces the dict
+            blocks = self._blocks
+
+        self.prog_counter = pc
+        self.instret = instret
+        return instret - start
+
+class IssValue:
+    # Same shape as the handles returned by get_register
+    def __init__(self, value):
+        self.value = BinaryValue(format(value, '032b'), n_bits=32)
+
+def run_iss(raw='', memory=None, max_instructions=10_000_000, setup_func=None):
+    # Same arguments as run_program, returns the Iss after it halted
+    if raw != '':
+        memory = load_listing(raw)
+
+    iss = Iss(memory)
+
+    if setup_func:
+        setup_func(iss)
+
+    iss.run(max_instructions)
+    assert iss.halted, 'program did not halt after %d instructions' % iss.instret
+    return iss
+
+if __name__ == '__main__':
+    # python iss.py binaries/test_program.bin
+    iss = Iss(load_image(sys.argv[1]))
+    iss.run()
+
+    print('halted' if iss.halted else 'not halted', 'after %d instructions, pc 0x%05x' % (iss.instret, iss.prog_counter))
+    for i in range(16):
+        print('x%-2d 0x%08x' % (i, iss.registers[i]))
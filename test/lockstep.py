@@ -0,0 +1,105 @@
+from cocotb.triggers import Edge, First, RisingEdge
+
+from iss import ADDRESS_MASK, I_TYPE_LOAD_INSTR, PERIPHERAL_BIT, S_TYPE_INSTR, Iss, sign_extend
+
+# Checks every instruction retired by the RTL against the ISS, using the
+# commit log in tb.v. Loads from the peripheral registers take the value
+# from the RTL, as the ISS does not see the pins.
+
+COMMIT_LOG_SIZE = 64
+
+class CommitEntry:
+    def __init__(self, value):
+        self.instruction = value & 0xffffffff
+        self.pc = (value >> 32) & 0x3ffff
+        self.rd = (value >> 50) & 0xf
+        self.rd_value = (value >> 54) & 0xffffffff
+        self.mem_address = (value >> 86) & 0x3ffff    # of loads and stores
+        self.store_value = (value >> 104) & 0xffffffff
+        self.cycle = (value >> 136) & 0xffffffff
+
+    def __str__(self):
+        return 'pc 0x%05x instr 0x%08x x%d=0x%08x' % (self.pc, self.instruction, self.rd, self.rd_value)
+
+class LockstepMismatch(AssertionError):
+    pass
+
+class LockstepChecker:
+    def __init__(self, dut, flash, ram=None):
+        # flash and ram are copied, the RTL memory models keep their own
+        self.dut = dut
+        self.iss = Iss(flash.copy(), ram.copy() if ram is not None else None)
+        self.iss.store_hook = self._store_hook
+
+        self.checked = 0    # entries read from the commit log
+        self._store = None
+
+        self._log = [dut.commit_log[i] for i in range(COMMIT_LOG_SIZE)]
+        self._count = dut.commit_count
+
+    def _store_hook(self, address, num_bytes, value):
+        self._store = (address, num_bytes, value)
+
+    def _mismatch(self, entry, field, rtl, iss):
+        raise LockstepMismatch('lockstep mismatch at instruction %d (%s): %s rtl 0x%x iss 0x%x'
+                               % (self.checked, entry, field, rtl, iss))
+
+    def check_entry(self, entry):
+        iss = self.iss
+        regs = iss.registers
+
+        if entry.pc != iss.prog_counter:
+            self._mismatch(entry, 'pc', entry.pc, iss.prog_counter)
+
+        instruction = iss.fetch(iss.prog_counter)
+        if entry.instruction != instruction:
+            self._mismatch(entry, 'instruction', entry.instruction, instruction)
+
+        opcode = instruction & 0x7f
+        is_peripheral_load = False
+        if opcode == I_TYPE_LOAD_INSTR:
+            address = (regs[(instruction >> 15) & 0xf] + sign_extend(instruction >> 20, 12)) & ADDRESS_MASK
+            is_peripheral_load = bool(address & PERIPHERAL_BIT)
+
+        self._store = None
+        iss.step()
+
+        if is_peripheral_load and entry.rd != 0:
+            regs[entry.rd] = entry.rd_value
+
+        if regs[entry.rd] != entry.rd_value:
+            self._mismatch(entry, 'x%d' % entry.rd, entry.rd_value, regs[entry.rd])
+
+        if opcode == S_TYPE_INSTR:
+            address, num_bytes, value = self._store
+            mask = (1 << (8 * num_bytes)) - 1
+
+            if entry.mem_address != address:
+                self._mismatch(entry, 'store address', entry.mem_address, address)
+            if entry.store_value & mask != value & mask:
+                self._mismatch(entry, 'store value', entry.store_value & mask, value & mask)
+
+        self.checked += 1
+
+    def check_batch(self):
+        # Checks all entries that were logged since the last call
+        count = self._count.value.integer
+        if count - self.checked > COMMIT_LOG_SIZE:
+            raise LockstepMismatch('commit log overflow, %d entries behind' % (count - self.checked))
+
+        while self.checked < count:
+            entry = CommitEntry(self._log[self.checked % COMMIT_LOG_SIZE].value.integer)
+            self.check_entry(entry)
+
+    async def run(self):
+        batch = Edge(self.dut.commit_batch)
+        halted = RisingEdge(self.dut.cpu1.halted)
+
+        while True:
+            if (await First(batch, halted)) == halted:
+                break
+            self.check_batch()
+
+        self.check_batch()
+        if not self.iss.halted:
+            raise LockstepMismatch('rtl halted after %d instructions, iss did not' % self.checked)
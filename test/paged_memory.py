@@ -0,0 +1,187 @@
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+PAGE_WRITTEN = (1 << PAGE_SIZE) - 1
+
+class PagedMemory:
+    # Sparse byte addressable memory for the flash and RAM models. Pages are
+    # bytearrays that are only allocated when written, bytes that were never
+    # written read back as fill (0xff, like erased flash). The written bytes
+    # of a page are a bit mask, as written bytes can have the fill value too.
+    def __init__(self, data=b'', base=0, fill=0xff):
+        self.fill = fill
+        self.pages = {}
+        self.written = {}   # Page index -> bit mask of the written bytes
+        self.size = 0       # Highest written address + 1
+        self._fill_page = bytes([fill]) * PAGE_SIZE
+
+        if len(data) > 0:
+            self.write(base, data)
+
+    @classmethod
+    def from_contents(cls, contents):
+        # Accepts the old list (flash) and dict (RAM) contents
+        if isinstance(contents, cls):
+            return contents
+
+        memory = cls()
+        if isinstance(contents, dict):
+            for address, value in contents.items():
+                memory[address] = value
+        else:
+            memory.write(0, bytes(contents))
+        return memory
+
+    def copy(self):
+        memory = PagedMemory(fill=self.fill)
+        memory.pages = {index: bytearray(page) for index, page in self.pages.items()}
+        memory.written = dict(self.written)
+        memory.size = self.size
+        return memory
+
+    def __len__(self):
+        return self.size
+
+    def _page(self, index):
+        page = self.pages.get(index)
+        if page is None:
+            page = bytearray(self._fill_page)
+            self.pages[index] = page
+        return page
+
+    def __getitem__(self, address):
+        if isinstance(address, slice):
+            start, stop, step = address.indices(self.size)
+            data = self.read(start, max(stop - start, 0))
+            return data if step == 1 else data[::step]
+
+        page = self.pages.get(address >> PAGE_BITS)
+        if page is None:
+            return self.fill
+        return page[address & PAGE_MASK]
+
+    def _mark_written(self, index, offset, length):
+        self.written[index] = self.written.get(index, 0) | (((1 << length) - 1) << offset)
+
+    def __setitem__(self, address, value):
+        index = address >> PAGE_BITS
+        offset = address & PAGE_MASK
+        self._page(index)[offset] = value
+        self.written[index] = self.written.get(index, 0) | (1 << offset)
+        if address >= self.size:
+            self.size = address + 1
+
+    def read(self, address, length):
+        offset = address & PAGE_MASK
+
+        # Fast path, the whole read is inside one page
+        if offset + length <= PAGE_SIZE:
+            page = self.pages.get(address >> PAGE_BITS)
+            if page is None:
+                return self._fill_page[:length]
+            return bytes(page[offset:offset + length])
+
+        output = bytearray()
+        while length > 0:
+            chunk = min(length, PAGE_SIZE - (address & PAGE_MASK))
+            output += self.read(address, chunk)
+            address += chunk
+            length -= chunk
+        return bytes(output)
+
+    def write(self, address, data):
+        if isinstance(data, list):
+            data = bytes(data)
+        offset = address & PAGE_MASK
+        end = address + len(data)
+
+        # Fast path, the whole write is inside one page
+        if offset + len(data) <= PAGE_SIZE:
+            index = address >> PAGE_BITS
+            page = self.pages.get(index)
+            if page is None:
+                page = self._page(index)
+            page[offset:offset + len(data)] = data
+            self.written[index] = self.written.get(index, 0) | (((1 << len(data)) - 1) << offset)
+            if end > self.size:
+                self.size = end
+            return
+
+        data = memoryview(data)
+
+        while len(data) > 0:
+            offset = address & PAGE_MASK
+            chunk = min(len(data), PAGE_SIZE - offset)
+            self._page(address >> PAGE_BITS)[offset:offset + chunk] = data[:chunk]
+            self._mark_written(address >> PAGE_BITS, offset, chunk)
+            address += chunk
+            data = data[chunk:]
+
+        if end > self.size:
+            self.size = end
+
+    def read_word(self, address, num_bytes=4):
+        # little-endian, so earlier mem addresses are the lsb
+        return int.from_bytes(self.read(address, num_bytes), 'little')
+
+    def write_word(self, address, value, num_bytes=4):
+        self.write(address, value.to_bytes(num_bytes, 'little'))
+
+    def iter_pages(self):
+        # (base address, memoryview of page) in address order, without copying
+        for index in sorted(self.pages):
+            yield index << PAGE_BITS, memoryview(self.pages[index])
+
+    def items(self):
+        # (address, value) of all written bytes, also the ones that were
+        # written with the fill value
+        for index in sorted(self.written):
+            base = index << PAGE_BITS
+            page = self.pages[index]
+            mask = self.written[index]
+
+            if mask == PAGE_WRITTEN:
+                for offset, value in enumerate(page):
+                    yield base + offset, value
+            else:
+                # Bit string with the bit of offset 0 first
+                bits = format(mask, '0%db' % PAGE_SIZE)[::-1]
+                offset = bits.find('1')
+                while offset >= 0:
+                    yield base + offset, page[offset]
+                    offset = bits.find('1', offset + 1)
+
+    def tofile(self, output_file, start=0, end=None):
+        # Writes the image from start to end (default, highest written address)
+        end = self.size if end is None else end
+        address = start
+        while address < end:
+            chunk = min(end - address, PAGE_SIZE - (address & PAGE_MASK))
+            page = self.pages.get(address >> PAGE_BITS)
+            offset = address & PAGE_MASK
+            if page is None:
+                output_file.write(self._fill_page[:chunk])
+            else:
+                output_file.write(memoryview(page)[offset:offset + chunk])
+            address += chunk
+
+    def to_numpy(self, start=0, length=None):
+        # Zero-copy if the range is inside a single allocated page
+        import numpy as np
+
+        length = self.size - start if length is None else length
+        offset = start & PAGE_MASK
+        page = self.pages.get(start >> PAGE_BITS)
+
+        if page is not None and offset + length <= PAGE_SIZE:
+            return np.frombuffer(page, dtype=np.uint8, count=length, offset=offset)
+        return np.frombuffer(self.read(start, length), dtype=np.uint8)
+
+    def __eq__(self, other):
+        if not isinstance(other, PagedMemory):
+            return NotImplemented
+
+        for index in set(self.pages) | set(other.pages):
+            if self.pages.get(index, self._fill_page) != other.pages.get(index, other._fill_page):
+                return False
+        return True
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import string
+import struct
+
+from paged_memory import PagedMemory
+
+# Builds the flash image for run_program from the different program formats.
+# Everything ends up in a PagedMemory, which the flash models use directly.
+
+ELF_MAGIC = b'\x7fELF'
+PT_LOAD = 1
+
+# sha256 of listing text -> packed words
+_listing_cache = {}
+
+class ListingError(ValueError):
+    pass
+
+def parse_word(text, line_number):
+    if len(text) == 0 or len(text) > 8 or any(c not in string.hexdigits for c in text):
+        raise ListingError("line %d: malformed word '%s'" % (line_number, text))
+    return int(text, 16)
+
+def parse_listing(raw):
+    # Returns the 32-bit words of a pasted listing, e.g. the output of the
+    # assembler with `|` columns, `Data Dump` headers and labels. Raises
+    # ListingError with the line number if a word cannot be parsed.
+    words = []
+    for line_number, line in enumerate(raw.splitlines(), 1):
+        line = line.strip()
+        if line == '' or line.endswith(':') or line.startswith('-') or line == 'Data Dump':
+            continue
+
+        if '|' in line:
+            # address | word | instruction, only the word is used
+            line = line.split('|')[1].strip()
+            if not line.lower().startswith('0x'):
+                raise ListingError("line %d: expected 0x prefix in '%s'" % (line_number, line))
+            line = line[2:]
+
+        words.append(parse_word(line, line_number))
+    return words
+
+def words_to_bytes(words):
+    # Packs the words in little-endian order, so the lsb is at the lowest address
+    return struct.pack('<%dI' % len(words), *words)
+
+def image_from_words(words, base=0):
+    return PagedMemory(words_to_bytes(words), base)
+
+def listing_cache_dir():
+    # With LISTING_CACHE=yes, parsed listings are also kept on disk next to
+    # the rtl/gl builds, so they are shared between runs
+    if 'LISTING_CACHE' in os.environ and os.environ['LISTING_CACHE'] == 'yes':
+        return os.path.join('sim_build', 'listings')
+    return None
+
+def listing_bytes(raw):
+    # The packed words of a listing, cached by the hash of the listing text
+    key = hashlib.sha256(raw.encode()).hexdigest()
+
+    data = _listing_cache.get(key)
+    if data is not None:
+        return data
+
+    cache_dir = listing_cache_dir()
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, key + '.bin')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as input_file:
+                data = input_file.read()
+
+    if data is None:
+        data = words_to_bytes(parse_listing(raw))
+
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write then rename, so parallel runs never read a partial file
+            tmp_path = '%s.%d' % (cache_path, os.getpid())
+            with open(tmp_path, 'wb') as output_file:
+                output_file.write(data)
+            os.replace(tmp_path, cache_path)
+
+    _listing_cache[key] = data
+    return data
+
+def load_listing(raw, base=0):
+    # A new PagedMemory every time, as the flash contents can be written
+    return PagedMemory(listing_bytes(raw), base)
+
+def load_binary(path, base=0):
+    with open(path, 'rb') as input_file:
+        return PagedMemory(input_file.read(), base)
+
+def load_intel_hex(path):
+    memory = PagedMemory()
+    upper_address = 0
+
+    with open(path, 'r') as input_file:
+        for line_number, line in enumerate(input_file, 1):
+            line = line.strip()
+            if line == '':
+                continue
+
+            if not line.startswith(':'):
+                raise ValueError("%s:%d: expected ':' at start of record" % (path, line_number))
+
+            record = bytes.fromhex(line[1:])
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise ValueError("%s:%d: bad record length" % (path, line_number))
+            if sum(record) & 0xff != 0:
+                raise ValueError("%s:%d: bad checksum" % (path, line_number))
+
+            address = (record[1] << 8) | record[2]
+            record_type = record[3]
+            data = record[4:-1]
+
+            if record_type == 0x00:
+                memory.write(upper_address + address, data)
+            elif record_type == 0x01:
+                break
+            elif record_type == 0x02:
+                # Extended segment address
+                upper_address = int.from_bytes(data, 'big') << 4
+            elif record_type == 0x04:
+                # Extended linear address
+                upper_address = int.from_bytes(data, 'big') << 16
+            # 0x03 and 0x05 are start addresses, which the CPU does not use
+
+    return memory
+
+def load_elf(path):
+    # Loads the PT_LOAD segments of a little-endian ELF32 file at their
+    # physical (load) address, like objcopy -O binary does
+    with open(path, 'rb') as input_file:
+        elf = input_file.read()
+
+    if elf[:4] != ELF_MAGIC or elf[4] != 1 or elf[5] != 1:
+        raise ValueError("%s: not a little-endian ELF32 file" % path)
+
+    phoff, = struct.unpack_from('<I', elf, 0x1c)
+    phentsize, phnum = struct.unpack_from('<HH', elf, 0x2a)
+
+    memory = PagedMemory()
+    for i in range(phnum):
+        p_type, p_offset, _, p_paddr, p_filesz, _, _, _ = \
+            struct.unpack_from('<8I', elf, phoff + i * phentsize)
+
+        if p_type == PT_LOAD and p_filesz > 0:
+            memory.write(p_paddr, memoryview(elf)[p_offset:p_offset + p_filesz])
+
+    return memory
+
+def load_image(path):
+    # Picks the loader from the file contents: ELF, Intel HEX, a text
+    # listing (.lst/.txt) or otherwise a raw binary
+    with open(path, 'rb') as input_file:
+        start = input_file.read(4)
+
+    if start == ELF_MAGIC:
+        return load_elf(path)
+    if start[:1] == b':':
+        return load_intel_hex(path)
+    if path.endswith('.lst') or path.endswith('.txt'):
+        with open(path, 'r') as input_file:
+            return load_listing(input_file.read())
+    return load_binary(path)
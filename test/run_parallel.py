@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Runs the cocotb tests in test.py across several make processes.
+
+The tests are split into shards with TESTCASE, balanced by the runtimes of
+earlier runs (kept in sim_build/test_times.json). Every shard has its own
+SIM_BUILD directory, results file and waveform file, and the results of all
+shards are merged into results.xml.
+
+    python run_parallel.py -j 8                 # RTL
+    python run_parallel.py -j 8 --gates         # gate level
+    python run_parallel.py -j 16 --rtl --gates  # both at the same time
+
+Any other arguments are passed on to make, e.g. SIM=verilator.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+TIMES_FILE = os.path.join('sim_build', 'test_times.json')
+
+# Runtime in s assumed for tests that have not been run yet
+DEFAULT_TIME = 1.0
+
+def mode_env(mode):
+    env = dict(os.environ)
+    env['GATES'] = 'yes' if mode == 'gl' else 'no'
+    return env
+
+def discover_tests(mode):
+    # Imports test.py in a separate process, as the tests that are defined
+    # depend on GATES and BENCHMARKS
+    script = ('import cocotb, test\n'
+              'for name, obj in vars(test).items():\n'
+              '    if isinstance(obj, cocotb.decorators.test):\n'
+              '        print(name)\n')
+    output = subprocess.run([sys.executable, '-c', script], cwd=TEST_DIR, env=mode_env(mode),
+                            check=True, capture_output=True, text=True).stdout
+    return output.split()
+
+def load_times():
+    try:
+        with open(os.path.join(TEST_DIR, TIMES_FILE)) as input_file:
+            return json.load(input_file)
+    except (OSError, ValueError):
+        return {}
+
+def save_times(times):
+    path = os.path.join(TEST_DIR, TIMES_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as output_file:
+        json.dump(times, output_file, indent=1, sort_keys=True)
+
+def make_shards(tests, times, num_shards):
+    # Longest processing time first: the slowest remaining test goes to the
+    # shard that currently has the least work
+    shards = [[] for _ in range(num_shards)]
+    loads = [0.0] * num_shards
+
+    for test in sorted(tests, key=lambda test: -times.get(test, DEFAULT_TIME)):
+        index = loads.index(min(loads))
+        shards[index].append(test)
+        loads[index] += times.get(test, DEFAULT_TIME)
+
+    return [shard for shard in shards if len(shard) > 0]
+
+def run_shard(mode, index, tests, make_args):
+    name = '%s_shard%d' % (mode, index)
+    sim_build = os.path.join('sim_build', name)
+    results_file = os.path.join(sim_build, 'results.xml')
+    log_file = os.path.join(TEST_DIR, sim_build, 'make.log')
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+
+    command = ['make', 'SIM_BUILD=%s' % sim_build, 'COCOTB_RESULTS_FILE=%s' % results_file,
+               'TESTCASE=%s' % ','.join(tests), 'DUMP_FILE=%s/tb.$(WAVEFORM)' % sim_build] + make_args
+
+    start = time.perf_counter()
+    with open(log_file, 'w') as log:
+        subprocess.run(command, cwd=TEST_DIR, env=mode_env(mode), stdout=log, stderr=subprocess.STDOUT)
+
+    print('%s: %d tests in %.1f s, log in %s' % (name, len(tests), time.perf_counter() - start, log_file))
+    return os.path.join(TEST_DIR, results_file)
+
+def merge_results(mode, tests, results_files):
+    # Returns a testsuite element with the testcases of all shards. Tests that
+    # are missing, e.g. because the simulator crashed, are added as failures.
+    suite = ET.Element('testsuite', name=mode, package=mode)
+    found = set()
+
+    for results_file in results_files:
+        try:
+            root = ET.parse(results_file).getroot()
+        except (OSError, ET.ParseError):
+            continue
+
+        for testcase in root.iter('testcase'):
+            suite.append(testcase)
+            found.add(testcase.get('name'))
+
+    for test in tests:
+        if test not in found:
+            testcase = ET.SubElement(suite, 'testcase', name=test, classname=mode)
+            ET.SubElement(testcase, 'failure', message='test did not report a result, see the shard log')
+
+    return suite
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the cocotb tests in parallel shards.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of make processes')
+    parser.add_argument('--rtl', action='store_true', help='run the RTL tests (default)')
+    parser.add_argument('--gates', action='store_true', help='run the gate level tests')
+    parser.add_argument('--results', default='results.xml', help='merged results file')
+    args, make_args = parser.parse_known_args()
+
+    modes = []
+    if args.rtl or not args.gates:
+        modes.append('rtl')
+    if args.gates:
+        modes.append('gl')
+
+    times = load_times()
+    jobs = max(1, args.jobs // len(modes))
+
+    plan = []
+    for mode in modes:
+        tests = discover_tests(mode)
+        shards = make_shards(tests, times.get(mode, {}), jobs)
+        plan.append((mode, tests, shards))
+
+    with ThreadPoolExecutor(max_workers=sum(len(shards) for _, _, shards in plan)) as executor:
+        futures = [(mode, tests, [executor.submit(run_shard, mode, index, shard, make_args)
+                                  for index, shard in enumerate(shards)])
+                   for mode, tests, shards in plan]
+
+        root = ET.Element('testsuites', name='results')
+        for mode, tests, shard_futures in futures:
+            suite = merge_results(mode, tests, [future.result() for future in shard_futures])
+            root.append(suite)
+
+            # Remember the runtimes for balancing the next run
+            mode_times = times.setdefault(mode, {})
+            for testcase in suite.iter('testcase'):
+                if testcase.get('time') is not None:
+                    mode_times[testcase.get('name')] = float(testcase.get('time'))
+
+    save_times(times)
+    ET.ElementTree(root).write(os.path.join(TEST_DIR, args.results))
+
+    failures = [testcase.get('name') for testcase in root.iter('testcase')
+                if testcase.find('failure') is not None]
+    total = sum(1 for _ in root.iter('testcase'))
+    print('%d tests, %d failed' % (total, len(failures)))
+    for name in failures:
+        print('FAIL', name)
+
+    return 1 if len(failures) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import array
+import csv
+import json
+import os
+
+import cocotb
+from cocotb.triggers import Edge
+
+from commit_trace import next_test_output_path
+
+# Summary of the SPI bus traffic, from the transaction log in tb.v. Every
+# transaction (the time that one CS is low) is decoded into the start cycle,
+# chip, opcode, address, data bytes and length. With SPI_STATS=log the
+# summary of every program is logged, SPI_STATS=csv or SPI_STATS=json also
+# write the transactions to SPI_STATS_DIR. In a test:
+#
+#   analyzer = SpiAnalyzer(dut, out_cs=0b0001)    # OUT0 is a CS too
+#   await run_program(dut, ..., spi_analyzer=analyzer)
+#   analyzer.summary()
+
+SPI_LOG_SIZE = 64
+
+CHIPS = ['flash', 'ram', 'out0', 'out1', 'out2', 'out3']
+KINDS = ['fetch', 'data', 'peripheral']
+
+QUAD_READ_COMMAND = 0x6B
+QUAD_DUMMY_CLOCKS = 8
+QUAD_IO_READ_COMMAND = 0xEB
+QUAD_IO_HEADER_CLOCKS = 20  # command, address, mode and dummy clocks
+
+# One array per field, in this order in the CSV and JSON files
+SPI_FIELDS = ('cycle', 'chip', 'kind', 'opcode', 'address', 'bytes', 'duration', 'sclk')
+
+def decode_transaction(fetch, chip, sclk, first_bits):
+    # Returns kind, opcode, address and data bytes. The flash and the PSRAM
+    # get a command and a 3 byte address, the data bytes follow on MOSI/MISO,
+    # or 4 bits per clock on the quad lines after the dummy clocks for 0x6B.
+    # The address of 0xEB is sent on the quad lines, so it is not known.
+    # A peripheral transaction has no address, all its bytes are counted.
+    bits = min(sclk, 32)
+    opcode = (first_bits >> (bits - 8)) & 0xff if bits >= 8 else 0
+
+    if chip >= 2:
+        return KINDS.index('peripheral'), opcode, 0, sclk // 8
+
+    kind = KINDS.index('fetch' if fetch else 'data')
+    if opcode == QUAD_IO_READ_COMMAND:
+        return kind, opcode, 0, max(sclk - QUAD_IO_HEADER_CLOCKS, 0) // 2
+
+    if sclk < 32:
+        # Ended before the address was sent, e.g. a squashed prefetch
+        return kind, opcode, 0, 0
+
+    if opcode == QUAD_READ_COMMAND:
+        num_bytes = max(sclk - 32 - QUAD_DUMMY_CLOCKS, 0) // 2
+    else:
+        num_bytes = (sclk - 32) // 8
+    return kind, opcode, first_bits & 0xffffff, num_bytes
+
+class SpiTransactions:
+    def __init__(self, capacity=4096):
+        # Preallocated like commit_trace.Trace, doubled when it is full
+        self.count = 0
+        self.capacity = capacity
+        self.columns = {field: array.array('I', bytes(4 * capacity)) for field in SPI_FIELDS}
+
+    def __len__(self):
+        return self.count
+
+    def append(self, *values):
+        if self.count == self.capacity:
+            for column in self.columns.values():
+                column.extend(bytes(4 * self.capacity))
+            self.capacity *= 2
+
+        for field, value in zip(SPI_FIELDS, values):
+            self.columns[field][self.count] = value
+        self.count += 1
+
+    def column(self, field):
+        return self.columns[field][:self.count]
+
+    def rows(self):
+        columns = [self.column(field) for field in SPI_FIELDS]
+        for values in zip(*columns):
+            row = dict(zip(SPI_FIELDS, values))
+            row['chip'] = CHIPS[row['chip']]
+            row['kind'] = KINDS[row['kind']]
+            yield row
+
+class SpiAnalyzer:
+    def __init__(self, dut, out_cs=0):
+        # out_cs: OUT0-OUT3 (bits 0-3) that are used as CS of a peripheral
+        self.dut = dut
+        self.out_cs = out_cs
+        self.transactions = SpiTransactions()
+        self.cycles = 0             # cycles since the reset, when stopped
+        self.instructions = None    # retired until stopped (RTL only)
+        self.lost = 0
+
+        self._log = [dut.spi_log[i] for i in range(SPI_LOG_SIZE)]
+        self._count = dut.spi_log_count
+        self._task = None
+        self.read = 0
+
+    def read_batch(self):
+        # Decodes all transactions that were logged since the last call
+        count = self._count.value.integer
+        if count - self.read > SPI_LOG_SIZE:
+            self.lost += count - self.read - SPI_LOG_SIZE
+            self.read = count - SPI_LOG_SIZE
+
+        append = self.transactions.append
+        while self.read < count:
+            value = self._log[self.read % SPI_LOG_SIZE].value.integer
+            first_bits = value & 0xffffffff
+            sclk = (value >> 32) & 0xffffffff
+            duration = (value >> 64) & 0xffffffff
+            cycle = (value >> 96) & 0xffffffff
+            chip = (value >> 128) & 0x7
+            fetch = (value >> 131) & 0x1
+
+            kind, opcode, address, num_bytes = decode_transaction(fetch, chip, sclk, first_bits)
+            append(cycle, chip, kind, opcode, address, num_bytes, duration, sclk)
+            self.read += 1
+
+    async def run(self):
+        batch = Edge(self.dut.spi_log_batch)
+        while True:
+            await batch
+            self.read_batch()
+
+    def start(self):
+        # Only the transactions from now on are decoded
+        self.dut.spi_monitor_out_cs.value = self.out_cs
+        self.read = self._count.value.integer
+        self._task = cocotb.start_soon(self.run())
+
+    def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.kill()
+        self.read_batch()
+
+        self.cycles = self.dut.spi_monitor_cycle.value.integer
+        # commit_count is in the RTL tests only, like the commit log
+        if os.environ.get('GATES', 'no') != 'yes':
+            self.instructions = self.dut.commit_count.value.integer
+
+        if self.lost:
+            self.dut._log.warning('spi analyzer: %d transactions were overwritten before they were read' % self.lost)
+
+    def summary(self):
+        # Bus utilization (sclk running, and any CS low), the transactions,
+        # bytes and length of every kind and chip, the idle time between
+        # transactions and the bytes per retired instruction
+        t = self.transactions
+        cycle, chip, kind = t.column('cycle'), t.column('chip'), t.column('kind')
+        num_bytes, duration, sclk = t.column('bytes'), t.column('duration'), t.column('sclk')
+        cycles = max(self.cycles, 1)
+
+        def group(column, names):
+            result = {}
+            for index, name in enumerate(names):
+                selected = [i for i in range(len(t)) if column[i] == index]
+                if not selected:
+                    continue
+                result[name] = {
+                    'transactions': len(selected),
+                    'bytes': sum(num_bytes[i] for i in selected),
+                    'sclk_cycles': sum(sclk[i] for i in selected),
+                    'average_duration': sum(duration[i] for i in selected) / len(selected),
+                    'max_duration': max(duration[i] for i in selected),
+                }
+            return result
+
+        gaps = [cycle[i + 1] - (cycle[i] + duration[i]) for i in range(len(t) - 1)]
+        total_bytes = sum(num_bytes)
+
+        return {
+            'cycles': self.cycles,
+            'transactions': len(t),
+            'bytes': total_bytes,
+            'utilization': sum(sclk) / cycles,
+            'cs_low': sum(duration) / cycles,
+            'average_idle_gap': sum(gaps) / len(gaps) if gaps else 0.0,
+            'instructions': self.instructions,
+            'bytes_per_instruction': total_bytes / self.instructions if self.instructions else None,
+            'kinds': group(kind, KINDS),
+            'chips': group(chip, CHIPS),
+        }
+
+    def report(self):
+        summary = self.summary()
+        lines = ['SPI bus: %d transactions, %d bytes in %d cycles, sclk %.1f %%, CS low %.1f %%, average idle gap %.1f cycles'
+                 % (summary['transactions'], summary['bytes'], summary['cycles'], 100 * summary['utilization'],
+                    100 * summary['cs_low'], summary['average_idle_gap'])]
+        if summary['bytes_per_instruction'] is not None:
+            lines.append('%.2f bytes per instruction (%d instructions)'
+                         % (summary['bytes_per_instruction'], summary['instructions']))
+
+        lines.append('%-16s %12s %8s %12s %14s %12s' % ('', 'transactions', 'bytes', 'sclk cycles',
+                                                        'avg duration', 'max duration'))
+        for section, key in [('kind', 'kinds'), ('chip', 'chips')]:
+            for name, stats in summary[key].items():
+                lines.append('%-16s %12d %8d %12d %14.1f %12d' % ('%s: %s' % (section, name), stats['transactions'],
+                                                                 stats['bytes'], stats['sclk_cycles'],
+                                                                 stats['average_duration'], stats['max_duration']))
+        return lines
+
+    def log(self):
+        for line in self.report():
+            self.dut._log.info(line)
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as output_file:
+            writer = csv.DictWriter(output_file, fieldnames=SPI_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.transactions.rows())
+
+    def write_json(self, path):
+        # Columns of the transactions, the chip and kind as names
+        columns = {field: self.transactions.column(field).tolist() for field in SPI_FIELDS}
+        columns['chip'] = [CHIPS[value] for value in columns['chip']]
+        columns['kind'] = [KINDS[value] for value in columns['kind']]
+
+        with open(path, 'w') as output_file:
+            json.dump({'summary': self.summary(), 'transactions': columns}, output_file, indent=1)
+
+def spi_stats_format():
+    return os.environ.get('SPI_STATS', 'off')
+
+def write_spi_stats_from_env(analyzer):
+    # Logs the summary, and writes the transactions for SPI_STATS=csv/json
+    stats_format = spi_stats_format()
+    analyzer.log()
+
+    if stats_format in ('csv', 'json'):
+        path = next_test_output_path(os.environ.get('SPI_STATS_DIR', 'sim_build/spi_stats'), '.' + stats_format)
+        if stats_format == 'csv':
+            analyzer.write_csv(path)
+        else:
+            analyzer.write_json(path)
+        analyzer.dut._log.info('SPI transactions written to %s', path)
@@ -0,0 +1,78 @@
+`default_nettype none `timescale 1ns / 10ps
+
+/* Behavioral SPI memory model used by tb.v for the flash (cs1) and PSRAM (cs2)
+   chips, so that instruction fetches and RAM accesses stay inside the simulator.
+
+   Supports the commands that spi_controller sends, both with a 3 byte address:
+   0x03 - read, bytes are streamed out for as long as CS is held low
+   0x02 - write, bytes are written for as long as CS is held low
+
+   A rising edge on load fills the memory with 0xff and then loads load_file
+   with $readmemh (if load_file is not empty).
+*/
+module spi_memory #(
+    parameter SIZE = 65536
+) (
+    input wire cs,
+    input wire sclk,
+    input wire mosi,
+    output reg miso,
+
+    input wire load,
+    input wire [8*256-1:0] load_file
+);
+    localparam ADDRESS_BITS = $clog2(SIZE);
+
+    reg [7:0] memory[0:SIZE-1];
+
+    reg [7:0] command;
+    reg [23:0] address;
+    reg [7:0] shift_in;
+    reg [31:0] bit_count;   // Number of bits received since CS went low
+
+    // Byte that is currently being read or written after the address
+    wire [31:0] data_offset = (bit_count - 32) >> 3;
+    wire [23:0] data_address = address + data_offset[23:0];
+
+    integer i;
+
+    always @(posedge load) begin
+        for (i = 0; i < SIZE; i = i + 1) begin
+            memory[i] = 8'hff;
+        end
+
+        if (load_file != 0) begin
+            $readmemh(load_file, memory);
+        end
+    end
+
+    // Sample MOSI on the rising edge of sclk
+    always @(posedge sclk or posedge cs) begin
+        if (cs) begin
+            bit_count <= 0;
+        end else begin
+            shift_in = {shift_in[6:0], mosi};
+            bit_count <= bit_count + 1;
+
+            if (bit_count < 8) begin
+                command <= shift_in;
+            end else if (bit_count < 32) begin
+                address <= {address[22:0], mosi};
+            end else if (bit_count[2:0] == 7 && command == 8'h02) begin
+                memory[data_address[ADDRESS_BITS-1:0]] <= shift_in;
+            end
+        end
+    end
+
+    // Shift out MISO on the falling edge of sclk, MSB first
+    always @(negedge sclk or posedge cs) begin
+        if (cs) begin
+            miso <= 0;
+        end else if (command == 8'h03 && bit_count >= 32) begin
+            miso <= memory[data_address[ADDRESS_BITS-1:0]][3'd7 - bit_count[2:0]];
+        end else begin
+            miso <= 0;
+        end
+    end
+
+endmodule
@@ -1,4 +1,4 @@
-`default_nettype none `timescale 1ns / 100ps
+`default_nettype none `timescale 1ns / 10ps
 
 /* This testbench just instantiates the module and makes some convenient wires
    that can be driven / tested by the cocotb test.py.
@@ -7,22 +7,64 @@ module tb ();
 
     integer i;
 
-    // Dump the signals to a VCD file. You can view it with gtkwave.
+    // Waveforms are off by default. The Makefile passes +dumpfile=<path> when
+    // WAVEFORM is vcd or fst, and waveform.py turns dumping on and off with
+    // waveform_en. You can view the file with gtkwave.
+    reg [8*256-1:0] dump_file;
+    reg waveform_en;
+    reg waveform_started;
+
     initial begin
-        $dumpfile("tb.vcd");
-        $dumpvars(0, tb);
+        waveform_en = 0;
+        waveform_started = 0;
+`ifndef VERILATOR
+        if ($value$plusargs("dumpfile=%s", dump_file)) begin
+            $dumpfile(dump_file);
+        end
+`endif
+    end
 
-        // for (i = 0; i < 16; i = i + 1) begin
-        //     $dumpvars(0, cpu1.reg1.registers[i]);
-        // end
-        #1;
+    // With Verilator the whole simulation is traced from the start instead,
+    // by the C++ main of cocotb (see the Makefile), so there is no window
+`ifndef VERILATOR
+    always @(waveform_en) begin
+        if (waveform_en & ~waveform_started) begin
+            $dumpvars(0, tb);
+            waveform_started = 1;
+        end else if (waveform_en) begin
+            $dumpon;
+        end else if (waveform_started) begin
+            $dumpoff;
+        end
     end
+`endif
 
     // Wire up the inputs and outputs:
     reg clk;
     reg rst_n;
     reg ena;
 
+    // Free running clock, run_program starts it with clk_en. Python only
+    // wakes up on the edges that a test waits for, instead of on every edge
+    // like with the cocotb Clock. Same period as CLOCK_PERIOD_NS in helpers.py.
+    // With COCOTB_CLOCK (CLOCK=cocotb in the Makefile) clk is driven by a
+    // cocotb Clock instead.
+    parameter real CLOCK_PERIOD_NS = 41.66;    // 24MHz
+    reg clk_en;
+
+`ifndef COCOTB_CLOCK
+    initial begin
+        clk = 0;
+        clk_en = 0;
+    end
+
+    always #(CLOCK_PERIOD_NS / 2) begin
+        if (clk_en) begin
+            clk = ~clk;
+        end
+    end
+`endif
+
     reg [7:0] ui_in;
     reg [7:0] uio_in;
     wire [7:0] uo_out;
@@ -50,10 +92,63 @@ module tb ();
     wire io_out5 = uio_out[6];
     wire io_out6 = uio_out[7];
 
-    reg miso;
-    always_comb begin
-        ui_in[2] = miso;
-        ui_in[7] = uart_rx;
+    // Shift registers for the SpiFlashPeripheral fast path. MOSI is shifted
+    // in on the rising edge of sclk and MISO is shifted out on the falling
+    // edge, so the Python model only wakes up when spi_fast_ready goes high
+    // after spi_fast_bit_target bits, instead of on every sclk edge.
+    reg spi_fast_en;
+    reg spi_fast_ready;
+    reg [31:0] spi_fast_rx;
+    reg [31:0] spi_fast_tx;
+    reg [7:0] spi_fast_bit_count;
+    reg [7:0] spi_fast_bit_target;
+    reg spi_fast_quad;          // shift out 4 bits per sclk on the quad lines
+    reg [31:0] spi_fast_quad_rx;
+
+    initial begin
+        spi_fast_en = 0;
+        spi_fast_ready = 0;
+        spi_fast_tx = 0;
+        spi_fast_bit_count = 0;
+        spi_fast_bit_target = 0;
+        spi_fast_quad = 0;
+    end
+
+    always @(posedge sclk) begin
+        spi_fast_rx <= {spi_fast_rx[30:0], flash_io0};
+        spi_fast_quad_rx <= {spi_fast_quad_rx[27:0], uio_out[7:4]};
+        spi_fast_bit_count <= spi_fast_bit_count + 1;
+    end
+
+    always @(negedge sclk) begin
+        spi_fast_tx <= spi_fast_quad ? spi_fast_tx << 4 : spi_fast_tx << 1;
+        spi_fast_ready <= (spi_fast_bit_count == spi_fast_bit_target);
+    end
+
+    // Flash data lines IO0-IO3 for the quad read of QuadSpiFlashPeripheral,
+    // connected to uio_in[7:4] of the CPU when flash_quad_en is set. The
+    // flash IO0 pin is on IO3 (uio[4]), and on MOSI through a resistor for
+    // the single reads, so it follows IO3 while the CPU drives it.
+    reg flash_quad_en;
+    reg [3:0] flash_quad_io;    // driven by the per-bit model
+    reg flash_quad_drive;       // set by the model while it drives the quad lines
+    reg flash_quad_conflict;    // the CPU drove IO3-IO6 or MOSI at the same time
+
+    wire flash_io0 = (flash_quad_en & ~cs1 & uio_oe[4]) ? uio_out[4] : mosi;
+    wire [3:0] flash_quad_out = spi_fast_en ? spi_fast_tx[31:28] : flash_quad_io;
+    wire [7:0] cpu_uio_in = flash_quad_en ? {flash_quad_out, uio_in[3:0]} : uio_in;
+
+    initial begin
+        flash_quad_en = 0;
+        flash_quad_io = 0;
+        flash_quad_drive = 0;
+        flash_quad_conflict = 0;
+    end
+
+    always @(posedge sclk) begin
+        if (~cs1 & flash_quad_drive & ((|uio_oe[7:4]) | mosi)) begin
+            flash_quad_conflict <= 1;
+        end
     end
 
     initial begin
@@ -61,9 +156,346 @@ module tb ();
         
         // Set debug mode to low, so NOT in debug mode
         ui_in[1:0] = 2'b11;
-        ui_in[6:3] = 4'b1111;
+        ui_in[5:3] = 3'b111;
+        ui_in[6] = 0;
+    end
+
+    // Flash and PSRAM models that are used instead of the Python
+    // SpiFlashPeripherals when hdl_memory_en is set.
+    reg hdl_memory_en;
+    reg hdl_memory_load;
+    reg [8*256-1:0] flash_load_file;
+    reg [8*256-1:0] ram_load_file;
+
+    wire flash_miso;
+    wire ram_miso;
+
+    initial begin
+        hdl_memory_en = 0;
+        hdl_memory_load = 0;
+        flash_load_file = 0;
+        ram_load_file = 0;
+    end
+
+    spi_memory flash_memory (
+        .cs(cs1),
+        .sclk(sclk),
+        .mosi(mosi),
+        .miso(flash_miso),
+        .load(hdl_memory_load),
+        .load_file(flash_load_file)
+    );
+
+    spi_memory ram_memory (
+        .cs(cs2),
+        .sclk(sclk),
+        .mosi(mosi),
+        .miso(ram_miso),
+        .load(hdl_memory_load),
+        .load_file(ram_load_file)
+    );
+
+    reg miso;
+    wire cpu_miso = (hdl_memory_en & ~cs1) ? flash_miso :
+                    (hdl_memory_en & ~cs2) ? ram_miso :
+                    spi_fast_en ? spi_fast_tx[31] : miso;
+
+    // MISO and UART RX replace bits 2 and 7 of the inputs that are set by the
+    // tests, so that a write of the whole ui_in does not change them
+    wire [7:0] cpu_ui_in = {uart_rx, ui_in[6:3], cpu_miso, ui_in[1:0]};
+
+    // Transaction log of the SPI bus for spi_analyzer.py. It only looks at
+    // the pins: a transaction is the time that one CS is low. CS of the
+    // flash and the PSRAM are always logged, OUT0-OUT3 if their bit in
+    // spi_monitor_out_cs is set. The first 32 bits on MOSI (command and
+    // address) and the number of sclk pulses are kept, and spi_log_batch
+    // toggles after every SPI_LOG_BATCH transactions like commit_batch.
+    localparam SPI_LOG_SIZE = 64;
+    localparam SPI_LOG_BATCH = 32;
+
+    reg [3:0] spi_monitor_out_cs;
+
+    // {fetch, chip, start cycle, length in cycles, sclk pulses, first 32 bits}
+    reg [131:0] spi_log[0:SPI_LOG_SIZE-1];
+    reg [31:0] spi_log_count;
+    reg spi_log_batch;
+
+    reg [31:0] spi_monitor_cycle;       // Cycles since the reset
+    reg [31:0] spi_monitor_sclk_count;  // sclk pulses since the start
+    reg [31:0] spi_monitor_shift;
+    reg [31:0] spi_monitor_header;
+
+    reg [31:0] spi_frame_start_cycle;
+    reg [31:0] spi_frame_start_sclk;
+    reg [2:0] spi_frame_chip;
+    reg spi_frame_fetch;
+    reg spi_frame_active;
+
+    // Chip 0 is the flash, 1 the PSRAM and 2-5 OUT0-OUT3
+    wire [5:0] spi_monitor_selected = {~{out3, out2, out1, out0} & spi_monitor_out_cs, ~cs2, ~cs1};
+    wire spi_monitor_active = |spi_monitor_selected;
+    wire [2:0] spi_monitor_chip = spi_monitor_selected[0] ? 3'd0 : spi_monitor_selected[1] ? 3'd1 :
+                                  spi_monitor_selected[2] ? 3'd2 : spi_monitor_selected[3] ? 3'd3 :
+                                  spi_monitor_selected[4] ? 3'd4 : 3'd5;
+    wire [31:0] spi_frame_sclk = spi_monitor_sclk_count - spi_frame_start_sclk;
+
+    // Instruction fetches are only known in the RTL
+`ifndef GL_TEST
+    wire spi_monitor_fetch = cpu1.mem_external1.is_fetch & ~cpu1.mem_external1.dma_active
+                             & ~cpu1.mem_external1.spi_peripheral_active;
+`else
+    wire spi_monitor_fetch = 0;
+`endif
+
+    initial begin
+        spi_monitor_out_cs = 0;
+        spi_log_count = 0;
+        spi_log_batch = 0;
+        spi_monitor_cycle = 0;
+        spi_monitor_sclk_count = 0;
+        spi_frame_start_cycle = 0;
+        spi_frame_start_sclk = 0;
+        spi_frame_chip = 0;
+        spi_frame_fetch = 0;
+        spi_frame_active = 0;
+    end
+
+    always @(posedge clk) begin
+        if (~rst_n) begin
+            spi_monitor_cycle <= 0;
+        end else begin
+            spi_monitor_cycle <= spi_monitor_cycle + 1;
+        end
+    end
+
+    always @(posedge sclk) begin
+        spi_monitor_sclk_count <= spi_monitor_sclk_count + 1;
+        spi_monitor_shift <= {spi_monitor_shift[30:0], mosi};
+        if (spi_frame_sclk == 31) begin
+            spi_monitor_header <= {spi_monitor_shift[30:0], mosi};
+        end
+    end
+
+    // CS goes low and high on the falling edge of clk, between the sclk
+    // pulses. If more than one CS is low, the transaction is of the first
+    // chip, so the flash and the PSRAM are logged on their own while the
+    // CS of a peripheral is low. A peripheral is only logged for the time
+    // that it got sclk pulses.
+    always @(spi_monitor_active or spi_monitor_chip) begin
+        if (spi_frame_active && rst_n && (spi_frame_chip < 2 || spi_frame_sclk != 0)) begin
+            spi_log[spi_log_count % SPI_LOG_SIZE] <= {
+                spi_frame_fetch, spi_frame_chip, spi_frame_start_cycle,
+                spi_monitor_cycle - spi_frame_start_cycle, spi_frame_sclk,
+                (spi_frame_sclk >= 32) ? spi_monitor_header : spi_monitor_shift
+            };
+            spi_log_count <= spi_log_count + 1;
+
+            if (spi_log_count % SPI_LOG_BATCH == SPI_LOG_BATCH - 1) begin
+                spi_log_batch <= ~spi_log_batch;
+            end
+        end
+
+        spi_frame_active <= spi_monitor_active;
+        spi_frame_start_cycle <= spi_monitor_cycle;
+        spi_frame_start_sclk <= spi_monitor_sclk_count;
+        spi_frame_fetch <= spi_monitor_fetch;
+        spi_frame_chip <= spi_monitor_chip;
     end
 
+`ifndef GL_TEST
+    // Goes high when the CPU reaches waveform_trigger_pc, to start dumping at a PC
+    reg waveform_trigger_en;
+    reg [17:0] waveform_trigger_pc;
+    wire waveform_pc_hit = waveform_trigger_en & (cpu1.prog_counter == waveform_trigger_pc);
+
+    initial begin
+        waveform_trigger_en = 0;
+        waveform_trigger_pc = 0;
+    end
+
+    // Commit log for the lockstep checker in lockstep.py. Every retired
+    // instruction is written to a ring buffer, and commit_batch toggles
+    // after every COMMIT_BATCH entries, so the checker only wakes up once
+    // per batch instead of on every clock.
+    localparam COMMIT_LOG_SIZE = 64;
+    localparam COMMIT_BATCH = 32;
+
+    // {cycle, store value, load/store address, rd value, rd, pc, instruction}
+    reg [167:0] commit_log[0:COMMIT_LOG_SIZE-1];
+    reg [31:0] commit_count;
+    reg commit_batch;
+
+    reg [17:0] commit_mem_address;
+    reg [31:0] commit_store_value;
+
+    wire [31:0] commit_instruction = {
+        cpu1.current_instruction[7:0], cpu1.current_instruction[15:8],
+        cpu1.current_instruction[23:16], cpu1.current_instruction[31:24]
+    };
+
+    initial begin
+        commit_count = 0;
+        commit_batch = 0;
+    end
+
+    always @(posedge clk) begin
+        if (~rst_n) begin
+            commit_count <= 0;
+        end else if (~cpu1.halted & ~cpu1.debug_mode) begin
+            // The address and value are only on the bus while parsing
+            if (cpu1.state == 5'b00100 && (cpu1.opcode == 7'h03 || cpu1.opcode == 7'h23)) begin
+                commit_mem_address <= cpu1.alu_result[17:0];
+                commit_store_value <= cpu1.reg_value;
+            end
+
+            // Registers are written back by the time the PC is moved, the
+            // CPU may wait there for the prefetch of the next instruction
+            if (cpu1.state == 5'b10000 && ~cpu1.prefetch_wait) begin
+                commit_log[commit_count % COMMIT_LOG_SIZE] <= {
+                    cpu1.cycle_count, commit_store_value, commit_mem_address,
+                    cpu1.reg1.registers[cpu1.instr_rd], cpu1.instr_rd,
+                    cpu1.prog_counter, commit_instruction
+                };
+                commit_count <= commit_count + 1;
+
+                if (commit_count % COMMIT_BATCH == COMMIT_BATCH - 1) begin
+                    commit_batch <= ~commit_batch;
+                end
+            end
+        end
+    end
+
+    // Cycle counters for the CPI profile in cpu_profile.py, counted while
+    // profile_en is set. Python only reads them when the program is done.
+    reg profile_en;
+
+    reg [31:0] profile_fetch_cycles;
+    reg [31:0] profile_read_cycles;
+    reg [31:0] profile_parse_cycles;
+    reg [31:0] profile_write_cycles;
+    reg [31:0] profile_move_cycles;
+    reg [31:0] profile_debug_read_cycles;      // debug_state
+    reg [31:0] profile_debug_tx_cycles;
+
+    // Cycles that the CPU waits for the SPI bus: for an instruction fetch
+    // that is not in the instruction cache, for a load/store and for a
+    // prefetch before the PC is moved
+    reg [31:0] profile_fetch_wait_cycles;
+    reg [31:0] profile_data_wait_cycles;
+    reg [31:0] profile_prefetch_wait_cycles;
+
+    // Cycles that sclk runs, and the part of them for peripherals and the DMA
+    reg [31:0] profile_spi_cycles;
+    reg [31:0] profile_spi_peripheral_cycles;
+    reg [31:0] profile_spi_dma_cycles;
+
+    // Cycles and retired instructions per opcode class, see cpu_profile.py.
+    // The cycles from the fetch until the instruction is retired are added
+    // to its class.
+    localparam PROFILE_CLASSES = 8;
+    reg [31:0] profile_class_cycles[0:PROFILE_CLASSES-1];
+    reg [31:0] profile_class_count[0:PROFILE_CLASSES-1];
+    reg [31:0] profile_instruction_cycles;
+    reg [2:0] profile_class;
+    integer profile_i;
+
+    initial begin
+        profile_en = 0;
+    end
+
+    always @(*) begin
+        case (cpu1.opcode)
+            7'h03:          profile_class = 0;  // load
+            7'h23:          profile_class = 1;  // store
+            7'h13:          profile_class = 2;  // ALU immediate
+            7'h33:          profile_class = 3;  // ALU register
+            7'h37, 7'h17:   profile_class = 4;  // LUI, AUIPC
+            7'h63:          profile_class = 5;  // branch
+            7'h6F, 7'h67:   profile_class = 6;  // JAL, JALR
+            default:        profile_class = 7;
+        endcase
+    end
+
+    wire profile_active = profile_en & ~cpu1.halted;
+    wire profile_running = profile_active & ~cpu1.debug_mode;
+    wire profile_retired = profile_running & (cpu1.state == 5'b10000) & ~cpu1.prefetch_wait;
+    wire profile_spi = cpu1.mem_external1.spi_in_transaction;
+
+    always @(posedge clk) begin
+        if (~rst_n) begin
+            profile_fetch_cycles <= 0;
+            profile_read_cycles <= 0;
+            profile_parse_cycles <= 0;
+            profile_write_cycles <= 0;
+            profile_move_cycles <= 0;
+            profile_debug_read_cycles <= 0;
+            profile_debug_tx_cycles <= 0;
+            profile_fetch_wait_cycles <= 0;
+            profile_data_wait_cycles <= 0;
+            profile_prefetch_wait_cycles <= 0;
+            profile_spi_cycles <= 0;
+            profile_spi_peripheral_cycles <= 0;
+            profile_spi_dma_cycles <= 0;
+            profile_instruction_cycles <= 0;
+
+            for (profile_i = 0; profile_i < PROFILE_CLASSES; profile_i = profile_i + 1) begin
+                profile_class_cycles[profile_i] <= 0;
+                profile_class_count[profile_i] <= 0;
+            end
+        end else begin
+            if (profile_running) begin
+                case (cpu1.state)
+                    5'b00001: profile_fetch_cycles <= profile_fetch_cycles + 1;
+                    5'b00010: profile_read_cycles <= profile_read_cycles + 1;
+                    5'b00100: profile_parse_cycles <= profile_parse_cycles + 1;
+                    5'b01000: profile_write_cycles <= profile_write_cycles + 1;
+                    5'b10000: profile_move_cycles <= profile_move_cycles + 1;
+                    default: ;
+                endcase
+
+                if (cpu1.state == 5'b00001 && ~cpu1.mem_request_done
+                    && ~cpu1.mem_external1.icache_fetch_hit) begin
+                    profile_fetch_wait_cycles <= profile_fetch_wait_cycles + 1;
+                end
+                if (cpu1.state == 5'b00100 && (cpu1.opcode == 7'h03 || cpu1.opcode == 7'h23)
+                    && ~cpu1.mem_request_done) begin
+                    profile_data_wait_cycles <= profile_data_wait_cycles + 1;
+                end
+                if (cpu1.prefetch_wait) begin
+                    profile_prefetch_wait_cycles <= profile_prefetch_wait_cycles + 1;
+                end
+
+                if (profile_retired) begin
+                    profile_class_cycles[profile_class] <= profile_class_cycles[profile_class]
+                                                           + profile_instruction_cycles + 1;
+                    profile_class_count[profile_class] <= profile_class_count[profile_class] + 1;
+                    profile_instruction_cycles <= 0;
+                end else begin
+                    profile_instruction_cycles <= profile_instruction_cycles + 1;
+                end
+            end
+
+            if (profile_active & cpu1.debug_mode) begin
+                if (cpu1.debug_state == 2'b01) begin
+                    profile_debug_read_cycles <= profile_debug_read_cycles + 1;
+                end else begin
+                    profile_debug_tx_cycles <= profile_debug_tx_cycles + 1;
+                end
+            end
+
+            if (profile_active & profile_spi) begin
+                profile_spi_cycles <= profile_spi_cycles + 1;
+                if (cpu1.mem_external1.spi_peripheral_active) begin
+                    profile_spi_peripheral_cycles <= profile_spi_peripheral_cycles + 1;
+                end
+                if (cpu1.mem_external1.dma_active) begin
+                    profile_spi_dma_cycles <= profile_spi_dma_cycles + 1;
+                end
+            end
+        end
+    end
+`endif
+
     // Replace tt_um_example with your module name:
     tt_um_liu3hao_rv32e_min_mcu cpu1 (
 
@@ -72,9 +504,9 @@ module tb ();
         .VPWR(1'b1),
         .VGND(1'b0),
 `endif
-        .ui_in(ui_in),      // Dedicated inputs
+        .ui_in(cpu_ui_in),  // Dedicated inputs
         .uo_out(uo_out),    // Dedicated outputs
-        .uio_in(uio_in),    // IOs: Input path
+        .uio_in(cpu_uio_in),  // IOs: Input path
         .uio_out(uio_out),  // IOs: Output path
         .uio_oe(uio_oe),    // IOs: Enable path (active high: 0=input, 1=output)
         .ena(ena),          // enable - goes high when design is selected
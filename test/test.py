@@ -5,12 +5,15 @@ import cocotb
 from cocotb.triggers import RisingEdge, FallingEdge, First, ClockCycles
 from cocotbext.spi import SpiBus
 
-from helpers import SpiFlashPeripheral, ValueWrapper, get_halt_signal, get_io_output_pin, get_output_pin, get_register, load_binary, assert_registers_zero, run_program, set_input_pin
+from cpu_profile import CpuProfile
+from helpers import SpiFlashPeripheral, ValueWrapper, get_halt_signal, get_io_output_pin, get_output_pin, get_register, is_benchmark_tests, is_gate_level_tests, load_binary, assert_registers_zero, run_program, set_input_pin
 from cocotbext.uart import UartSink, UartSource
 
 test_cpu =          True
 test_peripherals =  True
 test_debug =        True
+test_iss =          True
+test_benchmarks =   is_benchmark_tests()
 
 if test_cpu:
     from test_cpu import *
@@ -18,6 +21,12 @@ if test_cpu:
 if test_peripherals:
     from test_peripherals import *
 
+if test_iss:
+    from test_iss_rtl import *
+
+if test_benchmarks:
+    from test_benchmarks import *
+
 if test_debug:
     @cocotb.test()
     async def test_debug_mode(dut):
@@ -58,18 +67,19 @@ if test_debug:
     Data Dump
     -------------------------------------------------------------------------
     0x00000024	|	0x00020000
-            ''', extra_func=connect_spi)
+            ''', extra_func=connect_spi, profile=True)
+
+        if not is_gate_level_tests():
+            # The PC or a register is read in 1 clock before each of the 35
+            # words is sent
+            profile = CpuProfile.read(dut)
+            assert profile.states['debug read'] == 35
         
         dumped_values = {}
 
         # read out in words
         for i in range(0, 16):
-            start = i * 4
-            counter = 0
-            value = 0
-            while counter < 4:
-                value = (dumped_spi_contents["contents"][start+counter] << (counter*8)) | value
-                counter += 1
+            value = dumped_spi_contents["contents"].read_word(i * 4)
             dumped_values[i] = ValueWrapper(value)
 
         assert dumped_values[0].value == 24
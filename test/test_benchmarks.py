@@ -0,0 +1,324 @@
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import cocotb
+from cocotb.triggers import FallingEdge, RisingEdge
+from cocotbext.spi import SpiBus
+from cocotb.utils import get_sim_time
+
+from helpers import CLOCK_PERIOD_NS, SpiFlashPeripheral, get_halt_signal, get_register, is_gate_level_tests, load_binary, run_program, run_program_cycles
+from paged_memory import PagedMemory
+from program_image import words_to_bytes
+
+async def run_timed_program(dut, **kwargs):
+    # Returns the run_program result, the simulated time in ns and the wall
+    # clock time in s that was needed to simulate it.
+    sim_start = get_sim_time('ns')
+    wall_start = time.perf_counter()
+
+    result = await run_program(dut, **kwargs)
+
+    return result, get_sim_time('ns') - sim_start, time.perf_counter() - wall_start
+
+def log_benchmark(dut, title, rows):
+    dut._log.info(title)
+    dut._log.info("%-16s %14s %10s %16s", "mode", "sim time (ns)", "wall (s)", "sim ns / wall s")
+    for name, sim_ns, wall_s in rows:
+        dut._log.info("%-16s %14.0f %10.2f %16.0f", name, sim_ns, wall_s, sim_ns / wall_s)
+
+@cocotb.test()
+async def benchmark_spi_fast_path(dut):
+    # Compare the per-bit SpiFlashPeripheral against the fast path on test_program1
+    dut.ui_in[6].value = 0
+
+    rows = []
+    for fast_spi in [False, True]:
+        bytes = load_binary('binaries/test_program.bin')
+        _, sim_ns, wall_s = await run_timed_program(dut, memory=bytes, fast_spi=fast_spi)
+
+        assert get_register(dut, 10).value == 1024
+        rows.append(('fast' if fast_spi else 'per-bit', sim_ns, wall_s))
+
+    log_benchmark(dut, 'SpiFlashPeripheral on test_program1', rows)
+
+# Bundled binaries that halt without a device on the pins
+SIMULATOR_BINARIES = ['test_program.bin', 'test_blinky.bin', 'test_uart.bin']
+
+@cocotb.test()
+async def benchmark_simulator(dut):
+    # Simulated clock cycles per wall clock second. The rows of one
+    # simulator are comparable with the rows of another, e.g. SIM=icarus and
+    # SIM=verilator. With hdl_memory the SPI memories are models in tb.v, so
+    # only the simulator is measured and not the Python SpiFlashPeripheral.
+    dut.ui_in.value = 0
+    dut.uio_in.value = 0
+
+    dut._log.info('Simulator: %s %s', cocotb.SIM_NAME, cocotb.SIM_VERSION)
+    dut._log.info("%-20s %-12s %10s %10s %14s", "binary", "memory", "cycles", "wall (s)", "cycles / s")
+    for binary in SIMULATOR_BINARIES:
+        for hdl_memory in [False, True]:
+            bytes = load_binary('binaries/' + binary)
+            # test_uart.bin sends 'hello' at 9600 baud, about 6 ms
+            _, sim_ns, wall_s = await run_timed_program(dut, memory=bytes, hdl_memory=hdl_memory,
+                                                        timeout_us=20000)
+            assert get_halt_signal(dut).value == 1
+
+            cycles = sim_ns / CLOCK_PERIOD_NS
+            dut._log.info("%-20s %-12s %10.0f %10.2f %14.0f", binary,
+                          'hdl' if hdl_memory else 'python spi', cycles, wall_s, cycles / wall_s)
+
+SPI_SINGLE_BYTE_PROGRAM = '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x00300213	|	addi x4, x0, 3
+ 0x00000008	|	0x01000393	|	addi x7, x0, 16
+-------------------------------------------------------------------------
+ 	loop:
+ 0x0000000C	|	0x00708423	|	sb x7, 8(x1)
+ 0x00000010	|	0x004082A3	|	sb x4, 5(x1)
+ 0x00000014	|	0x00C0C283	|	lbu x5, 12(x1)
+ 0x00000018	|	0x00130313	|	addi x6, x6, 1
+ 0x0000001C	|	0xFE7318E3	|	bne x6, x7, loop
+ 0x00000020	|	0x0000006F	|	jal x0, 0
+'''
+
+SPI_BURST_PROGRAM = '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x04400113	|	addi x2, x0, 0x44
+ 0x00000008	|	0x002083A3	|	sb x2, 7(x1)
+ 0x0000000C	|	0x00300213	|	addi x4, x0, 3
+ 0x00000010	|	0x01000393	|	addi x7, x0, 16
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000014	|	0x0070A423	|	sw x7, 8(x1)
+ 0x00000018	|	0x004082A3	|	sb x4, 5(x1)
+ 0x0000001C	|	0x00C0A283	|	lw x5, 12(x1)
+ 0x00000020	|	0x00130313	|	addi x6, x6, 1
+ 0x00000024	|	0xFE7318E3	|	bne x6, x7, loop
+ 0x00000028	|	0x0000006F	|	jal x0, 0
+'''
+
+@cocotb.test()
+async def benchmark_spi_burst(dut):
+    # Peripheral SPI throughput of 16 transfers, one TX and one RX byte per
+    # transfer against 4 TX and 4 RX bytes under one CS. The TX bytes are not
+    # 0x02 or 0x03, which SpiFlashPeripheral handles as write and read.
+    modes = [
+        ('single byte', SPI_SINGLE_BYTE_PROGRAM, 1),
+        ('burst', SPI_BURST_PROGRAM, 4),
+    ]
+
+    dut._log.info("%-12s %8s %8s %18s", "mode", "bytes", "cycles", "bytes / 1000 clk")
+    throughput = {}
+    for name, program, num_bytes in modes:
+        stats = {'bytes': 0}
+
+        async def measure():
+            tmp_spi = SpiFlashPeripheral(SpiBus.from_entity(dut, cs_name='out0'), {},
+                                         dut, name='tmp_spi1')
+
+            async def echo(first_byte):
+                # Reply with the TX bytes + 1
+                tx_bytes = bytes([first_byte]) + await tmp_spi.shift_bytes(bytes(num_bytes - 1))
+                await tmp_spi.shift_bytes(bytes((value + 1) & 0xff for value in tx_bytes))
+                stats['bytes'] += 2 * num_bytes
+
+            tmp_spi.custom_func = echo
+
+            # From the first transfer until the program is done
+            await FallingEdge(dut.out0)
+            start = get_sim_time('ns')
+            await RisingEdge(get_halt_signal(dut))
+            stats['cycles'] = round((get_sim_time('ns') - start) / CLOCK_PERIOD_NS)
+            tmp_spi.stop()
+
+        await run_program(dut, program, extra_func=measure)
+        assert get_register(dut, 6).value == 16
+        assert stats['bytes'] == 16 * 2 * num_bytes
+
+        throughput[name] = stats['bytes'] * 1000 / stats['cycles']
+        dut._log.info("%-12s %8d %8d %18.1f", name, stats['bytes'], stats['cycles'], throughput[name])
+
+    assert throughput['burst'] > throughput['single byte']
+
+if not is_gate_level_tests():
+    # The memory control bits and the commit log are only in the RTL
+
+    @cocotb.test()
+    async def benchmark_quad_spi(dut):
+        # Cycles per instruction of test_program1 with single and quad reads
+        # from the flash, with and without burst fetch, instruction cache and prefetch
+        modes = [
+            ('single', 0b000),
+            ('single+burst', 0b001),
+            ('quad', 0b100),
+            ('quad+burst', 0b101),
+            ('quad+burst+cache', 0b0111),
+            ('quad+burst+cache+prefetch', 0b1111),
+            ('quad io+burst', 0b10101),
+            ('quad io+burst+cache+prefetch', 0b11111),
+        ]
+
+        dut._log.info("%-28s %8s %14s %6s", "mode", "cycles", "instructions", "CPI")
+        cpi = {}
+        for name, mem_control_bits in modes:
+            async def set_mem_control():
+                dut.cpu1.mem_external1.mem_control_bits.value = mem_control_bits
+
+            bytes = load_binary('binaries/test_program.bin')
+            cycles = await run_program_cycles(dut, memory=bytes, extra_func=set_mem_control, quad_spi=True)
+            assert get_register(dut, 10).value == 1024
+
+            instructions = dut.commit_count.value.integer
+            cpi[name] = cycles / instructions
+            dut._log.info("%-28s %8d %14d %6.1f", name, cycles, instructions, cpi[name])
+
+        assert cpi['quad'] < cpi['single']
+        assert cpi['quad+burst'] < cpi['single+burst']
+        assert cpi['quad+burst+cache+prefetch'] < cpi['quad+burst+cache']
+        assert cpi['quad io+burst'] < cpi['quad+burst']
+
+
+
+def reference_prepare_bytes(memory_array):
+    # The previous bit by bit helpers.prepare_bytes, kept for comparison
+    bytes_array = []
+
+    for item in memory_array:
+        tmp = item
+        bits = [0] * 32
+        index = 0
+
+        while tmp > 0:
+            bits[index] = tmp % 2
+            tmp = tmp >> 1
+            index += 1
+
+        bits.reverse()
+        
+        tmp_bytes = []
+        for i in range(0, 4):
+            tmp_bits = bits[i*8:(i+1)*8]
+
+            value = 0
+            for index, val in enumerate(tmp_bits):
+                value = value | (val << (7-index))
+            tmp_bytes.append(value)
+        
+        tmp_bytes.reverse()
+        bytes_array += tmp_bytes
+
+    return bytes_array
+
+def reference_load_binary(path):
+    # The previous byte by byte helpers.load_binary, kept for comparison
+    output = []
+    with open(path, 'rb') as input_file:
+        for b in input_file.read():
+            output.append(b)
+    return output
+
+def time_call(func, *args, repeat=5):
+    # Best of repeat, in ms
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+@cocotb.test()
+async def benchmark_image_builder(dut):
+    # Build a 64 KB image from random words, like the fuzzing jobs do
+    rng = random.Random(1)
+    words = [rng.getrandbits(32) for _ in range(16384)]
+
+    old_bytes, old_words_ms = time_call(lambda: PagedMemory.from_contents(reference_prepare_bytes(words)))
+    new_bytes, new_words_ms = time_call(lambda: PagedMemory(words_to_bytes(words)))
+    assert old_bytes == new_bytes
+
+    fd, path = tempfile.mkstemp(suffix='.bin')
+    try:
+        with os.fdopen(fd, 'wb') as output_file:
+            new_bytes.tofile(output_file)
+
+        old_binary, old_binary_ms = time_call(lambda: PagedMemory.from_contents(reference_load_binary(path)))
+        new_binary, new_binary_ms = time_call(load_binary, path)
+        assert old_binary == new_binary == new_bytes
+    finally:
+        os.remove(path)
+
+    dut._log.info('Image builder, 64 KB image')
+    dut._log.info("%-16s %12s %12s", "step", "old (ms)", "new (ms)")
+    dut._log.info("%-16s %12.2f %12.2f", "words to image", old_words_ms, new_words_ms)
+    dut._log.info("%-16s %12.2f %12.2f", "load .bin", old_binary_ms, new_binary_ms)
+
+def reference_get_value(contents, address, num_bytes):
+    # The previous SpiFlashPeripheral.get_value and read_byte, on the list
+    # (flash) or dict (RAM) contents
+    value = 0
+    for i in range(0, num_bytes):
+        try:
+            byte = contents[address + i]
+        except (IndexError, KeyError):
+            byte = 0xff
+        value = (byte << (i*8)) | value
+    return value
+
+def reference_set_value(contents, address, value, num_bytes):
+    for i in range(0, num_bytes):
+        contents[address + i] = (value >> (i*8)) & 0xff
+
+def allocated_bytes(func):
+    # Bytes still allocated by the result of func
+    tracemalloc.start()
+    try:
+        result = func()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+@cocotb.test()
+async def benchmark_paged_memory(dut):
+    # Memory footprint and word access time of the flash and RAM models,
+    # PagedMemory against the previous list (flash) and dict (RAM)
+    rng = random.Random(2)
+    image = bytes(rng.getrandbits(8) for _ in range(65536))
+    ram_words = [(rng.randrange(0, 65536, 4), rng.getrandbits(32)) for _ in range(4096)]
+
+    def fill_ram(ram):
+        for address, value in ram_words:
+            if isinstance(ram, PagedMemory):
+                ram.write_word(address, value)
+            else:
+                reference_set_value(ram, address, value, 4)
+        return ram
+
+    old_flash, old_flash_size = allocated_bytes(lambda: list(image))
+    new_flash, new_flash_size = allocated_bytes(lambda: PagedMemory(image))
+    old_ram, old_ram_size = allocated_bytes(lambda: fill_ram({}))
+    new_ram, new_ram_size = allocated_bytes(lambda: fill_ram(PagedMemory()))
+
+    addresses = [rng.randrange(0, 65536 - 4) for _ in range(10000)]
+    _, old_read_ms = time_call(lambda: [reference_get_value(old_flash, a, 4) for a in addresses])
+    _, new_read_ms = time_call(lambda: [new_flash.read_word(a, 4) for a in addresses])
+    _, old_write_ms = time_call(lambda: fill_ram({}))
+    _, new_write_ms = time_call(lambda: fill_ram(PagedMemory()))
+    _, old_dump_ms = time_call(lambda: sorted(old_ram.items()))
+    _, new_dump_ms = time_call(lambda: list(new_ram.items()))
+
+    assert new_flash[:] == bytes(old_flash)
+    assert list(new_ram.items()) == sorted(old_ram.items())
+    assert all(new_flash.read_word(a, 4) == reference_get_value(old_flash, a, 4) for a in addresses[:100])
+
+    dut._log.info('Flash and RAM models, 64 KB flash image, %d RAM words', len(ram_words))
+    dut._log.info("%-24s %12s %12s", "", "old", "new")
+    dut._log.info("%-24s %12d %12d", "flash (bytes)", old_flash_size, new_flash_size)
+    dut._log.info("%-24s %12d %12d", "RAM (bytes)", old_ram_size, new_ram_size)
+    dut._log.info("%-24s %12.2f %12.2f", "10000 word reads (ms)", old_read_ms, new_read_ms)
+    dut._log.info("%-24s %12.2f %12.2f", "RAM word writes (ms)", old_write_ms, new_write_ms)
+    dut._log.info("%-24s %12.2f %12.2f", "RAM dump (ms)", old_dump_ms, new_dump_ms)
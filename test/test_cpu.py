@@ -2,7 +2,9 @@ import cocotb
 from cocotb.triggers import RisingEdge, FallingEdge, First, ClockCycles
 from cocotbext.spi import SpiBus
 
-from helpers import SpiFlashPeripheral, get_halt_signal, get_io_output_pin, get_output_pin, get_register, load_binary, assert_registers_zero, run_program, set_input_pin
+from cpu_profile import CpuProfile
+from helpers import SNAPSHOT_PC, SNAPSHOT_STATE, SpiFlashPeripheral, addi_word, get_halt_signal, get_io_output_pin, get_output_pin, get_register, is_gate_level_tests, load_binary, assert_registers_zero, run_program, run_program_cycles, set_input_pin, snapshot_registers
+from program_image import ListingError
 from cocotbext.uart import UartSink
 
 @cocotb.test()
@@ -334,6 +336,7 @@ async def test_store_sb(dut):
     assert get_register(dut, 2).value == 1234
     assert ram_chip.get_value(0, 1) == 0xD2
     assert ram_chip.get_value(8, 1) == 0xD2
+    assert ram_chip.contents[0:9] == bytes([0xD2] + [0xff] * 7 + [0xD2])
     assert_registers_zero(dut, 3)
 
 @cocotb.test()
@@ -394,6 +397,34 @@ async def test_store_and_load(dut):
 
     assert_registers_zero(dut, 5)
 
+@cocotb.test()
+async def test_store_and_load_hdl_memory(dut):
+    # Same program as test_store_and_load, using the flash and PSRAM models in tb.v
+
+    ram_chip, flash = await run_program(dut, '''
+        01c02083
+        4d210113
+        0020a023
+        0020a423
+        0000a183
+        00008203
+        0000006f
+        00010000
+        0
+        0
+        ''', hdl_memory=True)
+
+    assert get_register(dut, 1).value == 0x10000
+    assert get_register(dut, 2).value == 1234
+    assert get_register(dut, 3).value == 1234
+    assert get_register(dut, 4).value.signed_integer == -46
+
+    assert ram_chip.get_value(0, 4) == 1234
+    assert ram_chip.get_value(8, 4) == 1234
+    assert ram_chip.get_value(4, 4) == 0xffffffff
+
+    assert_registers_zero(dut, 5)
+
 @cocotb.test()
 async def test_jal(dut):
     # addi x1, x1, 10
@@ -653,4 +684,160 @@ async def test_bltu(dut):
     assert get_register(dut, 3).value == 10
     assert get_register(dut, 4).value == 0
     assert get_register(dut, 5).value == 30
-    assert_registers_zero(dut, 6)
\ No newline at end of file
+    assert_registers_zero(dut, 6)
+
+@cocotb.test()
+async def test_prefetch_alu(dut):
+    # ALU instructions and a loop with and without prefetch of the next
+    # instruction. The taken branches squash the prefetched word.
+    cycles = {}
+    instructions = 8 + 2 * 5
+
+    for mem_control_bits in [0b0011, 0b1011]:
+        cycles[mem_control_bits] = await run_program_cycles(dut, '''
+ 0x00000000	|	0x000207B7	|	lui x15, 0x20
+ 0x00000004	|	0x%08X	|	addi x2, x0, mem_control_bits
+ 0x00000008	|	0x00278C23	|	sb x2, 24(x15)
+ 0x0000000C	|	0x3E808093	|	addi x1, x1, 1000
+ 0x00000010	|	0x7D008713	|	addi x14, x1, 2000
+ 0x00000014	|	0xC1818193	|	addi x3, x3, -1000
+ 0x00000018	|	0x00370233	|	add x4, x14, x3
+ 0x0000001C	|	0x00500313	|	addi x6, x0, 5
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000020	|	0x00128293	|	addi x5, x5, 1
+ 0x00000024	|	0xFE629EE3	|	bne x5, x6, loop
+ 0x00000028	|	0x0000006F	|	jal x0, 0
+        ''', mem_control=mem_control_bits)
+
+        assert get_register(dut, 1).value == 1000
+        assert get_register(dut, 2).value == mem_control_bits
+        assert get_register(dut, 3).value.signed_integer == -1000
+        assert get_register(dut, 4).value == 2000
+        assert get_register(dut, 5).value == 5
+        assert get_register(dut, 6).value == 5
+        assert_registers_zero(dut, 7, 13)
+        assert get_register(dut, 14).value == 3000
+        assert get_register(dut, 15).value == 0x20000
+
+    dut._log.info("CPI %.1f without prefetch, %.1f with prefetch",
+                  cycles[0b0011] / instructions, cycles[0b1011] / instructions)
+    assert cycles[0b1011] < cycles[0b0011]
+
+@cocotb.test()
+async def test_register_read_cycles(dut):
+    # Clocks per instruction of a loop that runs from the instruction
+    # cache, from the difference of two loop counts so that the fetch of
+    # the first iteration and the end of the program do not count. The
+    # cache and prefetch are turned on first.
+    cycles = {}
+
+    for count in [10, 30]:
+        cycles[count] = await run_program_cycles(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x%08X	|	addi x2, x0, mem_control_bits
+ 0x00000008	|	0x00208C23	|	sb x2, 24(x1)
+ 0x0000000C	|	0x%08X	|	addi x3, x0, count
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000010	|	0x00120213	|	addi x4, x4, 1
+ 0x00000014	|	0xFE321EE3	|	bne x4, x3, loop
+ 0x00000018	|	0x0000006F	|	jal x0, 0
+        ''' % (addi_word(2, 0b1010), addi_word(3, count)))
+        assert get_register(dut, 4).value == count
+
+    cycles_per_instruction = (cycles[30] - cycles[10]) / (2 * 20)
+    dut._log.info("%.1f clocks per instruction", cycles_per_instruction)
+
+    # 1 clock to read rs1, 1 to read rs2 and parse, 16 to write back and 1
+    # to move the PC. addi continues with the prefetched bne, the taken bne
+    # fetches addi from the cache in 2 clocks.
+    assert cycles_per_instruction == (19 + 21) / 2
+
+@cocotb.test()
+async def test_snapshot_registers(dut):
+    # addi x1, x0, -10
+    # addi x2, x2, 10
+    # jal x0, 0
+
+    await run_program(dut, '''
+        FF600093
+        00A10113
+        0000006f
+        ''')
+
+    snapshot = snapshot_registers(dut)
+    assert len(snapshot) == 18
+    assert snapshot[:3] == (0, 0xfffffff6, 10)
+    assert snapshot[3:16] == (0,) * 13
+
+    # Not available in every gate level netlist
+    if snapshot[SNAPSHOT_PC] is not None:
+        assert snapshot[SNAPSHOT_PC] == 8
+    if snapshot[SNAPSHOT_STATE] is not None:
+        assert snapshot[SNAPSHOT_STATE] == 1   # STATE_FETCH_INSTRUCTION
+
+@cocotb.test()
+async def test_listing_parse_error(dut):
+    # Malformed words are reported with their line number before the program is run
+    try:
+        await run_program(dut, '''
+            00100093
+            0010009G
+            0000006f
+            ''')
+        assert False, 'expected ListingError'
+    except ListingError as e:
+        assert str(e) == "line 3: malformed word '0010009G'"
+
+if not is_gate_level_tests():
+    # The profile counters are only in the RTL testbench
+
+    @cocotb.test()
+    async def test_cpu_profile(dut):
+        # Every cycle until the halt is counted in one of the states, and in
+        # the class of the instruction that it was spent on
+        bytes = load_binary('binaries/test_program.bin')
+        cycles = await run_program_cycles(dut, memory=bytes, profile=True)
+
+        profile = CpuProfile.read(dut)
+        profile.log(dut, 'CPI profile of test_program1')
+
+        assert profile.instructions == dut.commit_count.value.integer
+        assert sum(profile.class_cycles) == profile.cycles
+        assert abs(profile.cycles - cycles) <= 1
+
+        # rs1 is read in 1 clock, rd is shifted into the register file 2 bits
+        # per clock
+        assert profile.states['read registers'] == profile.instructions
+        assert profile.states['write register'] == 16 * profile.instructions
+        assert profile.states['debug read'] == profile.states['debug TX'] == 0
+
+        # The fetches that hit the instruction cache, and the clock that a
+        # fetch is done, are not waits for the SPI bus
+        assert 0 < profile.waits['fetch'] < profile.states['fetch']
+        assert 0 < profile.spi['all'] < profile.cycles
+
+        # A loop runs from the instruction cache after the first iteration,
+        # without the cache every fetch waits for the flash
+        fetch_waits = {}
+        for mem_control_bits in [0b1001, 0b1011]:
+            await run_program_cycles(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x%08X	|	addi x2, x0, mem_control_bits
+ 0x00000008	|	0x00208C23	|	sb x2, 24(x1)
+ 0x0000000C	|	0x03200193	|	addi x3, x0, 50
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000010	|	0x00120213	|	addi x4, x4, 1
+ 0x00000014	|	0xFE321EE3	|	bne x4, x3, loop
+ 0x00000018	|	0x0000006F	|	jal x0, 0
+            ''', mem_control=mem_control_bits, profile=True)
+
+            loop_profile = CpuProfile.read(dut)
+            fetch_waits[mem_control_bits] = loop_profile.waits['fetch']
+            assert 0 < loop_profile.waits['fetch'] < loop_profile.states['fetch']
+
+        dut._log.info("%d fetch wait cycles without the instruction cache, %d with it",
+                      fetch_waits[0b1001], fetch_waits[0b1011])
+        assert fetch_waits[0b1011] < fetch_waits[0b1001]
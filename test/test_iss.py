@@ -0,0 +1,311 @@
+import ast
+import glob
+import random
+import re
+
+import pytest
+
+from helpers import addi_word, load_binary
+from iss import run_iss
+from program_image import ListingError
+
+# The instruction set simulator does not need the HDL, these are plain
+# pytest tests (pytest test_iss.py). They check that it gives the same
+# results as the tests for the HDL, the HDL is compared against it in
+# test_iss_rtl.py.
+
+def test_iss_program1():
+    iss = run_iss(memory=load_binary('binaries/test_program.bin'))
+
+    # return value of the function
+    assert iss.get_register(10).value == 1024
+
+def test_iss_store_output_pins():
+    # lw x1, 32(x0)
+    # addi x2, x2, 5
+    # sb x2, 0(x1)
+    # lb x3, 0(x1)
+    iss = run_iss('''
+        02002083
+        00510113
+        00208023
+        00008183
+        0000006f
+        0
+        0
+        0
+        00020000
+        ''')
+
+    assert iss.get_register(1).value == 0x20000
+    assert iss.get_register(2).value == 5
+    assert iss.get_register(3).value == 5
+    assert iss.peripherals.outputs_bits == 0b0101
+
+def test_iss_spi_uart():
+    def spi_func(cs_bits, tx_bytes, rx_len):
+        # return the byte + 1
+        return bytes([tx_bytes[0] + 1])
+
+    iss = run_iss(memory=load_binary('binaries/test_spi.bin'),
+                  setup_func=lambda iss: setattr(iss.peripherals, 'spi_func', spi_func))
+    assert iss.get_register(10).value == 0xab + 1
+
+    iss = run_iss(memory=load_binary('binaries/test_uart.bin'))
+    assert bytes(iss.peripherals.uart_tx) == b'hello'
+
+def test_iss_uart_fifo():
+    # Same program as test_uart_fifo_throughput, all bytes are already in the RX FIFO
+    data = bytes((i * 37 + 11) & 0xff for i in range(64))
+
+    iss = run_iss('''
+        000200B7
+        01700113
+        00208B23
+        01000593
+        00B08823
+        00100193
+        04000393
+        00308023
+        0110C203
+        00227213
+        FE020CE3
+        01A0C283
+        00508A23
+        00530333
+        00140413
+        FE7412E3
+        01B0C483
+        0000006F
+        ''', setup_func=lambda iss: iss.peripherals.uart_rx.extend(data))
+
+    assert bytes(iss.peripherals.uart_tx) == data
+    assert iss.get_register(6).value == sum(data)
+    assert iss.get_register(9).value == 0b10   # RX FIFO empty, no overrun
+
+def test_iss_dma():
+    # Same programs as test_uart_dma and test_uart_dma_rx
+    iss = run_iss('''
+        000200B7
+        00010137
+        04000193
+        00300293
+        00508B23
+        00410333
+        02120393
+        00730023
+        00120213
+        FE3218E3
+        00100413
+        00808023
+        0220A023
+        01408493
+        0290A223
+        0230A423
+        02808623
+        02C0C483
+        0024F493
+        FE048CE3
+        0110C483
+        0014F493
+        FE048CE3
+        00008023
+        0000006F
+        ''')
+    assert bytes(iss.peripherals.uart_tx) == bytes(range(33, 33 + 64))
+    assert iss.peripherals.dma_length == 0
+
+    iss = run_iss('''
+        000200B7
+        00010137
+        01A08493
+        0290A023
+        0220A223
+        00400193
+        0230A423
+        00100413
+        00808023
+        02808623
+        02C0C483
+        0024F493
+        FE048CE3
+        00012503
+        0000006F
+        ''', setup_func=lambda iss: iss.peripherals.uart_rx.extend([0x12, 0x34, 0x56, 0x78]))
+    assert iss.ram_chip.get_value(0, 4) == 0x78563412
+    assert iss.get_register(10).value == 0x78563412
+
+def test_iss_counters():
+    # Same program as test_cycle_instret_counters, the cycle counter reads
+    # the instret count
+    iss = run_iss('''
+        000200B7
+        00A00193
+        0300A383
+        00120213
+        FE321EE3
+        0300A283
+        0340A303
+        0340C403
+        407284B3
+        0000006F
+        ''')
+    assert iss.get_register(6).value == 24
+    assert iss.get_register(8).value == 25
+    assert iss.get_register(5).value == 23
+    assert iss.get_register(9).value == 21
+    assert iss.instret == 28
+
+def test_iss_spi_burst():
+    # Same program as test_spi_burst, 4 TX and 4 RX bytes, 1 TX and 2 RX
+    # bytes, then 0x77 that is clamped to 4 and 4
+    received = []
+
+    def spi_func(cs_bits, tx_bytes, rx_len):
+        received.append(tx_bytes)
+        return bytes(tx_bytes[0] + 1 + i for i in range(rx_len))
+
+    iss = run_iss('''
+        000200B7
+        04400113
+        002083A3
+        040301B7
+        20118193
+        0030A423
+        00300213
+        004082A3
+        00C0A283
+        00D0C303
+        02100113
+        002083A3
+        004082A3
+        00C0A383
+        0070C403
+        07700113
+        002083A3
+        004082A3
+        00C0A483
+        0070C503
+        0000006F
+        ''', setup_func=lambda iss: setattr(iss.peripherals, 'spi_func', spi_func))
+
+    assert received == [b'\x01\x02\x03\x04', b'\x01', b'\x01\x02\x03\x04']
+    assert iss.get_register(5).value == 0x05040302
+    assert iss.get_register(6).value == 0x03
+    assert iss.get_register(7).value == 0x0302
+    assert iss.get_register(8).value == 0x21
+    assert iss.get_register(9).value == 0x05040302
+    assert iss.get_register(10).value == 0x44
+
+def random_program(rng, length):
+    # Random ALU, load and store instructions, x15 points to the RAM and
+    # is never written. Returned as a listing for run_program.
+    words = [0x000107b7]   # lui x15, 0x10
+
+    def rd():
+        return rng.randrange(0, 15)
+
+    def reg():
+        return rng.randrange(0, 16)
+
+    for _ in range(length):
+        kind = rng.randrange(5)
+        if kind == 0:
+            # R-type: add/sub, sll, slt, sltu, xor, srl/sra, or, and
+            func3 = rng.randrange(8)
+            func7 = 0x20 if func3 in (0, 5) and rng.randrange(2) else 0
+            words.append((func7 << 25) | (reg() << 20) | (reg() << 15) | (func3 << 12) | (rd() << 7) | 0x33)
+        elif kind == 1:
+            # I-type: addi, slli, slti, sltiu, xori, srli/srai, ori, andi
+            func3 = rng.randrange(8)
+            if func3 == 1:
+                imm = rng.randrange(32)
+            elif func3 == 5:
+                imm = rng.randrange(32) | (0x400 if rng.randrange(2) else 0)
+            else:
+                imm = rng.randrange(4096)
+            words.append((imm << 20) | (reg() << 15) | (func3 << 12) | (rd() << 7) | 0x13)
+        elif kind == 2:
+            # lui or auipc
+            words.append((rng.randrange(1 << 20) << 12) | (rd() << 7) | rng.choice([0x37, 0x17]))
+        elif kind == 3:
+            # sb, sh or sw to RAM
+            func3 = rng.randrange(3)
+            offset = rng.randrange(64) & ~((1 << func3) - 1)
+            words.append(((offset >> 5) << 25) | (reg() << 20) | (15 << 15) | (func3 << 12) | ((offset & 0x1f) << 7) | 0x23)
+        else:
+            # lb, lh, lw, lbu or lhu from RAM
+            func3 = rng.choice([0, 1, 2, 4, 5])
+            offset = rng.randrange(64) & ~((1 << (func3 & 3)) - 1)
+            words.append((offset << 20) | (15 << 15) | (func3 << 12) | (rd() << 7) | 0x03)
+
+    words.append(0x0000006f)   # jal x0, 0
+    return '\n'.join('%08x' % word for word in words)
+
+# Every binary and the listings of the cocotb tests should run to the end
+# in the ISS. The listings are the strings that are passed to run_program,
+# run_program_cycles and run_timed_program, and the *_PROGRAM listings.
+
+RUNNERS = {'run_program', 'run_program_cycles', 'run_timed_program'}
+
+def find_listings(paths):
+    # (test name, listing, needs UART input) of the listings in paths
+    listings = []
+    for path in paths:
+        with open(path, encoding='utf-8') as input_file:
+            tree = ast.parse(input_file.read())
+
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and \
+                    node.targets[0].id.endswith('_PROGRAM'):
+                listings.append((node.targets[0].id, node.value.value, False))
+
+        for func in ast.walk(tree):
+            if not isinstance(func, ast.AsyncFunctionDef):
+                continue
+
+            # The programs of the tests with a UartSource wait for RX bytes
+            uart_input = any(isinstance(node, ast.Name) and node.id == 'UartSource' for node in ast.walk(func))
+
+            for node in ast.walk(func):
+                if not isinstance(node, ast.Call) or getattr(node.func, 'id', None) not in RUNNERS:
+                    continue
+
+                raw = node.args[1] if len(node.args) > 1 else None
+                raw = next((keyword.value for keyword in node.keywords if keyword.arg == 'raw'), raw)
+
+                # raw % addi_word(...) of run_program_cycles listings
+                if isinstance(raw, ast.BinOp) and isinstance(raw.op, ast.Mod):
+                    raw = raw.left
+                if isinstance(raw, ast.Constant) and isinstance(raw.value, str):
+                    listings.append(('%s:%d' % (func.name, node.lineno), raw.value, uart_input))
+    return listings
+
+LISTINGS = find_listings(sorted(glob.glob('test_*.py')))
+
+@pytest.mark.parametrize('path', sorted(glob.glob('binaries/*.bin')))
+def test_iss_binaries(path):
+    run_iss(memory=load_binary(path))
+
+@pytest.mark.parametrize('name, raw, uart_input', LISTINGS, ids=[name for name, _, _ in LISTINGS])
+def test_iss_listings(name, raw, uart_input):
+    registers = re.findall(r'0x%08X\s*\|\s*addi x(\d+), x0', raw)
+    if registers:
+        # The addi words of run_program_cycles, with a small immediate
+        raw = raw % tuple(addi_word(int(register), 10) for register in registers)
+
+    def setup(iss):
+        if uart_input:
+            iss.peripherals.uart_rx.extend(range(256))
+
+    try:
+        run_iss(raw, setup_func=setup, max_instructions=1_000_000)
+    except ListingError:
+        # test_listing_parse_error checks that this listing is malformed
+        assert name.startswith('test_listing_parse_error')
+
+def test_iss_random_programs():
+    # The programs of test_lockstep_random_stream
+    rng = random.Random(7)
+    for _ in range(20):
+        run_iss(random_program(rng, 150))
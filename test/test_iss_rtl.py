@@ -0,0 +1,149 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import cocotb
+
+from commit_trace import Trace, diff_traces
+from helpers import get_register, is_gate_level_tests, load_binary, run_program
+from iss import run_iss
+from lockstep import LockstepChecker, LockstepMismatch
+from program_image import load_listing
+from test_iss import random_program
+
+# The HDL against the instruction set simulator
+
+@cocotb.test()
+async def test_iss_matches_rtl(dut):
+    # Final registers and RAM of the HDL and the ISS should be the same
+    # addi x1, x0, -10
+    # addi x2, x2, 10
+    # bltu x1, x2,  8
+    # addi x3, x0, 10
+    # bltu x2, x1, 8
+    # addi x4, x0, 20
+    # addi x5, x0, 30
+    # lui x6, 0x10
+    # sb x5, 3(x6)
+    # sw x1, 8(x6)
+    raw = '''
+        FF600093
+        00A10113
+        0020E463
+        00A00193
+        00116463
+        01400213
+        01E00293
+        00010337
+        005301A3
+        00132423
+        0000006f
+        '''
+    ram_chip, flash_chip = await run_program(dut, raw)
+    iss = run_iss(raw)
+
+    for i in range(16):
+        assert get_register(dut, i).value == iss.get_register(i).value, 'x%d' % i
+
+    assert ram_chip.contents == iss.ram_chip.contents
+
+if not is_gate_level_tests():
+    # The commit log is only in the RTL testbench
+
+    @cocotb.test()
+    async def test_lockstep_program1(dut):
+        bytes = load_binary('binaries/test_program.bin')
+        await run_program(dut, memory=bytes, lockstep=True)
+
+        assert get_register(dut, 10).value == 1024
+
+    @cocotb.test()
+    async def test_lockstep_random_stream(dut):
+        rng = random.Random(7)
+        await run_program(dut, random_program(rng, 150), lockstep=True)
+
+    @cocotb.test()
+    async def test_lockstep_reports_mismatch(dut):
+        # The ISS gets a different addi, the checker should stop there
+        raw = '''
+            00100093
+            00200113
+            00300193
+            0000006f
+            '''
+        wrong = load_listing(raw)
+        wrong.write_word(4, 0x00500113)
+
+        errors = []
+
+        async def start_checker():
+            async def check():
+                try:
+                    await LockstepChecker(dut, wrong).run()
+                except LockstepMismatch as e:
+                    errors.append(str(e))
+            cocotb.start_soon(check())
+
+        await run_program(dut, raw, extra_func=start_checker)
+
+        assert len(errors) == 1
+        assert errors[0].startswith('lockstep mismatch at instruction 1 (pc 0x00004 instr 0x00200113')
+
+    @cocotb.test()
+    async def test_commit_trace_program1(dut):
+        # The binary and the Spike trace have an entry for every retired
+        # instruction and decode to the same entries
+        bytes = load_binary('binaries/test_program.bin')
+        trace_dir = tempfile.mkdtemp()
+        paths = [os.path.join(trace_dir, 'program1.trace'), os.path.join(trace_dir, 'program1.log')]
+
+        wall_s = []
+        for path in [None] + paths:
+            start = time.perf_counter()
+            await run_program(dut, memory=bytes, trace=path)
+            wall_s.append(time.perf_counter() - start)
+            assert get_register(dut, 10).value == 1024
+
+        dut._log.info('test_program1 wall time: %.2f s without trace, %.2f s binary, %.2f s spike', *wall_s)
+
+        binary = Trace.read(paths[0])
+        spike = Trace.read(paths[1])
+        shutil.rmtree(trace_dir)
+
+        assert len(binary) == dut.commit_count.value.integer
+        assert diff_traces(binary, spike) == []
+
+        cycles = binary.columns['cycle']
+        assert all(cycles[i] < cycles[i + 1] for i in range(len(binary) - 1))
+
+    @cocotb.test()
+    async def test_commit_trace_fields(dut):
+        raw = '''
+            00010137
+            02a00093
+            00112223
+            00412183
+            0000006f
+            '''
+        path = os.path.join(tempfile.mkdtemp(), 'fields.log')
+        await run_program(dut, raw, trace=path)
+
+        with open(path) as input_file:
+            lines = input_file.read().splitlines()
+        shutil.rmtree(os.path.dirname(path))
+
+        assert lines[:4] == [
+            'core   0: 3 0x00000000 (0x00010137) x2  0x00010000',
+            'core   0: 3 0x00000004 (0x02a00093) x1  0x0000002a',
+            'core   0: 3 0x00000008 (0x00112223) mem 0x00010004 0x0000002a',
+            'core   0: 3 0x0000000c (0x00412183) x3  0x0000002a mem 0x00010004',
+        ]
+
+        # A different store value is the first difference
+        trace = Trace.read_spike('\n'.join(lines))
+        other = Trace.read_spike('\n'.join(lines).replace('0x00010004 0x0000002a', '0x00010004 0x0000002b'))
+        output = diff_traces(trace, other)
+        assert output[0] == 'first difference at instruction 2'
+        assert output[-1] == '+ core   0: 3 0x00000008 (0x00112223) mem 0x00010004 0x0000002b'
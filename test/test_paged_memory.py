@@ -0,0 +1,69 @@
+import pytest
+
+from paged_memory import PAGE_SIZE, PagedMemory
+
+# Plain pytest tests, they do not need a simulator:
+#   pytest test_paged_memory.py
+
+def test_items_written_fill_bytes():
+    # Bytes written with the fill value are still written
+    memory = PagedMemory()
+    memory[3] = 0xff
+    memory[5] = 0x12
+    memory.write(PAGE_SIZE - 2, b'\xff\x34\xff\x56')
+
+    assert list(memory.items()) == [
+        (3, 0xff),
+        (5, 0x12),
+        (PAGE_SIZE - 2, 0xff),
+        (PAGE_SIZE - 1, 0x34),
+        (PAGE_SIZE, 0xff),
+        (PAGE_SIZE + 1, 0x56),
+    ]
+
+def test_items_full_page():
+    data = bytes(range(256)) * (PAGE_SIZE // 256)
+    memory = PagedMemory(data, base=PAGE_SIZE)
+
+    assert list(memory.items()) == [(PAGE_SIZE + i, value) for i, value in enumerate(data)]
+
+def test_items_overwrite_and_copy():
+    memory = PagedMemory.from_contents({0x10: 0xff, 0x20: 0})
+    memory[0x10] = 0x44
+    copy = memory.copy()
+    copy[0x30] = 0xff
+
+    assert list(memory.items()) == [(0x10, 0x44), (0x20, 0)]
+    assert list(copy.items()) == [(0x10, 0x44), (0x20, 0), (0x30, 0xff)]
+
+def test_items_empty():
+    memory = PagedMemory()
+    assert memory[0x1234] == 0xff
+    assert memory.read(0, 8) == b'\xff' * 8
+    assert list(memory.items()) == []
+
+def test_to_numpy():
+    np = pytest.importorskip('numpy')
+
+    data = bytes((i * 7) & 0xff for i in range(2 * PAGE_SIZE + 100))
+    memory = PagedMemory(data)
+
+    # Inside one page, a view of the page
+    view = memory.to_numpy(16, 32)
+    assert view.dtype == np.uint8
+    assert bytes(view) == data[16:48]
+    memory[16] = 0xaa
+    assert view[0] == 0xaa
+
+    # Across pages and up to the highest written address, a copy
+    assert bytes(memory.to_numpy(PAGE_SIZE - 4, 8)) == data[PAGE_SIZE - 4:PAGE_SIZE + 4]
+    assert bytes(memory.to_numpy()) == bytes(memory[:])
+    assert len(memory.to_numpy()) == len(data)
+
+def test_to_numpy_unwritten():
+    pytest.importorskip('numpy')
+
+    memory = PagedMemory()
+    memory[3 * PAGE_SIZE] = 1
+    assert bytes(memory.to_numpy(PAGE_SIZE, 4)) == b'\xff' * 4
+    assert bytes(memory.to_numpy(3 * PAGE_SIZE - 2)) == b'\xff\xff\x01'
@@ -1,9 +1,16 @@
+import csv
+import json
+import os
+import tempfile
+
 import cocotb
 from cocotb.triggers import RisingEdge, FallingEdge, First, ClockCycles
+from cocotb.utils import get_sim_time
 from cocotbext.spi import SpiBus
 
-from helpers import SpiFlashPeripheral, get_halt_signal, get_io_output_pin, get_output_pin, get_register, is_gate_level_tests, load_binary, assert_registers_zero, run_program, set_input_pin
+from helpers import CLOCK_PERIOD_NS, SpiFlashPeripheral, addi_word, get_halt_signal, get_io_output_pin, get_output_pin, get_register, is_gate_level_tests, load_binary, assert_registers_zero, run_program, run_program_cycles, set_input_pin
 from cocotbext.uart import UartSink, UartSource
+from spi_analyzer import SpiAnalyzer
 
 baudrate = 9600
 
@@ -212,6 +219,323 @@ async def test_spi_program(dut):
     # return value of the function
     assert get_register(dut, 10).value == 0xab + 1
 
+@cocotb.test()
+async def test_spi_analyzer(dut):
+    # Transactions of test_spi.bin on the flash, the PSRAM and the
+    # peripheral on OUT0, and the CSV and JSON files of them
+    async def add_spi_device():
+        tmp_spi = SpiFlashPeripheral(SpiBus.from_entity(dut,
+                                                cs_name='out0'), {},
+                                                dut, name='tmp_spi1')
+
+        async def tmp(first_byte):
+            await tmp_spi.shift2(8, first_byte + 1)
+
+        tmp_spi.custom_func = tmp
+
+    analyzer = SpiAnalyzer(dut, out_cs=0b0001)
+    await run_program(dut, memory=load_binary('binaries/test_spi.bin'),
+                      extra_func=add_spi_device, spi_analyzer=analyzer)
+    assert get_register(dut, 10).value == 0xab + 1
+
+    summary = analyzer.summary()
+    transactions = list(analyzer.transactions.rows())
+    assert analyzer.lost == 0
+    assert sum(stats['transactions'] for stats in summary['chips'].values()) == len(transactions)
+
+    # OUT0 is low from the reset until the program sets it, the transfer of
+    # the function is 0xab and the reply
+    peripheral = [t for t in transactions if t['kind'] == 'peripheral']
+    assert all(t['chip'] == 'out0' for t in peripheral)
+    assert peripheral[-1]['opcode'] == 0xab and peripheral[-1]['bytes'] == 2
+
+    # The reset is released right after the analyzer starts. The flash and
+    # the PSRAM share the bus, one at a time.
+    memory = [t for t in transactions if t['chip'] in ('flash', 'ram')]
+    assert memory[0]['chip'] == 'flash' and memory[0]['address'] == 0
+    assert all(a['cycle'] + a['duration'] <= b['cycle'] for a, b in zip(memory, memory[1:]))
+
+    for transaction in memory:
+        assert transaction['sclk'] <= transaction['duration']
+        assert transaction['opcode'] in (0x02, 0x03), transaction
+    assert summary['kinds']['data']['transactions'] > 0
+
+    # Fetches are only told apart from loads and stores in the RTL
+    if not is_gate_level_tests():
+        fetches = summary['kinds']['fetch']
+        assert memory[0]['kind'] == 'fetch'
+        assert all(t['opcode'] == 0x03 and t['chip'] == 'flash' for t in memory if t['kind'] == 'fetch')
+        assert fetches['bytes'] >= 4 * fetches['transactions'] - 4
+        assert summary['bytes_per_instruction'] > 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        analyzer.write_csv(os.path.join(directory, 'spi.csv'))
+        with open(os.path.join(directory, 'spi.csv')) as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        assert [row['kind'] for row in rows] == [t['kind'] for t in transactions]
+        assert [int(row['address']) for row in rows] == [t['address'] for t in transactions]
+
+        analyzer.write_json(os.path.join(directory, 'spi.json'))
+        with open(os.path.join(directory, 'spi.json')) as json_file:
+            data = json.load(json_file)
+        assert data['summary']['transactions'] == len(transactions)
+        assert data['transactions']['chip'] == [t['chip'] for t in transactions]
+
+@cocotb.test()
+async def test_spi_non_blocking(dut):
+    # A loop that runs from the instruction cache, which the program turns
+    # on, starts 20 peripheral transfers. The CPU continues while a transfer
+    # is running, the write to the control register only waits if the
+    # previous one is not done.
+    stats = {'frames': 0, 'retired': 0}
+    devices = []
+    tasks = []
+
+    async def count_retired():
+        # Instructions retired while CS of the peripheral is low. The store
+        # that starts a transfer runs its write back next to it and retires
+        # on the clock after CS goes high, a blocking transfer held it in
+        # parse until then.
+        while True:
+            await FallingEdge(dut.out0)
+            retired = dut.commit_count.value.integer
+            await RisingEdge(dut.out0)
+            await ClockCycles(dut.clk, 2)
+            stats['frames'] += 1
+            stats['retired'] += dut.commit_count.value.integer - retired
+
+    async def add_spi_device():
+        tmp_spi = SpiFlashPeripheral(SpiBus.from_entity(dut,
+                                                cs_name='out0'), {},
+                                                dut, name='tmp_spi1')
+
+        async def tmp(first_byte):
+            # return the byte + 1
+            await tmp_spi.shift2(8, first_byte + 1)
+
+        tmp_spi.custom_func = tmp
+        devices.append(tmp_spi)
+
+        if not is_gate_level_tests():
+            tasks.append(cocotb.start_soon(count_retired()))
+
+    cycles = await run_program_cycles(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x00200413	|	addi x8, x0, 0b0010
+ 0x00000008	|	0x00808C23	|	sb x8, 24(x1)
+ 0x0000000C	|	0x01500113	|	addi x2, x0, 21
+ 0x00000010	|	0x00208423	|	sb x2, 8(x1)
+ 0x00000014	|	0x00300193	|	addi x3, x0, 3
+ 0x00000018	|	0x01400393	|	addi x7, x0, 20
+-------------------------------------------------------------------------
+ 	loop:
+ 0x0000001C	|	0x003082A3	|	sb x3, 5(x1)
+ 0x00000020	|	0x00130313	|	addi x6, x6, 1
+ 0x00000024	|	0xFE731CE3	|	bne x6, x7, loop
+ 0x00000028	|	0x00C0C203	|	lbu x4, 12(x1)
+ 0x0000002C	|	0x0060C283	|	lbu x5, 6(x1)
+ 0x00000030	|	0x0000006F	|	jal x0, 0
+        ''', extra_func=add_spi_device)
+
+    for device in devices:
+        device.stop()
+    for task in tasks:
+        task.kill()
+
+    # The RX byte is read after the last transfer is done
+    assert get_register(dut, 4).value == 22
+    assert get_register(dut, 5).value == 1
+    assert get_register(dut, 6).value == 20
+
+    dut._log.info("20 peripheral transfers in %d cycles", cycles)
+
+    if not is_gate_level_tests():
+        dut._log.info("%d instructions retired during %d transfers", stats['retired'], stats['frames'])
+        assert stats['frames'] == 20
+        assert stats['retired'] >= stats['frames']
+
+# Both programs start 20 transfers of 4 TX and 4 RX bytes from a loop in
+# the instruction cache, and read the 4 RX bytes with lw, which waits until
+# the transfer is done. The first reads them right after the start, like a
+# CPU that is stalled for the whole transfer. The second reads the bytes of
+# the previous transfer before it starts the next one.
+SPI_WORDS_BLOCKING_PROGRAM = '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x%08X	|	addi x2, x0, mem_control
+ 0x00000008	|	0x00208C23	|	sb x2, 24(x1)
+ 0x0000000C	|	0x04400113	|	addi x2, x0, 0x44
+ 0x00000010	|	0x002083A3	|	sb x2, 7(x1)
+ 0x00000014	|	0x040301B7	|	lui x3, 0x4030
+ 0x00000018	|	0x20118193	|	addi x3, x3, 0x201
+ 0x0000001C	|	0x0030A423	|	sw x3, 8(x1)
+ 0x00000020	|	0x00300193	|	addi x3, x0, 3
+ 0x00000024	|	0x01400393	|	addi x7, x0, 20
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000028	|	0x003082A3	|	sb x3, 5(x1)
+ 0x0000002C	|	0x00C0A203	|	lw x4, 12(x1)
+ 0x00000030	|	0x00130313	|	addi x6, x6, 1
+ 0x00000034	|	0xFE731AE3	|	bne x6, x7, loop
+-------------------------------------------------------------------------
+ 0x00000038	|	0x00C0A283	|	lw x5, 12(x1)
+ 0x0000003C	|	0x0060C403	|	lbu x8, 6(x1)
+ 0x00000040	|	0x0000006F	|	jal x0, 0
+'''
+
+SPI_WORDS_NON_BLOCKING_PROGRAM = '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x%08X	|	addi x2, x0, mem_control
+ 0x00000008	|	0x00208C23	|	sb x2, 24(x1)
+ 0x0000000C	|	0x04400113	|	addi x2, x0, 0x44
+ 0x00000010	|	0x002083A3	|	sb x2, 7(x1)
+ 0x00000014	|	0x040301B7	|	lui x3, 0x4030
+ 0x00000018	|	0x20118193	|	addi x3, x3, 0x201
+ 0x0000001C	|	0x0030A423	|	sw x3, 8(x1)
+ 0x00000020	|	0x00300193	|	addi x3, x0, 3
+ 0x00000024	|	0x01400393	|	addi x7, x0, 20
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000028	|	0x00C0A203	|	lw x4, 12(x1)
+ 0x0000002C	|	0x003082A3	|	sb x3, 5(x1)
+ 0x00000030	|	0x00130313	|	addi x6, x6, 1
+ 0x00000034	|	0xFE731AE3	|	bne x6, x7, loop
+-------------------------------------------------------------------------
+ 0x00000038	|	0x00C0A283	|	lw x5, 12(x1)
+ 0x0000003C	|	0x0060C403	|	lbu x8, 6(x1)
+ 0x00000040	|	0x0000006F	|	jal x0, 0
+'''
+
+@cocotb.test()
+async def test_spi_non_blocking_words(dut):
+    # The SPI_WORDS programs with the instruction cache on, against a device
+    # that replies with the first TX byte + 1, + 2, ...
+    cycles = {}
+    retired = {}
+
+    for name, program in [('blocking', SPI_WORDS_BLOCKING_PROGRAM),
+                          ('non-blocking', SPI_WORDS_NON_BLOCKING_PROGRAM)]:
+        frames = []
+        received = []
+        devices = []
+        tasks = []
+
+        async def count_retired():
+            # Instructions retired while CS of the peripheral is low
+            while True:
+                await FallingEdge(dut.out0)
+                start = dut.commit_count.value.integer
+                await RisingEdge(dut.out0)
+                frames.append(dut.commit_count.value.integer - start)
+
+        async def add_spi_device():
+            tmp_spi = SpiFlashPeripheral(SpiBus.from_entity(dut,
+                                                    cs_name='out0'), {},
+                                                    dut, name='tmp_spi1')
+
+            async def reply(first_byte):
+                tx_bytes = bytes([first_byte]) + await tmp_spi.shift_bytes(bytes(3))
+                received.append(tx_bytes)
+                await tmp_spi.shift_bytes(bytes(tx_bytes[0] + 1 + i for i in range(4)))
+
+            tmp_spi.custom_func = reply
+            devices.append(tmp_spi)
+
+            if not is_gate_level_tests():
+                tasks.append(cocotb.start_soon(count_retired()))
+
+        cycles[name] = await run_program_cycles(dut, program, mem_control=0b0010,
+                                                extra_func=add_spi_device)
+
+        for device in devices:
+            device.stop()
+        for task in tasks:
+            task.kill()
+
+        assert received == [b'\x01\x02\x03\x04'] * 20
+        assert get_register(dut, 4).value == 0x05040302
+        assert get_register(dut, 5).value == 0x05040302
+        assert get_register(dut, 6).value == 20
+        assert get_register(dut, 8).value == 1     # the last transfer is done
+
+        if not is_gate_level_tests():
+            assert len(frames) == 20
+            retired[name] = frames
+            dut._log.info("%-12s: 20 transfers in %d cycles, %d instructions retired during them",
+                          name, cycles[name], sum(frames))
+
+    dut._log.info("non-blocking: %d of %d cycles", cycles['non-blocking'], cycles['blocking'])
+
+    if not is_gate_level_tests():
+        # Only the store that starts a transfer retires while the blocking
+        # lw waits. In the non-blocking order the addi and the bne retire
+        # too, except in the first iteration, which is fetched from the
+        # flash after the transfer.
+        assert retired['blocking'] == [1] * 20
+        assert retired['non-blocking'] == [1] + [3] * 19
+
+    # At least 19 clocks for each of the 2 instructions in 19 iterations
+    assert cycles['blocking'] - cycles['non-blocking'] >= 19 * 2 * 19
+
+@cocotb.test()
+async def test_spi_burst(dut):
+    # 4 TX and 4 RX bytes under one CS, then 1 TX and 2 RX bytes, then 0x77
+    # that is clamped to 4 and 4 like the ISS. The device replies with the
+    # first TX byte + 1, + 2, ...
+    frames = [(4, 4), (1, 2), (4, 4)]
+    received = []
+    devices = []
+
+    async def add_spi_device():
+        tmp_spi = SpiFlashPeripheral(SpiBus.from_entity(dut,
+                                                cs_name='out0'), {},
+                                                dut, name='tmp_spi1')
+
+        async def reply(first_byte):
+            tx_len, rx_len = frames.pop(0)
+            tx_bytes = bytes([first_byte]) + await tmp_spi.shift_bytes(bytes(tx_len - 1))
+            received.append(tx_bytes)
+            await tmp_spi.shift_bytes(bytes(tx_bytes[0] + 1 + i for i in range(rx_len)))
+
+        tmp_spi.custom_func = reply
+        devices.append(tmp_spi)
+
+    await run_program(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x04400113	|	addi x2, x0, 0x44
+ 0x00000008	|	0x002083A3	|	sb x2, 7(x1)
+ 0x0000000C	|	0x040301B7	|	lui x3, 0x4030
+ 0x00000010	|	0x20118193	|	addi x3, x3, 0x201
+ 0x00000014	|	0x0030A423	|	sw x3, 8(x1)
+ 0x00000018	|	0x00300213	|	addi x4, x0, 3
+ 0x0000001C	|	0x004082A3	|	sb x4, 5(x1)
+ 0x00000020	|	0x00C0A283	|	lw x5, 12(x1)
+ 0x00000024	|	0x00D0C303	|	lbu x6, 13(x1)
+ 0x00000028	|	0x02100113	|	addi x2, x0, 0x21
+ 0x0000002C	|	0x002083A3	|	sb x2, 7(x1)
+ 0x00000030	|	0x004082A3	|	sb x4, 5(x1)
+ 0x00000034	|	0x00C0A383	|	lw x7, 12(x1)
+ 0x00000038	|	0x0070C403	|	lbu x8, 7(x1)
+ 0x0000003C	|	0x07700113	|	addi x2, x0, 0x77
+ 0x00000040	|	0x002083A3	|	sb x2, 7(x1)
+ 0x00000044	|	0x004082A3	|	sb x4, 5(x1)
+ 0x00000048	|	0x00C0A483	|	lw x9, 12(x1)
+ 0x0000004C	|	0x0070C503	|	lbu x10, 7(x1)
+ 0x00000050	|	0x0000006F	|	jal x0, 0
+        ''', extra_func=add_spi_device)
+
+    for device in devices:
+        device.stop()
+
+    assert received == [b'\x01\x02\x03\x04', b'\x01', b'\x01\x02\x03\x04']
+
+    # The first received byte is at 0x2000C, bytes that were not received are 0
+    assert get_register(dut, 5).value == 0x05040302
+    assert get_register(dut, 6).value == 0x03
+    assert get_register(dut, 7).value == 0x0302
+    assert get_register(dut, 8).value == 0x21
+    assert get_register(dut, 9).value == 0x05040302
+    assert get_register(dut, 10).value == 0x44
+
 @cocotb.test()
 async def test_program1(dut):
 
@@ -223,6 +547,200 @@ async def test_program1(dut):
     # return value of the function
     assert get_register(dut, 10).value == 1024
 
+@cocotb.test()
+async def test_program1_hdl_memory(dut):
+
+    bytes = load_binary('binaries/test_program.bin')
+    ram_chip, flash_chip = await run_program(dut, memory=bytes, hdl_memory=True)
+
+    # return value of the function
+    assert get_register(dut, 10).value == 1024
+
+@cocotb.test()
+async def test_mem_control_register(dut):
+    # every mode is off after reset, and the bits read back what is written
+    ram_chip, flash_chip = await run_program(dut, '''
+ 0x00000000	|	0x01C02083	|	lw x1, peripherals
+ 0x00000004	|	0x0180C103	|	lbu x2, 24(x1)
+ 0x00000008	|	0x00B00213	|	addi x4, x0, 0b1011
+ 0x0000000C	|	0x00408C23	|	sb x4, 24(x1)
+ 0x00000010	|	0x0180C183	|	lbu x3, 24(x1)
+ 0x00000014	|	0x00120293	|	addi x5, x4, 1
+ 0x00000018	|	0x0000006F	|	jal x0, 0
+-------------------------------------------------------------------------
+ Data Dump
+-------------------------------------------------------------------------
+ 0x0000001C	|	0x00020000	|	..
+        ''')
+
+    assert get_register(dut, 1).value == 0x20000
+    assert get_register(dut, 2).value == 0
+    assert get_register(dut, 3).value == 0b1011
+    assert get_register(dut, 4).value == 0b1011
+    assert get_register(dut, 5).value == 0b1100
+    assert_registers_zero(dut, 6)
+
+@cocotb.test()
+async def test_mem_request_not_io(dut):
+    # A store to the RAM at 0x10018 has the low address byte of the memory
+    # control register, it must only write the RAM. The IO registers only
+    # take requests to the peripherals.
+    ram_chip, flash_chip = await run_program(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x00010137	|	lui x2, 0x10
+ 0x00000008	|	0x00B00193	|	addi x3, x0, 0b1011
+ 0x0000000C	|	0x00310C23	|	sb x3, 24(x2)
+ 0x00000010	|	0x0180C203	|	lbu x4, 24(x1)
+ 0x00000014	|	0x01814283	|	lbu x5, 24(x2)
+ 0x00000018	|	0x0180C303	|	lbu x6, 24(x1)
+ 0x0000001C	|	0x0000006F	|	jal x0, 0
+        ''')
+
+    # Read twice, a memory request also must not leave the IO request done
+    # for the next read
+    assert get_register(dut, 4).value == 0
+    assert get_register(dut, 5).value == 0b1011
+    assert get_register(dut, 6).value == 0
+    assert ram_chip.get_value(0x18, 1) == 0b1011
+
+async def count_cs1_frames(dut, stats):
+    # Counts the SPI transactions on the flash until the task is killed
+    while True:
+        await FallingEdge(dut.cs1)
+        stats['frames'] += 1
+
+@cocotb.test()
+async def test_icache_loop(dut):
+    # 2 instruction loop that runs 50 times, with the instruction cache it is
+    # only fetched over SPI in the first iteration
+    results = {}
+
+    for mem_control_bits in [0b01, 0b11]:
+        stats = {'frames': 0}
+        frames_task = None
+
+        async def count_frames():
+            nonlocal frames_task
+            frames_task = cocotb.start_soon(count_cs1_frames(dut, stats))
+
+        cycles = await run_program_cycles(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x%08X	|	addi x2, x0, mem_control_bits
+ 0x00000008	|	0x00208C23	|	sb x2, 24(x1)
+ 0x0000000C	|	0x03200193	|	addi x3, x0, 50
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000010	|	0x00120213	|	addi x4, x4, 1
+ 0x00000014	|	0xFE321EE3	|	bne x4, x3, loop
+ 0x00000018	|	0x0000006F	|	jal x0, 0
+        ''', mem_control=mem_control_bits, extra_func=count_frames)
+        frames_task.kill()
+
+        assert get_register(dut, 4).value == 50
+
+        if is_gate_level_tests():
+            hits, misses = None, None
+        else:
+            hits = dut.cpu1.mem_external1.icache1.hits.value.integer
+            misses = dut.cpu1.mem_external1.icache1.misses.value.integer
+
+        results[mem_control_bits] = (stats['frames'], hits, misses, cycles)
+        dut._log.info("icache %s: %d cycles, %d CS1 frames, %s hits, %s misses",
+                      'on' if mem_control_bits & 0b10 else 'off', cycles, stats['frames'], hits, misses)
+
+    frames_off, hits_off, _, cycles_off = results[0b01]
+    frames_on, hits_on, misses_on, cycles_on = results[0b11]
+
+    assert frames_off >= 50
+    # burst fetch is off after reset, the instructions up to the sb are
+    # fetched in their own transactions
+    assert frames_on <= 4
+    assert cycles_on < cycles_off
+
+    if not is_gate_level_tests():
+        # 105 instructions are fetched, the 3 up to the sb with the cache
+        # still off, the 4 different words after it miss once
+        assert hits_off == 0
+        assert misses_on == 4
+        assert hits_on == 105 - 3 - 4
+
+@cocotb.test()
+async def test_mem_control_baseline(dut):
+    # Timing with every mode of 0x20018 off, as after reset: each instruction
+    # is fetched in its own CS1 transaction of command, address and data.
+    # From the difference of two loop counts, like test_register_read_cycles.
+    cycles = {}
+    frames = {}
+
+    for count in [10, 30]:
+        stats = {'frames': 0}
+        frames_task = None
+
+        async def count_frames():
+            nonlocal frames_task
+            frames_task = cocotb.start_soon(count_cs1_frames(dut, stats))
+
+        cycles[count] = await run_program_cycles(dut, '''
+ 0x00000000	|	0x%08X	|	addi x3, x0, count
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000004	|	0x00120213	|	addi x4, x4, 1
+ 0x00000008	|	0xFE321EE3	|	bne x4, x3, loop
+ 0x0000000C	|	0x0000006F	|	jal x0, 0
+        ''' % addi_word(3, count), extra_func=count_frames)
+        frames_task.kill()
+        frames[count] = stats['frames']
+
+        assert get_register(dut, 4).value == count
+
+    cycles_per_instruction = (cycles[30] - cycles[10]) / (2 * 20)
+    frames_per_instruction = (frames[30] - frames[10]) / (2 * 20)
+    dut._log.info("%.1f clocks and %.1f CS1 frames per instruction", cycles_per_instruction, frames_per_instruction)
+
+    # 19 clocks to execute, see test_register_read_cycles, and 66 to fetch:
+    # 64 bits of command, address and data and 2 to start and end the frame
+    assert frames_per_instruction == 1
+    assert cycles_per_instruction == 19 + 66
+
+@cocotb.test()
+async def test_quad_read(dut):
+    # Same program with single, quad output (0x6B) and quad I/O (0xEB) reads
+    # from the flash, the instruction cache is off so that the loop is
+    # fetched from the flash every time
+    cycles = {}
+
+    for mem_control_bits in [0b00001, 0b00101, 0b10101]:
+        cycles[mem_control_bits] = await run_program_cycles(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x%08X	|	addi x2, x0, mem_control_bits
+ 0x00000008	|	0x00208C23	|	sb x2, 24(x1)
+ 0x0000000C	|	0x02802283	|	lw x5, 40(x0)
+ 0x00000010	|	0x02904303	|	lbu x6, 41(x0)
+ 0x00000014	|	0x00500193	|	addi x3, x0, 5
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000018	|	0x00120213	|	addi x4, x4, 1
+ 0x0000001C	|	0xFE321EE3	|	bne x4, x3, loop
+ 0x00000020	|	0x0180C383	|	lbu x7, 24(x1)
+ 0x00000024	|	0x0000006F	|	jal x0, 0
+-------------------------------------------------------------------------
+ Data Dump
+-------------------------------------------------------------------------
+ 0x00000028	|	0x12345678	|	..
+        ''', mem_control=mem_control_bits, quad_spi=True)
+
+        assert get_register(dut, 4).value == 5
+        assert get_register(dut, 5).value == 0x12345678
+        assert get_register(dut, 6).value == 0x56
+        assert get_register(dut, 7).value == mem_control_bits
+
+        # The CPU does not drive IO3-IO6 or MOSI while the flash drives IO0-IO3
+        assert dut.flash_quad_conflict.value == 0
+
+    dut._log.info("%d cycles with single reads, %d with 0x6B, %d with 0xEB",
+                  cycles[0b00001], cycles[0b00101], cycles[0b10101])
+    assert cycles[0b10101] < cycles[0b00101] < cycles[0b00001]
+
 @cocotb.test()
 async def test_program3(dut):
     # program sets output pins and reads input pins
@@ -494,6 +1012,39 @@ Data Dump
     assert_registers_zero(dut, 5)
 
 if not is_gate_level_tests():
+    async def measure_program1(dut, mem_control_bits):
+        # Returns the cycles until the CPU halts and the number of CS1 frames
+        stats = {'frames': 0}
+        tasks = []
+
+        async def count_frames():
+            dut.cpu1.mem_external1.mem_control_bits.value = mem_control_bits
+            tasks.append(cocotb.start_soon(count_cs1_frames(dut, stats)))
+
+        bytes = load_binary('binaries/test_program.bin')
+        cycles = await run_program_cycles(dut, memory=bytes, extra_func=count_frames)
+        tasks[0].kill()
+        assert get_register(dut, 10).value == 1024
+
+        return cycles, stats['frames']
+
+    @cocotb.test()
+    async def test_program1_burst_fetch(dut):
+        # Sequential fetches only clock the 32 data bits, instead of the
+        # command, address and data. The instruction cache is off for both.
+        cycles, frames = await measure_program1(dut, 0b00)
+        burst_cycles, burst_frames = await measure_program1(dut, 0b01)
+
+        saved = cycles - burst_cycles
+        dut._log.info("test_program1: %d cycles, %d CS1 frames without burst, %d cycles, %d CS1 frames with burst",
+                      cycles, frames, burst_cycles, burst_frames)
+        dut._log.info("%d cycles saved, %.1f per fetch that continued a burst",
+                      saved, saved / (frames - burst_frames))
+
+        assert burst_frames < frames
+        # 32 clocks per continued fetch, minus 1 clock for every burst that is ended
+        assert saved > 30 * (frames - burst_frames)
+
     # this is not passing in gl_test
     @cocotb.test()
     async def test_program5_uart_tx(dut):
@@ -779,6 +1330,293 @@ async def test_uart_rx_flow_control (dut):
     assert_registers_zero(dut, 7)
     
 
+@cocotb.test()
+async def test_uart_fifo_mode(dut):
+    # Without the FIFO mode, a byte written to 0x20014 is only sent with bit 0
+    # of the control register, which reads 1 while it is sent. With it, the
+    # byte is sent right away.
+    uart_sink = UartSink(dut.uart_tx, baud=baudrate, bits=8)
+
+    await run_program(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x04100113	|	addi x2, x0, 0x41
+ 0x00000008	|	0x00208A23	|	sb x2, 20(x1)
+ 0x0000000C	|	0x0110C183	|	lbu x3, 17(x1)
+ 0x00000010	|	0x00100213	|	addi x4, x0, 1
+ 0x00000014	|	0x00408823	|	sb x4, 16(x1)
+ 0x00000018	|	0x0100C283	|	lbu x5, 16(x1)
+-------------------------------------------------------------------------
+ 	wait_sent:
+ 0x0000001C	|	0x0110C303	|	lbu x6, 17(x1)
+ 0x00000020	|	0x00137313	|	andi x6, x6, 1
+ 0x00000024	|	0xFE030CE3	|	beq x6, x0, wait_sent
+ 0x00000028	|	0x0100C383	|	lbu x7, 16(x1)
+ 0x0000002C	|	0x01000413	|	addi x8, x0, 0b10000
+ 0x00000030	|	0x00808823	|	sb x8, 16(x1)
+ 0x00000034	|	0x04200113	|	addi x2, x0, 0x42
+ 0x00000038	|	0x00208A23	|	sb x2, 20(x1)
+-------------------------------------------------------------------------
+ 	wait_sent_2:
+ 0x0000003C	|	0x0110C303	|	lbu x6, 17(x1)
+ 0x00000040	|	0x00137313	|	andi x6, x6, 1
+ 0x00000044	|	0xFE030CE3	|	beq x6, x0, wait_sent_2
+ 0x00000048	|	0x0100C483	|	lbu x9, 16(x1)
+ 0x0000004C	|	0x0000006F	|	jal x0, 0
+        ''', timeout_us=4000)
+
+    assert bytes(uart_sink.read_nowait()) == b'AB'
+
+    assert get_register(dut, 3).value == 0          # not sent by the write to 0x20014
+    assert get_register(dut, 5).value == 1          # sending
+    assert get_register(dut, 7).value == 0
+    assert get_register(dut, 9).value == 0b10000    # FIFO mode
+
+@cocotb.test()
+async def test_uart_fifo_throughput(dut):
+    # Bytes are sent back to back at 24MHz / (2 * (23 + 1)) = 500k baud
+    # without flow control. The program echoes each byte and keeps a checksum.
+    # The loop needs about 400 clocks with burst fetch, the instruction cache
+    # and prefetch on, a byte is received every 480 clocks, the FIFOs hold
+    # the bytes that arrive while the loop is fetched.
+    fast_baudrate = 500000
+    data = bytes((i * 37 + 11) & 0xff for i in range(64))
+    stats = {}
+
+    uart_sink = UartSink(dut.uart_tx, baud=fast_baudrate, bits=8)
+
+    async def add_uart_device():
+        uart_source = UartSource(dut.uart_rx, baud=fast_baudrate, bits=8)
+        await RisingEdge(dut.out0)  # the program has set the baud rate
+
+        stats['start'] = get_sim_time('ns')
+        await uart_source.write(data)
+
+    await run_program(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x00B00513	|	addi x10, x0, 0b1011
+ 0x00000008	|	0x00A08C23	|	sb x10, 24(x1)
+ 0x0000000C	|	0x01700113	|	addi x2, x0, 23
+ 0x00000010	|	0x00208B23	|	sb x2, 22(x1)
+ 0x00000014	|	0x01000593	|	addi x11, x0, 0b10000
+ 0x00000018	|	0x00B08823	|	sb x11, 16(x1)
+ 0x0000001C	|	0x00100193	|	addi x3, x0, 1
+ 0x00000020	|	0x04000393	|	addi x7, x0, 64
+ 0x00000024	|	0x00308023	|	sb x3, 0(x1)
+-------------------------------------------------------------------------
+ 	loop:
+ 0x00000028	|	0x0110C203	|	lbu x4, 17(x1)
+ 0x0000002C	|	0x00227213	|	andi x4, x4, 2
+ 0x00000030	|	0xFE020CE3	|	beq x4, x0, loop
+ 0x00000034	|	0x01A0C283	|	lbu x5, 26(x1)
+ 0x00000038	|	0x00508A23	|	sb x5, 20(x1)
+ 0x0000003C	|	0x00530333	|	add x6, x6, x5
+ 0x00000040	|	0x00140413	|	addi x8, x8, 1
+ 0x00000044	|	0xFE7412E3	|	bne x8, x7, loop
+ 0x00000048	|	0x01B0C483	|	lbu x9, 27(x1)
+ 0x0000004C	|	0x0000006F	|	jal x0, 0
+        ''', extra_func=add_uart_device, timeout_us=3000)
+
+    # Until the last byte is echoed
+    await ClockCycles(dut.clk, 2 * 24000000 // fast_baudrate * 10)
+    echoed = uart_sink.read_nowait()
+    cycles = round((get_sim_time('ns') - stats['start']) / CLOCK_PERIOD_NS)
+    dut._log.info("%d bytes received and echoed in %d cycles, %.1f bytes / 1000 clk",
+                  len(data), cycles, len(data) * 1000 / cycles)
+
+    assert bytes(echoed) == data
+
+    assert get_register(dut, 6).value == sum(data)
+    assert get_register(dut, 8).value == len(data)
+    assert get_register(dut, 9).value & 0b1000 == 0    # no RX overrun
+
+
+# Both programs turn the instruction cache and prefetch on, write 64 bytes
+# to the RAM at 0x10000, set OUT0 and send the bytes to the UART at 3M baud
+# (baud counter 3). OUT0 is cleared once all bytes are sent. The first
+# turns the UART FIFO mode on and copies each byte with a load and a store,
+# the second starts a DMA transfer from 0x10000 to 0x20014.
+UART_CPU_COPY_PROGRAM = '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x00A00513	|	addi x10, x0, 0b1010
+ 0x00000008	|	0x00A08C23	|	sb x10, 24(x1)
+ 0x0000000C	|	0x00010137	|	lui x2, 0x10
+ 0x00000010	|	0x04000193	|	addi x3, x0, 64
+ 0x00000014	|	0x00300293	|	addi x5, x0, 3
+ 0x00000018	|	0x00508B23	|	sb x5, 22(x1)
+ 0x0000001C	|	0x01000593	|	addi x11, x0, 0b10000
+ 0x00000020	|	0x00B08823	|	sb x11, 16(x1)
+-------------------------------------------------------------------------
+ 	fill:
+ 0x00000024	|	0x00410333	|	add x6, x2, x4
+ 0x00000028	|	0x02120393	|	addi x7, x4, 33
+ 0x0000002C	|	0x00730023	|	sb x7, 0(x6)
+ 0x00000030	|	0x00120213	|	addi x4, x4, 1
+ 0x00000034	|	0xFE3218E3	|	bne x4, x3, fill
+ 0x00000038	|	0x00100413	|	addi x8, x0, 1
+ 0x0000003C	|	0x00808023	|	sb x8, 0(x1)
+ 0x00000040	|	0x00000213	|	addi x4, x0, 0
+-------------------------------------------------------------------------
+ 	copy:
+ 0x00000044	|	0x01B0C483	|	lbu x9, 27(x1)
+ 0x00000048	|	0x0044F493	|	andi x9, x9, 4
+ 0x0000004C	|	0xFE049CE3	|	bne x9, x0, copy
+ 0x00000050	|	0x00410333	|	add x6, x2, x4
+ 0x00000054	|	0x00034383	|	lbu x7, 0(x6)
+ 0x00000058	|	0x00708A23	|	sb x7, 20(x1)
+ 0x0000005C	|	0x00120213	|	addi x4, x4, 1
+ 0x00000060	|	0xFE3212E3	|	bne x4, x3, copy
+-------------------------------------------------------------------------
+ 	wait_sent:
+ 0x00000064	|	0x0110C483	|	lbu x9, 17(x1)
+ 0x00000068	|	0x0014F493	|	andi x9, x9, 1
+ 0x0000006C	|	0xFE048CE3	|	beq x9, x0, wait_sent
+ 0x00000070	|	0x00008023	|	sb x0, 0(x1)
+ 0x00000074	|	0x0000006F	|	jal x0, 0
+'''
+
+UART_DMA_PROGRAM = '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x00A00513	|	addi x10, x0, 0b1010
+ 0x00000008	|	0x00A08C23	|	sb x10, 24(x1)
+ 0x0000000C	|	0x00010137	|	lui x2, 0x10
+ 0x00000010	|	0x04000193	|	addi x3, x0, 64
+ 0x00000014	|	0x00300293	|	addi x5, x0, 3
+ 0x00000018	|	0x00508B23	|	sb x5, 22(x1)
+-------------------------------------------------------------------------
+ 	fill:
+ 0x0000001C	|	0x00410333	|	add x6, x2, x4
+ 0x00000020	|	0x02120393	|	addi x7, x4, 33
+ 0x00000024	|	0x00730023	|	sb x7, 0(x6)
+ 0x00000028	|	0x00120213	|	addi x4, x4, 1
+ 0x0000002C	|	0xFE3218E3	|	bne x4, x3, fill
+ 0x00000030	|	0x00100413	|	addi x8, x0, 1
+ 0x00000034	|	0x00808023	|	sb x8, 0(x1)
+ 0x00000038	|	0x0220A023	|	sw x2, 32(x1)
+ 0x0000003C	|	0x01408493	|	addi x9, x1, 20
+ 0x00000040	|	0x0290A223	|	sw x9, 36(x1)
+ 0x00000044	|	0x0230A423	|	sw x3, 40(x1)
+ 0x00000048	|	0x02808623	|	sb x8, 44(x1)
+-------------------------------------------------------------------------
+ 	wait_dma:
+ 0x0000004C	|	0x02C0C483	|	lbu x9, 44(x1)
+ 0x00000050	|	0x0024F493	|	andi x9, x9, 2
+ 0x00000054	|	0xFE048CE3	|	beq x9, x0, wait_dma
+-------------------------------------------------------------------------
+ 	wait_sent:
+ 0x00000058	|	0x0110C483	|	lbu x9, 17(x1)
+ 0x0000005C	|	0x0014F493	|	andi x9, x9, 1
+ 0x00000060	|	0xFE048CE3	|	beq x9, x0, wait_sent
+ 0x00000064	|	0x00008023	|	sb x0, 0(x1)
+ 0x00000068	|	0x0000006F	|	jal x0, 0
+'''
+
+@cocotb.test()
+async def test_uart_dma(dut):
+    fast_baudrate = 3000000
+    data = bytes(range(33, 33 + 64))
+
+    cycles = {}
+    for name, program in [('cpu copy', UART_CPU_COPY_PROGRAM), ('dma', UART_DMA_PROGRAM)]:
+        uart_sink = UartSink(dut.uart_tx, baud=fast_baudrate, bits=8)
+
+        async def measure():
+            await RisingEdge(dut.out0)
+            start = get_sim_time('ns')
+            await FallingEdge(dut.out0)
+            cycles[name] = round((get_sim_time('ns') - start) / CLOCK_PERIOD_NS)
+
+        await run_program(dut, program, extra_func=measure)
+
+        assert bytes(uart_sink.read_nowait()) == data
+        dut._log.info("%-8s: 64 bytes sent in %d cycles", name, cycles[name])
+
+    # The DMA keeps up with the UART, a byte takes 80 clocks
+    assert cycles['dma'] < 64 * 100
+    assert cycles['dma'] < cycles['cpu copy']
+
+
+@cocotb.test()
+async def test_uart_dma_rx(dut):
+    # DMA from the RX FIFO (0x2001A) to the RAM, the transfer waits for each byte
+
+    async def add_uart_device():
+        uart_source = UartSource(dut.uart_rx, baud=baudrate, bits=8)
+        await RisingEdge(dut.out0)  # the transfer is started
+
+        await uart_source.write([0x12, 0x34, 0x56, 0x78])
+
+    ram_chip, flash_chip = await run_program(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x00010137	|	lui x2, 0x10
+ 0x00000008	|	0x01A08493	|	addi x9, x1, 26
+ 0x0000000C	|	0x0290A023	|	sw x9, 32(x1)
+ 0x00000010	|	0x0220A223	|	sw x2, 36(x1)
+ 0x00000014	|	0x00400193	|	addi x3, x0, 4
+ 0x00000018	|	0x0230A423	|	sw x3, 40(x1)
+ 0x0000001C	|	0x00100413	|	addi x8, x0, 1
+ 0x00000020	|	0x00808023	|	sb x8, 0(x1)
+ 0x00000024	|	0x02808623	|	sb x8, 44(x1)
+-------------------------------------------------------------------------
+ 	wait_dma:
+ 0x00000028	|	0x02C0C483	|	lbu x9, 44(x1)
+ 0x0000002C	|	0x0024F493	|	andi x9, x9, 2
+ 0x00000030	|	0xFE048CE3	|	beq x9, x0, wait_dma
+ 0x00000034	|	0x00012503	|	lw x10, 0(x2)
+ 0x00000038	|	0x0000006F	|	jal x0, 0
+        ''', extra_func=add_uart_device, timeout_us=6000)
+
+    assert ram_chip.get_value(0, 4) == 0x78563412
+    assert get_register(dut, 3).value == 4
+    assert get_register(dut, 9).value == 2
+    assert get_register(dut, 10).value == 0x78563412
+
+
+@cocotb.test()
+async def test_cycle_instret_counters(dut):
+    # Reads the cycle and instret counters before and after a loop, and
+    # compares them with the clocks counted here and the commit log of tb.v
+    stats = {}
+
+    async def count_cycles():
+        # Reset is released when extra_func is started
+        start = get_sim_time('ns')
+        await RisingEdge(get_halt_signal(dut))
+        stats['cycles'] = round((get_sim_time('ns') - start) / CLOCK_PERIOD_NS)
+        if not is_gate_level_tests():
+            stats['cycle_count'] = dut.cpu1.cycle_count.value.integer
+            stats['commit_count'] = dut.commit_count.value.integer
+
+    await run_program(dut, '''
+ 0x00000000	|	0x000200B7	|	lui x1, 0x20
+ 0x00000004	|	0x00A00193	|	addi x3, x0, 10
+ 0x00000008	|	0x0300A383	|	lw x7, 48(x1)
+-------------------------------------------------------------------------
+ 	loop:
+ 0x0000000C	|	0x00120213	|	addi x4, x4, 1
+ 0x00000010	|	0xFE321EE3	|	bne x4, x3, loop
+ 0x00000014	|	0x0300A283	|	lw x5, 48(x1)
+ 0x00000018	|	0x0340A303	|	lw x6, 52(x1)
+ 0x0000001C	|	0x0340C403	|	lbu x8, 52(x1)
+ 0x00000020	|	0x407284B3	|	sub x9, x5, x7
+ 0x00000024	|	0x0000006F	|	jal x0, 0
+        ''', extra_func=count_cycles)
+
+    # 3 + 2 * 10 + 1 instructions before lw x6
+    assert get_register(dut, 6).value == 24
+    assert get_register(dut, 8).value == 25
+
+    # Cycles up to the second read, and between the two reads
+    cycles_at_read = int(get_register(dut, 5).value)
+    assert 0 < cycles_at_read < stats['cycles']
+    assert int(get_register(dut, 9).value) == cycles_at_read - int(get_register(dut, 7).value)
+    assert int(get_register(dut, 9).value) > 10 * 2
+
+    if not is_gate_level_tests():
+        assert stats['cycle_count'] == stats['cycles']
+        # lw x6 and the 3 instructions after it, including the final jal
+        assert get_register(dut, 6).value == stats['commit_count'] - 4
+
+
 @cocotb.test()
 async def test_blinky(dut):
     # program sets output pins and reads input pins
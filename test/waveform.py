@@ -0,0 +1,136 @@
+import json
+import os
+
+import cocotb
+from cocotb.triggers import RisingEdge, Timer
+from cocotb.utils import get_sim_time
+
+# Control of the waveform dump in tb.v. Nothing is dumped unless the
+# simulation was started with WAVEFORM=vcd or WAVEFORM=fst. By default
+# run_program dumps the whole program, WAVEFORM_START and WAVEFORM_CYCLES
+# limit it to a window:
+#
+#   WAVEFORM_START=pc:0x40      start when the CPU reaches the PC (RTL only)
+#   WAVEFORM_START=cycle:1200   start 1200 cycles after reset
+#   WAVEFORM_START=end:5000     start 5000 cycles before the program ended
+#                               in the previous run
+#   WAVEFORM_CYCLES=500         stop 500 cycles after the start
+#
+# The cycles from reset until every program ended (or timed out) are kept
+# in WAVEFORM_ENDS for end:<n>, so that a rerun of a failing test dumps the
+# last cycles of its programs. Without WAVEFORM_CYCLES, end:<n> stops n
+# cycles after the end, so the dump is never longer than 2 * n cycles.
+
+def program_ends_path():
+    return os.environ.get('WAVEFORM_ENDS', 'sim_build/program_ends.json')
+
+def load_program_ends():
+    # Test name -> cycles of every program of the test
+    try:
+        with open(program_ends_path()) as input_file:
+            return json.load(input_file)
+    except (OSError, ValueError):
+        return {}
+
+def current_test_name():
+    test = getattr(cocotb.regression_manager, '_test', None)
+    return getattr(test, '__name__', 'test')
+
+# Programs that were started by every test, to number them
+_program_counts = {}
+
+def waveform_format():
+    return os.environ.get('WAVEFORM', 'off')
+
+def is_waveform_enabled():
+    return waveform_format() != 'off'
+
+class Waveform:
+    def __init__(self, dut, clock_period_ns):
+        # Created when the reset of a program is released
+        self.dut = dut
+        self.clock_period_ns = clock_period_ns
+        self.enabled = is_waveform_enabled()
+
+        self.test = current_test_name()
+        self.index = _program_counts.get(self.test, 0)
+        _program_counts[self.test] = self.index + 1
+        self.start_ns = get_sim_time('ns')
+
+    def record_end(self):
+        # Keeps the cycles of this program for a later end:<n>. The file is
+        # read again first, as it can be shared by run_parallel.py shards.
+        cycles = round((get_sim_time('ns') - self.start_ns) / self.clock_period_ns)
+
+        ends = load_program_ends()
+        test_ends = ends.setdefault(self.test, [])
+        del test_ends[self.index:]
+        test_ends += [None] * (self.index - len(test_ends)) + [cycles]
+
+        path = program_ends_path()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w') as output_file:
+            json.dump(ends, output_file, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def start(self):
+        if self.enabled:
+            self.dut.waveform_en.value = 1
+
+    def stop(self):
+        if self.enabled:
+            self.dut.waveform_en.value = 0
+
+    async def _wait_cycles(self, cycles):
+        # One timer instead of a callback per clock
+        await Timer(cycles * self.clock_period_ns, 'ns', round_mode='round')
+
+    async def _window(self, cycles):
+        self.start()
+        if cycles is not None:
+            await self._wait_cycles(cycles)
+            self.stop()
+
+    async def start_at_pc(self, pc, cycles=None):
+        self.dut.waveform_trigger_pc.value = pc
+        self.dut.waveform_trigger_en.value = 1
+
+        await RisingEdge(self.dut.waveform_pc_hit)
+
+        self.dut.waveform_trigger_en.value = 0
+        await self._window(cycles)
+
+    async def start_at_cycle(self, cycle, cycles=None):
+        await self._wait_cycles(cycle)
+        await self._window(cycles)
+
+    async def start_before_end(self, before, cycles=None):
+        # The end of this program in the previous run. Unknown programs are
+        # dumped from the reset, for the same number of cycles.
+        cycles = 2 * before if cycles is None else cycles
+        test_ends = load_program_ends().get(self.test, [])
+        end = test_ends[self.index] if self.index < len(test_ends) else None
+
+        if end is None:
+            self.dut._log.warning('no end of program %d of %s in %s, dumping from the reset',
+                                  self.index, self.test, program_ends_path())
+            end = before
+        await self.start_at_cycle(max(end - before, 0), cycles)
+
+    async def run_from_env(self):
+        # Dumps the window that is set in the environment, see above
+        if not self.enabled:
+            return
+
+        start = os.environ.get('WAVEFORM_START', '')
+        cycles = os.environ.get('WAVEFORM_CYCLES')
+        cycles = int(cycles, 0) if cycles else None
+
+        if start.startswith('pc:'):
+            await self.start_at_pc(int(start[3:], 0), cycles)
+        elif start.startswith('cycle:'):
+            await self.start_at_cycle(int(start[6:], 0), cycles)
+        elif start.startswith('end:'):
+            await self.start_before_end(int(start[4:], 0), cycles)
+        else:
+            await self._window(cycles)